@@ -0,0 +1,215 @@
+"""
+Reproducible benchmark of the video-to-latent pipeline on synthetic clips.
+
+Clips are generated with ffmpeg's testsrc at every combination of the requested resolutions,
+lengths, frame rates and containers. Each stage then runs on every clip in a fresh process, so
+peak RSS is per stage: convert_avi_to_mp4 (avi clips), random_crop_video, extract_vae_features
+(on the CPU, with a tiny randomly initialised AutoencoderKL) and VideoDataset iteration.
+
+    python3 benchmarks/pipeline_benchmark.py --output bench.json
+    python3 benchmarks/pipeline_benchmark.py --output new.json --compare bench.json
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'processing'))
+
+STAGES = ('convert', 'crop', 'extract', 'dataset')
+VIDEO_CODECS = {
+    'mp4': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p'],
+    'avi': ['-c:v', 'mpeg4', '-q:v', '5'],
+}
+
+
+def generate_clip(path, width, height, seconds, fps):
+    """Write a testsrc clip; the container (and codec) follows the file extension."""
+    container = os.path.splitext(path)[1].lstrip('.')
+    subprocess.run(
+        ['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi', '-i', f'testsrc=size={width}x{height}:rate={fps}:duration={seconds}',
+         *VIDEO_CODECS[container], path],
+        check=True,
+    )
+    return path
+
+
+def generate_clips(clip_dir, resolutions, lengths, fps_values, containers):
+    clips = []
+    for (width, height), seconds, fps, container in itertools.product(resolutions, lengths, fps_values, containers):
+        name = f"testsrc_{width}x{height}_{seconds}s_{fps}fps.{container}"
+        clips.append({
+            'name': name,
+            'path': generate_clip(os.path.join(clip_dir, name), width, height, seconds, fps),
+            'width': width, 'height': height, 'seconds': seconds, 'fps': fps, 'container': container,
+            'frames': seconds * fps,
+        })
+    return clips
+
+
+def save_tiny_vae(path):
+    """A randomly initialised AutoencoderKL small enough to benchmark on a CPU, saved like a hub model."""
+    import torch
+    from diffusers import AutoencoderKL
+
+    torch.manual_seed(0)
+    AutoencoderKL(
+        in_channels=3, out_channels=3, latent_channels=4,
+        down_block_types=('DownEncoderBlock2D',) * 4, up_block_types=('UpDecoderBlock2D',) * 4,
+        block_out_channels=(8, 16, 16, 16), layers_per_block=1, norm_num_groups=8, sample_size=256,
+    ).save_pretrained(path)
+    return path
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def _peak_rss_mb():
+    """Peak RSS of this process and of its (ffmpeg) children, whichever is larger."""
+    self_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1 / 1024 / 1024 if sys.platform == 'darwin' else 1 / 1024  # bytes on macOS, KiB elsewhere
+    return max(self_peak, child_peak) * scale
+
+
+def run_stage(stage, clip, work_dir):
+    """Run one stage on one clip inside a fresh worker process and measure it."""
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''  # the VAE benchmark is a CPU benchmark
+    import instrumentation
+
+    input_path = clip['path']
+    output_dir = os.path.join(work_dir, 'out')
+    os.makedirs(output_dir, exist_ok=True)
+    frames = clip['frames']
+    if stage == 'dataset':
+        # VideoDataset reads a whole directory, so give it one holding only this clip
+        dataset_dir = os.path.join(work_dir, 'dataset')
+        os.makedirs(dataset_dir)
+        shutil.copy(input_path, dataset_dir)
+
+    start = time.perf_counter()
+    if stage == 'convert':
+        from avi_to_mp4 import convert_avi_to_mp4
+        ok = convert_avi_to_mp4(input_path, os.path.join(output_dir, 'converted'))
+    elif stage == 'crop':
+        from resize import random_crop_video
+        random_crop_video(input_path, os.path.join(output_dir, 'cropped.mp4'), 256, 256, seed=0, keep_input=True)
+        ok = os.path.exists(os.path.join(output_dir, 'cropped.mp4'))
+    elif stage == 'extract':
+        from vae_feature_extraction import extract_vae_features
+        ok = extract_vae_features(input_path, output_dir) is not None
+        frames = instrumentation.snapshot()['stages'].get('vae_encode', {}).get('frames', 0)
+    elif stage == 'dataset':
+        from dataloader import VideoDataset
+        dataset = VideoDataset(dataset_dir)
+        frames = sum(len(dataset[i]) for i in range(len(dataset)))
+        ok = len(dataset) == 1
+    else:
+        raise ValueError(f"Unknown stage {stage}")
+    seconds = time.perf_counter() - start
+
+    return {
+        'stage': stage,
+        'clip': clip['name'],
+        'ok': bool(ok),
+        'seconds': seconds,
+        'frames': frames,
+        'frames_per_second': frames / seconds if seconds else 0.0,
+        'peak_rss_mb': _peak_rss_mb(),
+        'bytes_written': directory_bytes(output_dir),
+        'stage_timings': instrumentation.snapshot()['stages'],
+    }
+
+
+def run_benchmarks(clips, stages, work_root, vae_path, repeats=1):
+    context = multiprocessing.get_context('spawn')
+    if vae_path:
+        os.environ['VAE_MODEL_NAME'] = vae_path  # inherited by the spawned workers
+    results = []
+    for stage, clip, repeat in itertools.product(stages, clips, range(repeats)):
+        if stage == 'convert' and clip['container'] != 'avi':
+            continue
+        if stage == 'dataset' and clip['container'] != 'mp4':
+            continue  # VideoDataset only lists .mp4 files
+        work_dir = tempfile.mkdtemp(dir=work_root)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_stage, stage, clip, work_dir).result()
+        result['repeat'] = repeat
+        shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"{stage:<8} {clip['name']:<40} {result['frames_per_second']:>9.1f} frames/s "
+              f"{result['peak_rss_mb']:>8.0f} MB peak {result['bytes_written'] / 1e6:>8.2f} MB written")
+        results.append(result)
+    return results
+
+
+def environment():
+    info = {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()}
+    try:
+        import torch
+        info['torch'] = torch.__version__
+        info['torch_threads'] = torch.get_num_threads()
+    except ImportError:
+        pass
+    info['ffmpeg'] = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout.split('\n')[0]
+    return info
+
+
+def compare(results, baseline):
+    """Print frames/s against a previous run, matched on stage and clip."""
+    previous = {(r['stage'], r['clip']): r for r in baseline['results']}
+    for result in results:
+        old = previous.get((result['stage'], result['clip']))
+        if old and old['frames_per_second']:
+            change = result['frames_per_second'] / old['frames_per_second'] - 1
+            print(f"{result['stage']:<8} {result['clip']:<40} {old['frames_per_second']:>9.1f} -> "
+                  f"{result['frames_per_second']:>9.1f} frames/s ({change:+.1%})")
+
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic ffmpeg testsrc clips.")
+    parser.add_argument('--resolutions', nargs='+', type=parse_resolution, default=[(320, 240), (640, 360), (1280, 720)])
+    parser.add_argument('--lengths', nargs='+', type=int, default=[2, 10], help="clip lengths in seconds")
+    parser.add_argument('--fps', nargs='+', type=int, default=[25, 30])
+    parser.add_argument('--containers', nargs='+', choices=sorted(VIDEO_CODECS), default=['mp4', 'avi'])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, help="earlier JSON output to compare frames/s against")
+    parser.add_argument('--keep-clips', default=None, help="generate the clips into this directory and keep them")
+    args = parser.parse_args()
+
+    work_root = tempfile.mkdtemp(prefix='vidforge_bench_')
+    try:
+        clip_dir = args.keep_clips or os.path.join(work_root, 'clips')
+        os.makedirs(clip_dir, exist_ok=True)
+        clips = generate_clips(clip_dir, args.resolutions, args.lengths, args.fps, args.containers)
+        vae_path = save_tiny_vae(os.path.join(work_root, 'tiny_vae')) if 'extract' in args.stages else ''
+        results = run_benchmarks(clips, args.stages, work_root, vae_path, args.repeats)
+    finally:
+        shutil.rmtree(work_root, ignore_errors=True)
+
+    output = {'environment': environment(), 'created_at': time.time(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -1,31 +1,268 @@
+import json
 import os
-import cv2
+import sys
+import random
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from torch.utils.data import Dataset, DataLoader
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'processing'))
+from latent_shards import LatentShardReader, shard_index_path
+from latent_codec import load_latents
+from decode_backends import open_decoder
+
 class VideoDataset(Dataset):
-    def __init__(self, video_dir):
+    def __init__(self, video_dir, clip_length=None, frame_stride=1, random_offset=True, frame_size=None, backend=None):
+        """
+        With clip_length=None every item is a whole video. With clip_length set, every item is a
+        fixed-size clip of clip_length frames taken every frame_stride frames from a random (or,
+        with random_offset=False, centred) start, so items can be batched with collate_clips.
+        frame_size=(width, height) resizes frames on decode. backend picks the decoder
+        ('opencv', 'pyav' or 'ffmpeg'; DECODE_BACKEND by default).
+        """
         self.video_files = [os.path.join(video_dir, f) for f in os.listdir(video_dir) if f.endswith('.mp4')]
+        self.clip_length = clip_length
+        self.frame_stride = max(1, frame_stride)
+        self.random_offset = random_offset
+        self.frame_size = frame_size
+        self.backend = backend
         
     def __len__(self):
         return len(self.video_files)
 
+    def _clip_start(self, num_frames):
+        span = (self.clip_length - 1) * self.frame_stride + 1
+        max_start = max(0, num_frames - span)
+        if self.random_offset:
+            return random.randint(0, max_start)
+        return max_start // 2
+
     def __getitem__(self, idx):
         video_path = self.video_files[idx]
-        cap = cv2.VideoCapture(video_path)
-        frames = []
-        
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = torch.tensor(frame).permute(2, 0, 1)  # Convert to (C, H, W) format
-            frames.append(frame)
-        
-        cap.release()
-        frames = torch.stack(frames)
-        return frames
+        with open_decoder(video_path, backend=self.backend, size=self.frame_size) as decoder:
+            if self.clip_length is None:
+                frames = torch.from_numpy(decoder.read_all())
+                return frames.permute(0, 3, 1, 2)  # Convert to (T, C, H, W) format
+
+            start = self._clip_start(decoder.frame_count)
+            indices = range(start, start + self.clip_length * self.frame_stride, self.frame_stride)
+            # Decode straight into one preallocated (T, H, W, C) buffer instead of a list + torch.stack
+            width, height = decoder.size
+            buffer = torch.empty((self.clip_length, height, width, 3), dtype=torch.uint8)
+            _, count = decoder.get_batch(indices, out=buffer.numpy())
+
+        if count == 0:
+            buffer.zero_()
+        elif count < self.clip_length:
+            buffer[count:] = buffer[count - 1]  # pad short videos by repeating the last frame
+        return buffer.permute(0, 3, 1, 2)  # Convert to (T, C, H, W) format
+
+def collate_clips(batch):
+    """Stack fixed-length (T, C, H, W) clips into a (B, T, C, H, W) uint8 batch."""
+    return torch.stack(batch)
+
+class LatentDataset(Dataset):
+    def __init__(self, source, seq_len=20, cache_dir='./latent_cache', max_open_files=8, seed=0):
+        """
+        Serve fixed-length latent sequences from precomputed VAE features.
+
+        source is a local directory or an s3://bucket/prefix holding `_vae_features_batch_*.pt`
+        segments and/or packed `.bin` latent shards. S3 objects are downloaded into cache_dir on
+        first use, and up to max_open_files loaded segments / mapped shards are kept in an LRU.
+        Shards are counted from their .json index, so nothing is downloaded or mapped until it is read.
+        """
+        self.source = source
+        self.seq_len = seq_len
+        self.cache_dir = cache_dir
+        self.max_open_files = max_open_files
+        self.seed = seed
+        self._open_files = OrderedDict()
+        self._users = {}    # id(open file) -> __getitem__ calls currently reading it
+        self._retired = {}  # id(shard reader) -> reader evicted while in use, closed by its last user
+        self._lock = threading.Lock()
+
+        if source.startswith('s3://'):
+            self.bucket, _, self.prefix = source[len('s3://'):].partition('/')
+            keys = self._list_s3_keys()
+        else:
+            self.bucket, self.prefix = None, source
+            keys = sorted(
+                os.path.relpath(os.path.join(root, f), source)
+                for root, _, files in os.walk(source) for f in files
+            )
+
+        # items are (file key, shard entry index); .pt segments have no entry index
+        self.items = []
+        for key in keys:
+            if key.endswith('.pt'):
+                self.items.append((key, None))
+            elif key.endswith('.bin'):
+                self.items.extend((key, entry) for entry in range(self._shard_entries(key)))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, idx):
+        key, entry = self.items[idx]
+        data = self._acquire(key)
+        try:
+            latents = data if entry is None else data[entry]
+            sequence = self._fit_length(latents)
+            del latents  # a view into the mapped shard; it must be gone before the reader can be closed
+        finally:
+            self._release(data)
+        return sequence
+
+    def _fit_length(self, latents):
+        # .float() copies, so no view into a mapped shard outlives the LRU entry
+        if latents.shape[0] >= self.seq_len:
+            return latents[:self.seq_len].float()
+        padding = latents[-1:].expand(self.seq_len - latents.shape[0], *latents.shape[1:])
+        return torch.cat([latents, padding]).float()
+
+    def epoch_order(self, epoch=0):
+        """
+        Deterministic shuffle for an epoch: files are shuffled, then items are shuffled within
+        windows of max_open_files files so the LRU keeps hitting. Usable as a DataLoader sampler.
+        """
+        rng = random.Random(self.seed + epoch)
+        by_file = OrderedDict()
+        for idx, (key, _) in enumerate(self.items):
+            by_file.setdefault(key, []).append(idx)
+        files = list(by_file.values())
+        rng.shuffle(files)
+
+        order = []
+        for start in range(0, len(files), self.max_open_files):
+            window = [idx for indices in files[start:start + self.max_open_files] for idx in indices]
+            rng.shuffle(window)
+            order.extend(window)
+        return order
+
+    def iter_epoch(self, epoch=0, num_threads=4, prefetch=16):
+        """Yield the items of one epoch in epoch_order, loading up to `prefetch` ahead on background threads."""
+        order = iter(self.epoch_order(epoch))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for idx in order:
+                pending.append(executor.submit(self.__getitem__, idx))
+                if len(pending) >= prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _shard_entries(self, key):
+        with open(self._local_path(key[:-len('.bin')] + '.json')) as f:
+            return len(json.load(f)['entries'])
+
+    def _acquire(self, key):
+        """The loaded segment or shard reader for key, marked in use until _release(); evicts past max_open_files."""
+        with self._lock:
+            data = self._open_files.get(key)
+            if data is not None:
+                self._open_files.move_to_end(key)
+                self._users[id(data)] = self._users.get(id(data), 0) + 1
+                return data
+
+        path = self._local_path(key)
+        if key.endswith('.bin'):
+            data = LatentShardReader(path)
+        else:
+            data = load_latents(path)  # dequantizes int8 segments
+
+        to_close = []
+        with self._lock:
+            if key in self._open_files:  # another thread opened it meanwhile
+                to_close.append(data)
+                data = self._open_files[key]
+                self._open_files.move_to_end(key)
+            else:
+                self._open_files[key] = data
+            self._users[id(data)] = self._users.get(id(data), 0) + 1
+            while len(self._open_files) > self.max_open_files:
+                _, evicted = self._open_files.popitem(last=False)
+                if self._users.get(id(evicted)):
+                    self._retired[id(evicted)] = evicted
+                else:
+                    to_close.append(evicted)
+        for evicted in to_close:
+            self._close(evicted)
+        return data
+
+    def _release(self, data):
+        with self._lock:
+            users = self._users[id(data)] - 1
+            if users:
+                self._users[id(data)] = users
+                return
+            del self._users[id(data)]
+            retired = self._retired.pop(id(data), None)
+        if retired is not None:
+            self._close(retired)
+
+    @staticmethod
+    def _close(data):
+        if isinstance(data, LatentShardReader):
+            data.close()
+
+    def close(self):
+        """Unmap every shard that is not being read; the dataset reopens them on demand."""
+        with self._lock:
+            idle = [data for data in self._open_files.values() if not self._users.get(id(data))]
+            busy = {id(data): data for data in self._open_files.values() if self._users.get(id(data))}
+            self._retired.update(busy)
+            self._open_files.clear()
+        for data in idle:
+            self._close(data)
+
+    def _local_path(self, key):
+        if self.bucket is None:
+            return os.path.join(self.prefix, key)
+
+        path = os.path.join(self.cache_dir, key)
+        if key.endswith('.bin'):
+            self._download(key[:-len('.bin')] + '.json', shard_index_path(path))
+        self._download(key, path)
+        return path
+
+    def _download(self, key, path):
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.part"
+        self._s3().download_file(self.bucket, f"{self.prefix.rstrip('/')}/{key}" if self.prefix else key, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _s3(self):
+        import boto3
+        with self._lock:
+            if getattr(self, '_s3_client', None) is None:
+                self._s3_client = boto3.client(
+                    's3',
+                    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
+                )
+            return self._s3_client
+
+    def __getstate__(self):
+        # DataLoader workers get a fresh lock, LRU and client
+        state = self.__dict__.copy()
+        state.update(_open_files=OrderedDict(), _users={}, _retired={}, _lock=None, _s3_client=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _list_s3_keys(self):
+        prefix = self.prefix.rstrip('/') + '/' if self.prefix else ''
+        keys = []
+        paginator = self._s3().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(obj['Key'][len(prefix):] for obj in page.get('Contents', []))
+        return sorted(keys)
 
 def train_dummy_model(data_loader):
     """
@@ -39,7 +276,14 @@ def train_dummy_model(data_loader):
 
 if __name__ == "__main__":
     video_dir = "./processed_videos"
-    dataset = VideoDataset(video_dir)
-    loader = DataLoader(dataset, batch_size=1, shuffle=True)
+    dataset = VideoDataset(video_dir, clip_length=16, frame_stride=2)
+    loader = DataLoader(
+        dataset,
+        batch_size=4,
+        shuffle=True,
+        num_workers=4,
+        pin_memory=torch.cuda.is_available(),
+        collate_fn=collate_clips,
+    )
     
     train_dummy_model(loader)
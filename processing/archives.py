@@ -0,0 +1,13 @@
+import os
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.webm', '.mov')
+
+
+def is_video_member(member):
+    return member.isfile() and member.name.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def archive_name(url):
+    """Name of a shard without directories, query string or extensions, e.g. 'part_0' for .../part_0.tar.gz?x=1."""
+    return os.path.basename(url.split('?')[0]).split('.')[0]
+
@@ -1,5 +1,7 @@
 import subprocess
+from instrumentation import timed
 
+@timed('convert')
 def convert_avi_to_mp4(avi_file_path, output_name):
     try:
         command = [
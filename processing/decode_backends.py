@@ -0,0 +1,288 @@
+"""
+Interchangeable video decoders.
+
+Every backend hands out frames as contiguous uint8 arrays in the requested color order ('rgb' or
+'bgr') and size, one frame at a time, in (N, H, W, 3) batches, or for an arbitrary list of frame
+indices with get_batch(). Pick one per host with DECODE_BACKEND:
+
+    opencv  cv2.VideoCapture; always available
+    pyav    PyAV with FFmpeg's frame/slice threading; color conversion and scaling happen in swscale
+    ffmpeg  an ffmpeg subprocess writing rawvideo to a pipe; decodes on its own threads
+"""
+import os
+import subprocess
+import cv2
+import numpy as np
+from video_probe import probe_video
+
+DECODE_BACKEND = os.getenv('DECODE_BACKEND', 'opencv')
+DECODE_THREADS = int(os.getenv('DECODE_THREADS', '0'))  # 0 lets the decoder pick
+
+
+def pipe_frames(command, shape):
+    """Run ffmpeg and yield its raw stdout as uint8 arrays of the given shape, one per frame."""
+    frame_size = int(np.prod(shape))
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    exhausted = False
+    try:
+        while True:
+            buffer = bytearray(frame_size)
+            if process.stdout.readinto(buffer) != frame_size:
+                exhausted = True
+                break
+            yield np.frombuffer(buffer, dtype=np.uint8).reshape(shape)
+    finally:
+        if not exhausted:
+            process.kill()
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        process.wait()
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+
+
+def build_sample_filter(target_fps):
+    """Keep the first frame at or after each 1/target_fps tick, matching FrameSampler; never duplicates frames."""
+    if not target_fps:
+        return None
+    return f"select='gte(t*{target_fps}+0.000001,selected_n)'"
+
+
+class FrameSampler:
+    """Decide which source frames to keep so the sampled stream runs at target_fps."""
+
+    def __init__(self, source_fps, target_fps):
+        self.step = None
+        if target_fps and source_fps and target_fps < source_fps:
+            self.step = target_fps / source_fps
+        self.kept = 0
+
+    def keep(self, index):
+        if self.step is None:
+            return True
+        # Keep the first frame at or after each 1/target_fps tick so the rate does not drift.
+        if index * self.step + 1e-6 >= self.kept:
+            self.kept += 1
+            return True
+        return False
+
+
+class VideoDecoder:
+    """
+    Base decoder. Subclasses implement _frames(start, keep), yielding (index, frame) for the frames
+    from `start` on that keep(index) accepts, already converted to self.color and self.size.
+    """
+
+    def __init__(self, path, size=None, color='rgb', threads=DECODE_THREADS):
+        if color not in ('rgb', 'bgr'):
+            raise ValueError(f"Unknown color order {color!r}")
+        self.path = path
+        self.color = color
+        self.threads = threads
+        metadata = probe_video(path) or {}
+        self.fps = metadata.get('fps') or 0.0
+        self.frame_count = metadata.get('frame_count') or 0
+        self.source_size = (metadata.get('width'), metadata.get('height'))
+        self.size = tuple(size) if size else self.source_size  # (width, height) of the frames handed out
+
+    def iter_frames(self, target_fps=None):
+        """Yield (H, W, 3) frames, subsampled to target_fps when given."""
+        for index, frame in self._frames(0, FrameSampler(self.fps, target_fps).keep):
+            yield frame
+
+    def iter_batches(self, batch_size, target_fps=None):
+        """Yield contiguous (N, H, W, 3) batches of up to batch_size frames."""
+        width, height = self.size
+        batch = np.empty((batch_size, height, width, 3), dtype=np.uint8)
+        count = 0
+        for frame in self.iter_frames(target_fps):
+            batch[count] = frame
+            count += 1
+            if count == batch_size:
+                yield batch
+                batch = np.empty_like(batch)
+                count = 0
+        if count:
+            yield batch[:count]
+
+    def read_all(self):
+        """Every frame as one (N, H, W, 3) array."""
+        batches = list(self.iter_batches(256))
+        width, height = self.size
+        return np.concatenate(batches) if batches else np.empty((0, height, width, 3), dtype=np.uint8)
+
+    def get_batch(self, indices, out=None):
+        """
+        Decode the given frame indices into `out` (a (len(indices), H, W, 3) uint8 array, allocated when
+        omitted), seeking to the smallest one and decoding forward once. Returns (out, frames decoded);
+        for ascending indices the decoded frames are out[:count], and indices past the end are left unfilled.
+        """
+        width, height = self.size
+        if out is None:
+            out = np.empty((len(indices), height, width, 3), dtype=np.uint8)
+        if not len(indices):
+            return out, 0
+        wanted = {}
+        for position, index in enumerate(indices):
+            wanted.setdefault(int(index), []).append(position)
+        last = max(wanted)
+        filled = 0
+        for index, frame in self._frames(min(wanted), lambda index: index in wanted):
+            for position in wanted[index]:
+                out[position] = frame
+                filled += 1
+            if index >= last:
+                break
+        return out, filled
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _frames(self, start, keep):
+        raise NotImplementedError
+
+
+class OpenCVDecoder(VideoDecoder):
+    """cv2.VideoCapture; skipped frames are grabbed but never converted to arrays."""
+
+    def __init__(self, path, size=None, color='rgb', threads=DECODE_THREADS):
+        super().__init__(path, size, color, threads)
+        self.cap = cv2.VideoCapture(path)
+        self.fps = self.fps or self.cap.get(cv2.CAP_PROP_FPS)
+        # CAP_PROP_FRAME_COUNT is a container estimate and can be 0 or -1; it only guides clip placement
+        self.frame_count = self.frame_count or max(0, int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+        if self.size[0] is None:
+            self.source_size = self.size = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self._position = 0
+
+    def _frames(self, start, keep):
+        width, height = self.size
+        if start != self._position:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        index = start
+        while self.cap.grab():
+            self._position = index + 1
+            if keep(index):
+                ret, frame = self.cap.retrieve()
+                if not ret:
+                    return
+                if frame.shape[0] != height or frame.shape[1] != width:
+                    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+                if self.color == 'rgb':
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                yield index, frame
+            index += 1
+
+    def close(self):
+        self.cap.release()
+
+
+class PyAVDecoder(VideoDecoder):
+    """PyAV with threaded decoding; frames are scaled and converted to rgb24/bgr24 by swscale."""
+
+    def __init__(self, path, size=None, color='rgb', threads=DECODE_THREADS):
+        import av
+
+        super().__init__(path, size, color, threads)
+        self.container = av.open(path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = 'AUTO'
+        if threads:
+            self.stream.codec_context.thread_count = threads
+        self.fps = self.fps or float(self.stream.average_rate or 0)
+        self.frame_count = self.frame_count or max(0, self.stream.frames)
+        if self.size[0] is None:
+            self.source_size = self.size = (self.stream.codec_context.width, self.stream.codec_context.height)
+
+    def _frames(self, start, keep):
+        width, height = self.size
+        time_base = float(self.stream.time_base)
+        first_pts = self.stream.start_time or 0
+        index = 0
+        if start and self.fps:
+            # seek to the keyframe at or before the start, then decode forward to it
+            self.container.seek(first_pts + int(start / self.fps / time_base), stream=self.stream, backward=True)
+        else:
+            self.container.seek(first_pts, stream=self.stream)
+        for frame in self.container.decode(self.stream):
+            if frame.pts is not None and self.fps:
+                index = round((frame.pts - first_pts) * time_base * self.fps)
+            if index >= start and keep(index):
+                yield index, frame.to_ndarray(format=f'{self.color}24', width=width, height=height)
+            index += 1
+
+    def close(self):
+        self.container.close()
+
+
+class FFmpegPipeDecoder(VideoDecoder):
+    """An ffmpeg subprocess that scales, converts and (optionally) subsamples before writing to a pipe."""
+
+    def __init__(self, path, size=None, color='rgb', threads=DECODE_THREADS):
+        super().__init__(path, size, color, threads)
+        if None in self.source_size:
+            # raw frames can only be cut out of the pipe at a known size; ask OpenCV when ffprobe could not tell
+            cap = cv2.VideoCapture(path)
+            try:
+                width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                self.fps = self.fps or cap.get(cv2.CAP_PROP_FPS)
+                self.frame_count = self.frame_count or max(0, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+            finally:
+                cap.release()
+            if width <= 0 or height <= 0:  # OpenCV reports -1 or 0 for a file it cannot open
+                raise ValueError(f"Cannot decode {path} with the ffmpeg backend: its frame size could not be probed")
+            self.source_size = (width, height)
+            if None in self.size:
+                self.size = self.source_size
+
+    def _command(self, video_filters, start_seconds=0):
+        width, height = self.size
+        command = ['ffmpeg', '-v', 'error']
+        if self.threads:
+            command += ['-threads', str(self.threads)]
+        if start_seconds:
+            command += ['-ss', f'{start_seconds:.6f}']  # input seek: keyframe, then accurate decode forward
+        command += ['-i', self.path]
+        filters = list(video_filters)
+        if (width, height) != tuple(self.source_size):
+            filters.append(f'scale={width}:{height}:flags=area')
+        if filters:
+            command += ['-vf', ','.join(filters)]
+        return command + ['-an', '-vsync', '0', '-f', 'rawvideo', '-pix_fmt', f'{self.color}24', 'pipe:1']
+
+    def iter_frames(self, target_fps=None):
+        width, height = self.size
+        filters = [build_sample_filter(target_fps)] if target_fps and self.fps and target_fps < self.fps else []
+        yield from pipe_frames(self._command(filters), (height, width, 3))
+
+    def _frames(self, start, keep):
+        width, height = self.size
+        start_seconds = start / self.fps if start and self.fps else 0
+        first = start if start_seconds else 0
+        for offset, frame in enumerate(pipe_frames(self._command([], start_seconds), (height, width, 3))):
+            index = first + offset
+            if keep(index):
+                yield index, frame
+
+
+DECODE_BACKENDS = {
+    'opencv': OpenCVDecoder,
+    'pyav': PyAVDecoder,
+    'ffmpeg': FFmpegPipeDecoder,
+}
+
+
+def open_decoder(path, backend=None, size=None, color='rgb', threads=DECODE_THREADS):
+    """Open `path` with the named backend (DECODE_BACKEND by default); size is (width, height)."""
+    backend = backend or DECODE_BACKEND
+    if backend not in DECODE_BACKENDS:
+        raise ValueError(f"Unknown decode backend {backend!r}, expected one of {sorted(DECODE_BACKENDS)}")
+    return DECODE_BACKENDS[backend](path, size=size, color=color, threads=threads)
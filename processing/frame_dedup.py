@@ -0,0 +1,113 @@
+"""
+Cheap near-duplicate detection for sampled frames, run before the VAE.
+
+A frame whose signature is within the threshold of the last *encoded* frame reuses that frame's
+latent instead of going through the encoder; comparing against the last encoded frame (not the
+previous one) keeps a slow pan from drifting through a long chain of reuses.
+
+    diff   mean absolute difference of 32x32 grayscale thumbnails, in 0-255 gray levels
+    dhash  difference hash of a 9x8 grayscale thumbnail; distance is the number of differing bits
+
+Enable with FRAME_DEDUP=diff or FRAME_DEDUP=dhash (off by default).
+"""
+import os
+import numpy as np
+
+DEDUP_METHODS = ('off', 'diff', 'dhash')
+FRAME_DEDUP = os.getenv('FRAME_DEDUP', 'off')
+DEFAULT_THRESHOLDS = {'diff': 1.0, 'dhash': 1}
+FRAME_DEDUP_THRESHOLD = os.getenv('FRAME_DEDUP_THRESHOLD')  # unset uses the method's default
+# Encode at least one frame in every run of this many, so a static stretch is never one latent forever
+FRAME_DEDUP_MAX_RUN = int(os.getenv('FRAME_DEDUP_MAX_RUN', '20'))
+
+
+def gray_thumbnail(frame, height, width):
+    """
+    Area-averaged (height, width) float32 grayscale thumbnail of an (H, W, 3) frame, or of a
+    (K, H, W, 3) stack of views treated as one tall image. Pixels are point-sampled onto a grid
+    4x finer than the thumbnail first, so the cost does not grow with the source resolution.
+    """
+    frame = np.asarray(frame)
+    frame = frame.reshape(-1, frame.shape[-2], frame.shape[-1])
+    rows = np.linspace(0, frame.shape[0] - 1, height * 4).astype(np.intp)
+    cols = np.linspace(0, frame.shape[1] - 1, width * 4).astype(np.intp)
+    gray = frame[rows][:, cols].mean(axis=-1, dtype=np.float32)
+    return gray.reshape(height, 4, width, 4).mean(axis=(1, 3))
+
+
+def frame_signature(frame, method):
+    if method == 'diff':
+        return gray_thumbnail(frame, 32, 32)
+    if method == 'dhash':
+        thumbnail = gray_thumbnail(frame, 8, 9)
+        return thumbnail[:, 1:] > thumbnail[:, :-1]
+    raise ValueError(f"Unknown dedup method {method!r}, expected one of {DEDUP_METHODS}")
+
+
+def signature_distance(a, b, method):
+    if method == 'diff':
+        return float(np.abs(a - b).mean())
+    return int(np.count_nonzero(a != b))
+
+
+def dedup_threshold(method, threshold=None):
+    """The threshold in effect for a method: the explicit one, else FRAME_DEDUP_THRESHOLD, else the default."""
+    if threshold is None:
+        threshold = FRAME_DEDUP_THRESHOLD
+    return float(threshold) if threshold is not None else DEFAULT_THRESHOLDS.get(method)
+
+
+class FrameDeduplicator:
+    """
+    Decide, frame by frame, whether a frame can reuse the latent of the last encoded one.
+    Keeps the indices of the reused frames for the record; the first frame it sees is start_index.
+    """
+
+    def __init__(self, method=FRAME_DEDUP, threshold=None, max_run=FRAME_DEDUP_MAX_RUN, start_index=0):
+        if method not in DEDUP_METHODS:
+            raise ValueError(f"Unknown dedup method {method!r}, expected one of {DEDUP_METHODS}")
+        self.method = method
+        self.threshold = dedup_threshold(method, threshold)
+        self.max_run = max_run
+        self.start_index = start_index
+        self.frames = 0
+        self.reused = []
+        self._reference = None
+        self._run = 0
+
+    @property
+    def enabled(self):
+        return self.method != 'off'
+
+    def is_duplicate(self, frame):
+        """True if the frame should reuse the previous latent; otherwise it becomes the new reference."""
+        index = self.start_index + self.frames
+        self.frames += 1
+        if not self.enabled:
+            return False
+        signature = frame_signature(frame, self.method)
+        if (self._reference is not None and (not self.max_run or self._run < self.max_run)
+                and signature_distance(signature, self._reference, self.method) <= self.threshold):
+            self._run += 1
+            self.reused.append(index)
+            return True
+        self._reference = signature
+        self._run = 0
+        return False
+
+    @property
+    def skip_ratio(self):
+        return len(self.reused) / self.frames if self.frames else 0.0
+
+    def summary(self):
+        return {
+            'method': self.method,
+            'threshold': self.threshold,
+            'max_run': self.max_run,
+            'start_index': self.start_index,
+            'frames': self.frames,
+            'encoded': self.frames - len(self.reused),
+            'reused': len(self.reused),
+            'skip_ratio': self.skip_ratio,
+            'reused_frames': self.reused,
+        }
@@ -0,0 +1,80 @@
+import random
+from resize import get_video_dimensions, fit_dimensions, views_filter_graph
+from decode_backends import build_sample_filter, pipe_frames
+
+
+def build_crop_filter(original_width, original_height, crop_width=256, crop_height=256, seed=None):
+    """Build the ffmpeg filter that random_crop_video would apply; returns (filter, out_width, out_height)."""
+    if original_width == crop_width and original_height == crop_height:
+        return None, crop_width, crop_height
+
+    if crop_width > original_width or crop_height > original_height:
+        new_width, new_height = fit_dimensions(original_width, original_height, crop_width, crop_height)
+        return f"scale={new_width}:{new_height}", new_width, new_height
+
+    rng = random.Random(seed) if seed is not None else random
+    x_offset = rng.randint(0, original_width - crop_width)
+    y_offset = rng.randint(0, original_height - crop_height)
+    print(f"Cropping video at x: {x_offset}, y: {y_offset}, width: {crop_width}, height: {crop_height}")
+    return f"crop={crop_width}:{crop_height}:{x_offset}:{y_offset}", crop_width, crop_height
+
+
+def build_ffmpeg_command(input_file, video_filter, mp4_output=None, target_fps=None):
+    """One ffmpeg invocation: decode once, filter, pipe raw frames to stdout and optionally tee an mp4."""
+    command = ['ffmpeg', '-v', 'error', '-y', '-i', input_file]
+    sample_filter = build_sample_filter(target_fps)
+    raw_output = ['-vsync', '0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+
+    if mp4_output is None:
+        filters = [f for f in (video_filter, sample_filter) if f]
+        if filters:
+            command += ['-vf', ','.join(filters)]
+        return command + ['-an'] + raw_output
+
+    # split the filtered stream so the mp4 and the raw pipe share a single decode;
+    # only the raw branch is subsampled, the uploaded mp4 keeps every frame
+    graph = f"[0:v]{video_filter or 'null'},split=2[enc][raw]"
+    if sample_filter:
+        graph = f"[0:v]{video_filter or 'null'},split=2[enc][full];[full]{sample_filter}[raw]"
+    command += ['-filter_complex', graph]
+    command += [
+        '-map', '[enc]', '-map', '0:a?',
+        '-c:v', 'libx264', '-b:v', '2000k', '-vprofile', 'high', '-bf', '0',
+        '-c:a', 'aac', '-ac', '2', '-b:a', '160k',
+        '-f', 'mp4', mp4_output,
+    ]
+    return command + ['-map', '[raw]'] + raw_output
+
+
+def stream_video_frames(input_file, crop_width=256, crop_height=256, mp4_output=None, target_fps=None, seed=None):
+    """
+    Decode, crop and scale a video in one ffmpeg pass and yield its frames as (H, W, 3) BGR arrays.
+
+    Frames come out in the same channel order as cv2.VideoCapture, so they can go straight into
+    the VAE transform. When mp4_output is given, the cropped clip is also encoded there in the same pass.
+    target_fps subsamples the piped frames only; seed makes the random crop reproducible.
+    """
+    original_width, original_height = get_video_dimensions(input_file)
+    if original_width is None or original_height is None:
+        return
+
+    video_filter, width, height = build_crop_filter(original_width, original_height, crop_width, crop_height, seed)
+    command = build_ffmpeg_command(input_file, video_filter, mp4_output, target_fps)
+    yield from pipe_frames(command, (height, width, 3))
+
+
+def stream_video_views(input_file, views, target_fps=None):
+    """
+    Decode a video once and yield, per sampled frame, all of its planned crop views (see resize.crop_views)
+    as one (K, H, W, 3) BGR array. The views are stacked vertically inside ffmpeg, so they share one pipe.
+    """
+    graph = views_filter_graph(views)
+    stacked = ''.join(f"[v{i}]" for i in range(len(views)))
+    graph += f";{stacked}vstack=inputs={len(views)}" if len(views) > 1 else ";[v0]null"
+    sample_filter = build_sample_filter(target_fps)
+    graph += f",{sample_filter}[raw]" if sample_filter else "[raw]"
+    command = ['ffmpeg', '-v', 'error', '-y', '-i', input_file, '-filter_complex', graph, '-map', '[raw]', '-an',
+               '-vsync', '0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+    height, width = views[0]['output_height'], views[0]['output_width']
+    yield from pipe_frames(command, (len(views), height, width, 3))
+
@@ -0,0 +1,197 @@
+"""
+Per-stage timers and counters for the pipeline.
+
+Each process accumulates, per stage, the number of calls, busy seconds, bytes and frames handled.
+Celery tasks reset the counters when they start and publish a snapshot as a structured event when
+they finish (see process.py); the submitter aggregates those events into a throughput report.
+"""
+import functools
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+GPU_SAMPLE_INTERVAL = float(os.getenv('GPU_SAMPLE_INTERVAL', '1.0'))
+# Redis list (on the result backend) that task events are pushed to and the submitter reads back
+METRICS_KEY = os.getenv('METRICS_KEY', 'vidforge:metrics')
+
+_lock = threading.Lock()
+_stages = {}
+_gpu = {}
+
+
+class StageCounter:
+    """Counts added to a stage while its timer runs."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.frames = 0
+
+
+def _record(name, seconds, bytes_=0, frames=0, failed=False):
+    with _lock:
+        totals = _stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'frames': 0, 'errors': 0})
+        totals['calls'] += 1
+        totals['seconds'] += seconds
+        totals['bytes'] += bytes_
+        totals['frames'] += frames
+        totals['errors'] += int(failed)
+
+
+@contextmanager
+def stage(name):
+    """Time a block as one call of `name`; add to the yielded counter's bytes and frames inside it."""
+    counter = StageCounter()
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield counter
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        _record(name, time.perf_counter() - start, counter.bytes, counter.frames, failed)
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def timed(name, input_path_arg=0):
+    """
+    Decorator timing every call of a function as stage `name`. The size of the file passed as
+    positional argument input_path_arg is counted as the stage's bytes; a False return and an exception
+    count as an error.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            size = _file_size(args[input_path_arg]) if input_path_arg is not None and len(args) > input_path_arg else 0
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = result is False
+                return result
+            finally:
+                _record(name, time.perf_counter() - start, size, 0, failed)
+        return wrapper
+    return decorator
+
+
+class GpuSampler:
+    """
+    Sample GPU utilization and memory on a background thread while open; the summary is merged
+    into the process snapshot. Does nothing without CUDA.
+    """
+
+    def __init__(self, interval=GPU_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._utilization = []
+        self._memory = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def start(self):
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+            self._thread = threading.Thread(target=self._run, args=(torch,), daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self, torch):
+        while not self._stop.wait(self.interval):
+            try:
+                self._utilization.append(torch.cuda.utilization())  # needs pynvml
+            except Exception:
+                pass
+            self._memory.append(torch.cuda.memory_allocated())
+
+    def stop(self):
+        if self._thread is None:
+            return
+        import torch
+        self._stop.set()
+        self._thread.join()
+        with _lock:
+            _gpu['samples'] = _gpu.get('samples', 0) + len(self._memory)
+            if self._utilization:
+                _gpu['utilization_mean'] = sum(self._utilization) / len(self._utilization)
+            _gpu['memory_peak'] = max(_gpu.get('memory_peak', 0), torch.cuda.max_memory_allocated())
+            if self._memory:
+                _gpu['memory_mean'] = sum(self._memory) / len(self._memory)
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _gpu.clear()
+
+
+def snapshot():
+    """Everything recorded in this process since the last reset, as a JSON-serialisable event."""
+    with _lock:
+        return {
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'time': time.time(),
+            'stages': {name: dict(totals) for name, totals in _stages.items()},
+            'gpu': dict(_gpu),
+        }
+
+
+def aggregate(events):
+    """Sum the stage totals of many events; per-stage rates are computed over summed busy seconds."""
+    stages = {}
+    for event in events:
+        for name, totals in event.get('stages', {}).items():
+            merged = stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'frames': 0, 'errors': 0})
+            for field in merged:
+                merged[field] += totals.get(field, 0)
+    for totals in stages.values():
+        seconds = totals['seconds']
+        totals['frames_per_second'] = totals['frames'] / seconds if seconds else 0.0
+        totals['megabytes_per_second'] = totals['bytes'] / seconds / 1e6 if seconds else 0.0
+    return stages
+
+
+def report(events, wall_seconds, dollars=None, target_fps=4, frames_stage='vae_encode'):
+    """
+    Per-stage throughput plus the cost of the run per hour of source video. Video time is counted
+    from the frames the VAE encoded at target_fps, plus the frames that reused a latent instead.
+    """
+    stages = aggregate(events)
+    reused = stages.get('dedup', {}).get('frames', 0)
+    video_hours = (stages.get(frames_stage, {}).get('frames', 0) + reused) / target_fps / 3600
+    summary = {
+        'tasks': len(events),
+        'reused_frames': reused,
+        'wall_seconds': wall_seconds,
+        'video_hours': video_hours,
+        'stages': stages,
+        'dollars': dollars,
+        'dollars_per_video_hour': dollars / video_hours if dollars is not None and video_hours else None,
+    }
+    print(f"{'stage':<16}{'calls':>8}{'busy s':>10}{'frames/s':>10}{'MB/s':>8}{'errors':>8}")
+    for name, totals in sorted(stages.items(), key=lambda item: -item[1]['seconds']):
+        print(f"{name:<16}{totals['calls']:>8}{totals['seconds']:>10.1f}{totals['frames_per_second']:>10.1f}"
+              f"{totals['megabytes_per_second']:>8.1f}{totals['errors']:>8}")
+    if reused:
+        encoded = stages.get(frames_stage, {}).get('frames', 0)
+        print(f"Dedup reused latents for {reused} of {encoded + reused} frames ({reused / (encoded + reused):.1%} skipped)")
+    print(f"{video_hours:.2f} hours of video in {wall_seconds / 3600:.2f} hours"
+          + (f", ${dollars:.2f} total, ${summary['dollars_per_video_hour']:.3f} per hour of video"
+             if summary['dollars_per_video_hour'] is not None else ""))
+    return summary
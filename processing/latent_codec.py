@@ -0,0 +1,164 @@
+"""
+What is kept from the VAE posterior, and how it is stored.
+
+Policies: 'mean' (the posterior mean), 'mean_logvar' (mean and log-variance concatenated along the
+channel axis, 2C channels) or 'sample' (one draw from the posterior, seeded per video by sample_generator).
+Storage dtypes: 'fp32', 'fp16' or 'int8' (per-channel affine quantization with a stored scale and
+zero point). Plain mean latents in fp32/fp16 are saved as bare tensors, as before; everything else
+is saved as a dict that load_latents understands.
+
+    python3 latent_codec.py check <video_file> [--frames 32]    # reconstruction error per policy/dtype
+"""
+import hashlib
+import os
+import torch
+
+LATENT_POLICIES = ('mean', 'mean_logvar', 'sample')
+LATENT_DTYPES = ('fp32', 'fp16', 'int8')
+LATENT_POLICY = os.getenv('LATENT_POLICY', 'mean')
+LATENT_DTYPE = os.getenv('LATENT_DTYPE', 'fp32')
+LATENT_SAMPLE_SEED = int(os.getenv('LATENT_SAMPLE_SEED', '0'))
+
+
+def sample_generator(name, seed=LATENT_SAMPLE_SEED, device=None):
+    """Generator for the 'sample' policy of one video, seeded from seed and a stable digest of its name."""
+    digest = hashlib.sha256(f"{seed}:{name}".encode()).digest()
+    return torch.Generator(device=device).manual_seed(int.from_bytes(digest[:8], 'big'))
+
+
+def select_latents(latent_dist, policy=LATENT_POLICY, generator=None):
+    """
+    Reduce a DiagonalGaussianDistribution to the (N, C or 2C, H, W) tensor the policy keeps.
+
+    For 'sample', generator is one generator for the whole batch or a list with one per row, so rows
+    of different videos draw from their own streams whatever batch they land in.
+    """
+    if policy == 'mean':
+        return latent_dist.mean
+    if policy == 'mean_logvar':
+        return torch.cat([latent_dist.mean, latent_dist.logvar], dim=1)
+    if policy == 'sample':
+        mean = latent_dist.mean
+        if isinstance(generator, (list, tuple)):
+            noise = torch.stack([torch.randn(mean.shape[1:], generator=row, device=row.device, dtype=mean.dtype)
+                                 for row in generator])
+        else:
+            noise = torch.randn(mean.shape, generator=generator, device=generator.device if generator else None,
+                                dtype=mean.dtype)
+        return mean + latent_dist.std * noise.to(mean.device)
+    raise ValueError(f"Unknown latent policy {policy!r}, expected one of {LATENT_POLICIES}")
+
+
+def split_mean_logvar(latents):
+    """Inverse of the 'mean_logvar' policy: (mean, logvar) along the channel axis of (..., 2C, H, W)."""
+    return latents.chunk(2, dim=-3)
+
+
+def quantize_int8(latents):
+    """
+    Per-channel affine int8 quantization of a (..., C, H, W) tensor. Returns (q, scale, zero_point),
+    where latents ≈ (q - zero_point) * scale, channel by channel.
+    """
+    latents = latents.float()
+    channels = latents.shape[-3]
+    per_channel = latents.transpose(0, -3).reshape(channels, -1) if latents.dim() > 3 else latents.reshape(channels, -1)
+    low, high = per_channel.min(dim=1).values, per_channel.max(dim=1).values
+    scale = ((high - low) / 255).clamp(min=1e-8)
+    zero_point = (-128 - torch.round(low / scale)).to(torch.int32)
+    shape = (channels, 1, 1)
+    q = torch.clamp(torch.round(latents / scale.view(shape)) + zero_point.view(shape), -128, 127).to(torch.int8)
+    return q, scale, zero_point
+
+
+def dequantize_int8(q, scale, zero_point):
+    shape = (len(scale), 1, 1)
+    scale = torch.as_tensor(scale, dtype=torch.float32).view(shape)
+    zero_point = torch.as_tensor(zero_point, dtype=torch.float32).view(shape)
+    return (q.float() - zero_point) * scale
+
+
+def pack_latents(latents, dtype=LATENT_DTYPE, policy=LATENT_POLICY):
+    """What torch.save should store for a (T, C, H, W) latent segment under the given dtype and policy."""
+    latents = latents.detach().cpu()
+    if dtype not in LATENT_DTYPES:
+        raise ValueError(f"Unknown latent dtype {dtype!r}, expected one of {LATENT_DTYPES}")
+    if dtype == 'int8':
+        q, scale, zero_point = quantize_int8(latents)
+        return {'policy': policy, 'dtype': 'int8', 'data': q, 'scale': scale, 'zero_point': zero_point}
+    data = latents.half() if dtype == 'fp16' else latents.float()
+    if policy == 'mean':
+        return data
+    return {'policy': policy, 'dtype': dtype, 'data': data}
+
+
+def unpack_latents(obj):
+    """fp32 latents from anything pack_latents produced (or a bare tensor from older runs)."""
+    if torch.is_tensor(obj):
+        return obj.float()
+    if obj['dtype'] == 'int8':
+        return dequantize_int8(obj['data'], obj['scale'], obj['zero_point'])
+    return obj['data'].float()
+
+
+def load_latents(path):
+    """Load a saved latent segment as fp32, dequantizing if needed."""
+    return unpack_latents(torch.load(path, map_location='cpu'))
+
+
+def packed_bytes(obj):
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    return sum(value.numel() * value.element_size() for value in obj.values() if torch.is_tensor(value))
+
+
+def reconstruction_check(frames, model=None, policies=LATENT_POLICIES, dtypes=LATENT_DTYPES, seed=LATENT_SAMPLE_SEED):
+    """
+    Encode (N, 3, H, W) frames in [0, 1], store the latents under every policy/dtype, decode them back
+    and report latent RMSE against fp32, image PSNR against the input and bytes per frame.
+    """
+    from model_manager import get_vae
+
+    model = model if model is not None else get_vae()
+    device = next(model.parameters()).device
+    frames = frames.to(device)
+    results = []
+    with torch.inference_mode():
+        latent_dist = model.encode(frames).latent_dist
+        for policy in policies:
+            generator = torch.Generator(device=device).manual_seed(seed)
+            reference = select_latents(latent_dist, policy, generator).float().cpu()
+            for dtype in dtypes:
+                packed = pack_latents(reference, dtype, policy)
+                restored = unpack_latents(packed)
+                decodable = split_mean_logvar(restored)[0] if policy == 'mean_logvar' else restored
+                decoded = model.decode(decodable.to(device)).sample.float().clamp(0, 1)
+                mse = torch.mean((decoded - frames.float()) ** 2).item()
+                results.append({
+                    'policy': policy,
+                    'dtype': dtype,
+                    'latent_rmse': torch.sqrt(torch.mean((restored - reference) ** 2)).item(),
+                    'psnr': 10 * torch.log10(torch.tensor(1.0 / max(mse, 1e-12))).item(),
+                    'bytes_per_frame': packed_bytes(packed) / len(frames),
+                })
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    from vae_feature_extraction import read_video_frames, transform
+
+    parser = argparse.ArgumentParser(description="Measure latent storage size against reconstruction quality.")
+    parser.add_argument('command', choices=['check'])
+    parser.add_argument('video_file')
+    parser.add_argument('--frames', type=int, default=32)
+    args = parser.parse_args()
+
+    frames = []
+    for frame in read_video_frames(args.video_file):
+        frames.append(transform(frame))
+        if len(frames) == args.frames:
+            break
+    print(f"{'policy':<12}{'dtype':<6}{'bytes/frame':>12}{'latent rmse':>13}{'psnr dB':>9}")
+    for result in reconstruction_check(torch.stack(frames)):
+        print(f"{result['policy']:<12}{result['dtype']:<6}{result['bytes_per_frame']:>12.0f}"
+              f"{result['latent_rmse']:>13.5f}{result['psnr']:>9.2f}")
@@ -0,0 +1,159 @@
+import json
+import mmap
+import os
+import torch
+from upload_to_s3 import upload_file_to_s3
+from latent_codec import LATENT_DTYPE, LATENT_POLICY, dequantize_int8, quantize_int8
+
+SHARD_MAX_BYTES = int(os.getenv('LATENT_SHARD_MAX_BYTES', str(1 << 30)))  # roll over to a new shard after ~1 GiB
+
+
+def shard_index_path(shard_path):
+    """The JSON index that sits next to a .bin shard."""
+    return os.path.splitext(shard_path)[0] + '.json'
+
+
+class LatentShardWriter:
+    """
+    Append latent segments from many videos into large contiguous fp16 (or per-channel int8) shards.
+
+    Each shard is a raw `<prefix>_<n>.bin` array plus a `<prefix>_<n>.json` index with one
+    entry per segment: video_id, segment, byte offset and shape, and for int8 the per-channel
+    scale and zero point.
+    """
+
+    def __init__(self, output_dir, prefix='latents', max_shard_bytes=SHARD_MAX_BYTES, bucket_name=None, s3_prefix='vae_shards',
+                 uploader=None, dtype='int8' if LATENT_DTYPE == 'int8' else 'float16', policy=LATENT_POLICY):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_shard_bytes = max_shard_bytes
+        self.bucket_name = bucket_name
+        self.s3_prefix = s3_prefix
+        self.uploader = uploader
+        self.dtype = dtype
+        self.policy = policy
+        self.shard_paths = []
+        self._shard_number = 0
+        self._file = None
+        self._path = None
+        self._offset = 0
+        self._entries = []
+
+    def append(self, video_id, segment, latents):
+        """Write one (T, C, H, W) latent segment; returns (shard_path, entry)."""
+        latents = latents.detach().cpu()
+        quantization = {}
+        if self.dtype == 'int8':
+            data, scale, zero_point = quantize_int8(latents)
+            quantization = {'scale': scale.tolist(), 'zero_point': zero_point.tolist()}
+        else:
+            data = latents.to(torch.float16)
+        data = data.contiguous()
+        nbytes = data.numel() * data.element_size()
+
+        if self._file is not None and self._offset and self._offset + nbytes > self.max_shard_bytes:
+            self._finish_shard()
+        if self._file is None:
+            self._start_shard()
+
+        self._file.write(data.numpy().tobytes())
+        entry = {
+            'video_id': video_id,
+            'segment': segment,
+            'offset': self._offset,
+            'shape': list(data.shape),
+            **quantization,
+        }
+        self._entries.append(entry)
+        self._offset += nbytes
+        return self._path, entry
+
+    def close(self):
+        """Finish the open shard and return the paths of every shard written."""
+        if self._file is not None:
+            self._finish_shard()
+        return self.shard_paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _start_shard(self):
+        while True:
+            path = os.path.join(self.output_dir, f"{self.prefix}_{self._shard_number:05d}.bin")
+            self._shard_number += 1
+            if not os.path.exists(path):
+                break
+        self._path = path
+        self._file = open(path, 'wb')
+        self._offset = 0
+        self._entries = []
+
+    def _finish_shard(self):
+        self._file.close()
+        index_path = shard_index_path(self._path)
+        with open(index_path, 'w') as f:
+            json.dump({'dtype': self.dtype, 'policy': self.policy, 'entries': self._entries}, f)
+        print(f"Saved latent shard: {self._path} ({len(self._entries)} segments, {self._offset} bytes)")
+
+        if self.bucket_name:
+            for path in (self._path, index_path):
+                object_name = f"{self.s3_prefix}/{os.path.basename(path)}"
+                if self.uploader is not None:
+                    self.uploader.submit(path, self.bucket_name, object_name)
+                else:
+                    upload_file_to_s3(path, self.bucket_name, object_name)
+
+        self.shard_paths.append(self._path)
+        self._file = None
+        self._path = None
+
+
+class LatentShardReader:
+    """Memory-map a shard and hand out zero-copy tensor views of its segments (dequantized copies for int8 shards)."""
+
+    def __init__(self, shard_path):
+        with open(shard_index_path(shard_path)) as f:
+            index = json.load(f)
+        self.shard_path = shard_path
+        self.dtype = getattr(torch, index['dtype'])
+        self.policy = index.get('policy', 'mean')
+        self.entries = index['entries']
+        self._lookup = {(e['video_id'], e['segment']): i for i, e in enumerate(self.entries)}
+        self._file = open(shard_path, 'rb')
+        # copy-on-write mapping: pages are shared with the page cache and the buffer stays writable for torch
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, idx):
+        entry = self.entries[idx]
+        shape = entry['shape']
+        count = 1
+        for dim in shape:
+            count *= dim
+        data = torch.frombuffer(self._mmap, dtype=self.dtype, count=count, offset=entry['offset']).view(shape)
+        if self.dtype == torch.int8:
+            return dequantize_int8(data, entry['scale'], entry['zero_point'])
+        return data
+
+    def get(self, video_id, segment):
+        return self[self._lookup[(video_id, segment)]]
+
+    def close(self):
+        """Unmap the shard; views handed out earlier must be released first, or the mapping outlives them."""
+        self._file.close()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # a view is still alive; the mapping is released when it is garbage collected
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,196 @@
+"""
+Run the whole pipeline on one machine, without Redis or Celery.
+
+Conversion and cropping run across a process pool; a single encoder thread owns the VAE and
+is fed ready clips through a bounded queue. Outputs land in the same layout as the Celery tasks.
+
+    python3 local_runner.py <video_dir | url_list.txt> <output_dir> [--workers 8] [--bucket kinetics-400]
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from tqdm import tqdm
+from archives import VIDEO_EXTENSIONS, archive_name
+from tar_ingest import iter_archive_videos
+from manifest import archive_member_source
+from video_probe import probe_directory
+from process import preprocess_video, encode_video
+from vae_feature_extraction import TARGET_FPS
+
+ARCHIVE_EXTENSIONS = ('.tar.gz', '.tgz', '.tar')
+_DONE = object()
+
+
+def read_sources(source, index_dir=None):
+    """
+    A directory yields its videos, longest first (from the probe index) so the pool does not end on one
+    long straggler; a text file yields one path or URL per line. The probe index is kept in index_dir,
+    so the input directory is only read.
+    """
+    if os.path.isdir(source):
+        index = probe_directory(source, index_dir=index_dir)
+        names = sorted((f for f in os.listdir(source) if f.lower().endswith(VIDEO_EXTENSIONS)),
+                       key=lambda name: -((index.get(name) or {}).get('duration') or 0))
+        return [os.path.join(source, name) for name in names]
+    with open(source) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def iter_videos(video_paths, archives, output_dir):
+    """
+    Yield (path, manifest source or None) for every video: the plain paths first, then the members of each
+    archive, streamed into output_dir one at a time as they are asked for. An archive that fails to download
+    is reported and skipped after the members already read from it.
+    """
+    for file_path in video_paths:
+        yield file_path, None
+    for url in archives:
+        archive_dir = os.path.join(output_dir, archive_name(url))
+        os.makedirs(archive_dir, exist_ok=True)
+        try:
+            for member_name, video_path in iter_archive_videos(url, archive_dir):
+                yield video_path, archive_member_source(url, member_name)
+        except Exception as e:
+            print(f"Error reading archive {url}: {e}")
+
+
+def preprocess_job(file_path, output_dir, target_width, target_height, target_fps, keep_source, source=None):
+    """Pool job: convert and crop one video; returns (clip, or None/False when skipped/failed, seconds spent)."""
+    start = time.time()
+    clip = preprocess_video(file_path, output_dir, target_width, target_height, None, target_fps, keep_source, source)
+    return clip, time.time() - start
+
+
+class EncoderThread(threading.Thread):
+    """Owns the VAE for the whole run and encodes clips in arrival order."""
+
+    def __init__(self, clips, output_dir, target_width, target_height, bucket_name, target_fps, progress_bar):
+        super().__init__(daemon=True)
+        self.clips = clips
+        self.args = (output_dir, target_width, target_height, bucket_name, target_fps)
+        self.progress_bar = progress_bar
+        self.encoded = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.idle_seconds = 0.0
+
+    def run(self):
+        while True:
+            wait_start = time.time()
+            clip = self.clips.get()
+            self.idle_seconds += time.time() - wait_start
+            if clip is _DONE:
+                return
+
+            start = time.time()
+            try:
+                ok = encode_video(clip, *self.args)
+            except Exception as e:
+                print(f"Error encoding {clip['file_path']}: {e}")
+                ok = False
+            self.busy_seconds += time.time() - start
+            if ok:
+                self.encoded += 1
+            else:
+                self.failed += 1
+            self.progress_bar.update(1)
+
+
+def run(source, output_dir, workers=None, queue_size=8, target_width=256, target_height=256, bucket_name=None,
+        target_fps=TARGET_FPS, keep_sources=True):
+    """Process every video behind `source` and return a throughput summary."""
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or max(1, os.cpu_count() - 1)
+    started = time.time()
+    # spawn, not fork: the parent runs the encoder thread and may already hold a CUDA context
+    context = multiprocessing.get_context('spawn')
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        sources = read_sources(source, index_dir=output_dir)
+        archives = [s for s in sources if s.lower().endswith(ARCHIVE_EXTENSIONS)]
+        video_paths = [s for s in sources if not s.lower().endswith(ARCHIVE_EXTENSIONS)]
+
+        # archive members are only counted once they are read
+        progress_bar = tqdm(total=len(video_paths), desc="encoded", unit="video")
+        clips = queue.Queue(maxsize=queue_size)
+        encoder = EncoderThread(clips, output_dir, target_width, target_height, bucket_name, target_fps, progress_bar)
+        encoder.start()
+
+        preprocess_seconds = 0.0
+        skipped = 0
+        submitted = 0
+        pending = set()
+        remaining = iter_videos(video_paths, archives, output_dir)
+        # never run more than the pool plus the queue ahead of the encoder, so clips and archive members on disk stay
+        # bounded; the next archive member is only read once a slot frees up, while the pool works on the others
+        max_in_flight = workers + queue_size
+        while True:
+            for file_path, member_source in remaining:
+                # extracted archive members are our own copies, always safe to remove
+                keep_source = keep_sources and member_source is None
+                pending.add(pool.submit(preprocess_job, file_path, output_dir, target_width, target_height, target_fps, keep_source,
+                                        member_source))
+                submitted += 1
+                if submitted > progress_bar.total:
+                    progress_bar.total = submitted
+                    progress_bar.refresh()
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    clip, seconds = future.result()
+                except Exception as e:
+                    print(f"Error preprocessing a video: {e}")
+                    clip, seconds = None, 0.0
+                preprocess_seconds += seconds
+                if not clip:
+                    skipped += 1
+                    progress_bar.update(1)
+                else:
+                    clips.put(clip)  # blocks while the encoder is behind
+
+        clips.put(_DONE)
+        encoder.join()
+        progress_bar.close()
+
+    elapsed = time.time() - started
+    summary = {
+        'videos': submitted,
+        'encoded': encoder.encoded,
+        'failed': encoder.failed,
+        'skipped_or_failed_preprocess': skipped,
+        'elapsed_seconds': elapsed,
+        'videos_per_second': encoder.encoded / elapsed if elapsed else 0.0,
+        'preprocess_seconds': preprocess_seconds,
+        'encode_seconds': encoder.busy_seconds,
+        'encoder_idle_fraction': encoder.idle_seconds / elapsed if elapsed else 0.0,
+    }
+    print(f"Encoded {summary['encoded']}/{summary['videos']} videos in {elapsed:.1f}s "
+          f"({summary['videos_per_second']:.2f} videos/s); preprocessing {preprocess_seconds:.1f} worker-s, "
+          f"encoding {encoder.busy_seconds:.1f}s, encoder idle {summary['encoder_idle_fraction']:.0%}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the video-to-latent pipeline locally without a broker.")
+    parser.add_argument('source', help="directory of videos, or a text file of paths/URLs (tar.gz shards allowed)")
+    parser.add_argument('output_dir')
+    parser.add_argument('--workers', type=int, default=None, help="preprocessing processes (default: cores - 1)")
+    parser.add_argument('--queue-size', type=int, default=8, help="ready clips buffered ahead of the encoder")
+    parser.add_argument('--width', type=int, default=256)
+    parser.add_argument('--height', type=int, default=256)
+    parser.add_argument('--fps', type=float, default=TARGET_FPS)
+    parser.add_argument('--bucket', default=None, help="also upload results to this S3 bucket")
+    parser.add_argument('--consume-sources', action='store_true', help="delete source videos after processing, like the workers do")
+    args = parser.parse_args()
+
+    run(args.source, args.output_dir, args.workers, args.queue_size, args.width, args.height, args.bucket, args.fps,
+        keep_sources=not args.consume_sources)
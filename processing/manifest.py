@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from upload_to_s3 import get_s3_client
+
+# Local directory or s3://bucket/prefix where completion records are kept
+MANIFEST_URI = os.getenv('MANIFEST_URI', './manifest')
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """sha256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_key(source, params):
+    """
+    Key a unit of work on its source (path or URL) plus the pipeline parameters that shape its output,
+    so changing the crop size, fps or VAE model produces a different key.
+    """
+    payload = json.dumps({'source': source, 'params': params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def archive_member_source(archive_url, member_name):
+    """
+    Manifest source of a video inside a tar.gz shard. Spooled copies live at worker-local paths, so videos
+    are keyed on where they came from instead, which the submitter can compute from the archive listing.
+    """
+    return f"{archive_url}#{member_name}"
+
+
+def pipeline_params(target_width=256, target_height=256, target_fps=4, frames_per_segment=20, segment_stride=None,
+                    vae_model=os.getenv('VAE_MODEL_NAME', 'stabilityai/sd-vae-ft-mse'), crop_views=1, crop_mode='random',
+                    latent_policy=os.getenv('LATENT_POLICY', 'mean'), latent_dtype=os.getenv('LATENT_DTYPE', 'fp32'),
+                    frame_dedup=os.getenv('FRAME_DEDUP', 'off'), frame_dedup_threshold=os.getenv('FRAME_DEDUP_THRESHOLD'),
+                    frame_dedup_max_run=int(os.getenv('FRAME_DEDUP_MAX_RUN', '20'))):
+    """The parameters that change what process_video produces for a given source."""
+    params = {
+        'crop': [target_width, target_height],
+        'fps': target_fps,
+        'frames_per_segment': frames_per_segment,
+        'segment_stride': segment_stride or frames_per_segment,
+        'vae_model': vae_model,
+    }
+    if crop_views > 1:  # single-view keys stay as they were before multi-crop existed
+        params['crop_views'] = [crop_views, crop_mode]
+    if (latent_policy, latent_dtype) != ('mean', 'fp32'):
+        params['latent_storage'] = [latent_policy, latent_dtype]
+    if frame_dedup != 'off':  # reused latents change the output, so they get their own key
+        params['frame_dedup'] = [frame_dedup, frame_dedup_threshold, frame_dedup_max_run]
+    return params
+
+
+def crop_seed(key):
+    """Deterministic crop seed for a manifest key, so a resumed run crops exactly like the first one."""
+    return int(key[:16], 16)
+
+
+class Manifest:
+    """Completion records, one small JSON object per key, stored in a local directory or under an S3 prefix."""
+
+    def __init__(self, uri=MANIFEST_URI):
+        self.uri = uri
+        if uri.startswith('s3://'):
+            self.bucket, _, prefix = uri[len('s3://'):].partition('/')
+            self.prefix = prefix.rstrip('/')
+        else:
+            self.bucket, self.prefix = None, uri
+            os.makedirs(uri, exist_ok=True)
+
+    def get(self, key):
+        if self.bucket is None:
+            path = os.path.join(self.prefix, f"{key}.json")
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                return json.load(f)
+
+        client = get_s3_client()
+        try:
+            body = client.get_object(Bucket=self.bucket, Key=self._object_name(key))['Body'].read()
+        except client.exceptions.NoSuchKey:
+            return None
+        return json.loads(body)
+
+    def put(self, key, record):
+        record = dict(record, updated_at=time.time())
+        if self.bucket is None:
+            path = os.path.join(self.prefix, f"{key}.json")
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(record, f)
+            os.replace(tmp_path, path)  # atomic, so a preempted worker never leaves a torn record
+        else:
+            get_s3_client().put_object(Bucket=self.bucket, Key=self._object_name(key), Body=json.dumps(record).encode())
+
+    def is_complete(self, key, content_hash=None):
+        """True if the key finished; with content_hash, only if it finished on the same source bytes."""
+        record = self.get(key)
+        if record is None or record.get('status') != 'complete':
+            return False
+        return content_hash is None or record.get('content_hash') == content_hash
+
+    def _object_name(self, key):
+        return f"{self.prefix}/{key}.json" if self.prefix else f"{key}.json"
+
+
+class ManifestProgress:
+    """
+    Track one video's progress in the manifest.
+
+    Segments may finish uploading out of order, so only the contiguous prefix of finished
+    segments is recorded; a rerun resumes from the first segment not in that prefix.
+    """
+
+    def __init__(self, manifest, key, source, params, content_hash=None):
+        self.manifest = manifest
+        self.key = key
+        self._lock = threading.Lock()
+        previous = manifest.get(key)
+        if previous is not None and content_hash is not None and previous.get('content_hash') != content_hash:
+            previous = None  # the source changed since the last run, start over
+        self.record = previous or {
+            'source': source,
+            'params': params,
+            'content_hash': content_hash,
+            'status': 'partial',
+            'segments_done': 0,
+        }
+        self._done = set()
+
+    @property
+    def resume_segment(self):
+        return 0 if self.record['status'] == 'complete' else self.record['segments_done']
+
+    def segment_done(self, segment):
+        with self._lock:
+            self._done.add(segment)
+            segments_done = self.record['segments_done']
+            while segments_done in self._done:
+                segments_done += 1
+            if segments_done != self.record['segments_done']:
+                self.record['segments_done'] = segments_done
+                self.manifest.put(self.key, self.record)
+
+    def complete(self, **info):
+        with self._lock:
+            self.record.update(info, status='complete')
+            self.manifest.put(self.key, self.record)
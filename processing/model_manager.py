@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+import torch
+
+VAE_MODEL_NAME = os.getenv('VAE_MODEL_NAME', 'stabilityai/sd-vae-ft-mse')
+VAE_PRELOAD = os.getenv('VAE_PRELOAD', '0') == '1'  # load in every worker process at start instead of on first use
+VAE_SHARE_WEIGHTS = os.getenv('VAE_SHARE_WEIGHTS', '0') == '1'  # load once in the parent and share with forked children
+
+_lock = threading.Lock()
+_model = None
+_encoder = None
+_device = None
+_load_seconds = None
+
+
+def get_device():
+    """Pick the fastest available device for VAE encoding."""
+    if torch.cuda.is_available():
+        return torch.device('cuda')
+    mps = getattr(torch.backends, 'mps', None)
+    if mps is not None and mps.is_available():
+        return torch.device('mps')
+    return torch.device('cpu')
+
+
+def load_vae(device=None):
+    """Load the VAE from the hub cache in eval mode, without gradients, on the given device."""
+    from diffusers import AutoencoderKL
+
+    model = AutoencoderKL.from_pretrained(VAE_MODEL_NAME)
+    model.eval()
+    model.requires_grad_(False)
+    return model.to(device or torch.device('cpu'))
+
+
+def preload_shared():
+    """
+    Load the weights on the CPU in the parent worker process and move them into shared memory.
+
+    Forked pool children then map the same pages instead of each holding a private copy; a child
+    that encodes on the GPU copies them to the device on first use. CUDA is never touched here,
+    since a CUDA context does not survive a fork.
+    """
+    global _model, _device, _load_seconds
+    with _lock:
+        if _model is not None:
+            return _model
+        start = time.time()
+        _model = load_vae(torch.device('cpu'))
+        _model.share_memory()
+        _device = torch.device('cpu')
+        _load_seconds = time.time() - start
+        print(f"Loaded {VAE_MODEL_NAME} into shared memory in {_load_seconds:.1f}s")
+        return _model
+
+
+def get_vae(device=None):
+    """Return this process's VAE pinned to its device, loading it on first use."""
+    global _model, _device, _load_seconds
+    device = torch.device(device) if device is not None else get_device()
+    with _lock:
+        if _model is None:
+            start = time.time()
+            _model = load_vae(device)
+            _load_seconds = time.time() - start
+            print(f"Loaded {VAE_MODEL_NAME} on {device} in {_load_seconds:.1f}s (pid {os.getpid()})")
+        elif _device != device:
+            # weights inherited from the parent (or loaded for another device) move once per process
+            _model = _model.to(device)
+        _device = device
+        return _model
+
+
+def get_encoder(device=None):
+    """
+    Return this process's encoder-only engine (see vae_engine), building it on first use.
+
+    The full VAE is loaded on the CPU and only the encoder half moves to the device, so the decoder
+    never takes device memory and is freed with the rest of the model. Weights preloaded with
+    preload_shared are reused instead of loading again.
+    """
+    global _encoder, _device, _load_seconds
+    from vae_engine import VAEEncoderEngine
+
+    device = torch.device(device) if device is not None else get_device()
+    with _lock:
+        if _encoder is None or _encoder.device != device:
+            start = time.time()
+            vae = _model if _model is not None else load_vae(torch.device('cpu'))
+            _encoder = VAEEncoderEngine(vae, device=device, model_name=VAE_MODEL_NAME)
+            _load_seconds = time.time() - start
+            print(f"Loaded the {_encoder.backend} encoder of {VAE_MODEL_NAME} on {device} in {_load_seconds:.1f}s "
+                  f"(pid {os.getpid()})")
+        _device = device
+        return _encoder
+
+
+def warm_up(batch_size=1, size=256):
+    """Run one dummy encode so kernel selection, compilation and allocator growth happen before the first real task."""
+    encoder = get_encoder()
+    dummy = torch.zeros((batch_size, 3, size, size), device=_device)
+    start = time.time()
+    with torch.inference_mode():
+        encoder.encode(dummy)
+    if _device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.time() - start
+
+
+def health_check():
+    """Report whether this process holds a model, where it lives and how much device memory it uses."""
+    status = {
+        'pid': os.getpid(),
+        'model': VAE_MODEL_NAME,
+        'loaded': _model is not None or _encoder is not None,
+        'device': str(_device) if _device is not None else None,
+        'load_seconds': _load_seconds,
+    }
+    if _encoder is not None:
+        status.update(_encoder.describe())
+    if _device is not None and _device.type == 'cuda':
+        status['cuda_memory_allocated'] = torch.cuda.memory_allocated(_device)
+        status['cuda_memory_reserved'] = torch.cuda.memory_reserved(_device)
+    return status
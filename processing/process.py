@@ -1,9 +1,25 @@
 import os
-from celery import Celery  # Import Celery
+import uuid
+from celery import Celery, chord  # Import Celery
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import worker_init, worker_process_init, task_prerun, task_postrun
 from avi_to_mp4 import convert_avi_to_mp4
 from resize import random_crop_video
-from vae_feature_extraction import extract_vae_features
-from upload_to_s3 import upload_file_to_s3
+from vae_feature_extraction import (
+    extract_vae_features, extract_vae_features_from_frames, extract_vae_features_from_views, encode_frame_streams,
+    TARGET_FPS, FRAMES_PER_SEGMENT, VAE_MODEL_NAME,
+)
+from fused_pipeline import stream_video_frames, stream_video_views
+from resize import crop_views, get_video_dimensions, view_count
+from latent_shards import LatentShardWriter
+from upload_to_s3 import get_upload_queue, download_file_from_s3
+from manifest import Manifest, ManifestProgress, manifest_key, pipeline_params, file_digest, crop_seed, archive_member_source
+from archives import archive_name
+from tar_ingest import ingest_archive
+from queues import CPU_QUEUE, GPU_QUEUE, TASK_ROUTES
+import model_manager
+import instrumentation
+import json
 import logging
 from dotenv import load_dotenv
 import os
@@ -11,44 +27,545 @@ import os
 # app = Celery('process', broker='redis://localhost:6379/0')
 # Replace 'localhost' with your global Redis server IP.
 GLOBAL_REDIS_IP = os.getenv('IP_ADDRESS')
-app = Celery('process', broker=f'redis://{GLOBAL_REDIS_IP}:6379/0')
+app = Celery('process', broker=f'redis://{GLOBAL_REDIS_IP}:6379/0', backend=f'redis://{GLOBAL_REDIS_IP}:6379/1')
+
+# Per-archive time limits in seconds; the submitter scales them by the number of archives per task.
+ARCHIVE_TIME_LIMIT = int(os.getenv('ARCHIVE_TIME_LIMIT', '7200'))
+ARCHIVE_SOFT_TIME_LIMIT = int(os.getenv('ARCHIVE_SOFT_TIME_LIMIT', '6600'))
+
+app.conf.update(
+    # Ack only after a task finishes and hold one task per worker process, so work left behind by a
+    # dead or preempted worker is redelivered and idle workers pull the remaining tasks.
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    worker_prefetch_multiplier=1,
+    task_time_limit=ARCHIVE_TIME_LIMIT,
+    task_soft_time_limit=ARCHIVE_SOFT_TIME_LIMIT,
+    result_expires=7 * 24 * 3600,
+)
+
+# CPU and GPU stages go to separate queues (see queues.py); STAGED_PIPELINE=0 runs whole videos in the archive task instead
+STAGED_PIPELINE = os.getenv('STAGED_PIPELINE', '1') == '1'
+# Augmented views per video in single-pass mode, all cropped from one decode (random, center, corner or jitter)
+CROP_VIEWS = int(os.getenv('CROP_VIEWS', '1'))
+CROP_VIEW_MODE = os.getenv('CROP_VIEW_MODE', 'random')
+app.conf.task_routes = TASK_ROUTES
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@worker_init.connect
+def share_vae_weights(**kwargs):
+    """Runs once in the parent worker process before the pool forks."""
+    if model_manager.VAE_SHARE_WEIGHTS:
+        model_manager.preload_shared()
+
+@worker_process_init.connect
+def warm_vae(**kwargs):
+    """Runs in every pool process; without VAE_PRELOAD the encoder is loaded by the first encode instead."""
+    if model_manager.VAE_PRELOAD:
+        model_manager.get_encoder()
+        logger.info(f"VAE warm-up took {model_manager.warm_up():.2f}s")
+
+# Tasks that never touch the GPU; every other task is sampled for GPU utilization and memory
+CPU_ONLY_TASKS = {'process.preprocess_video', 'process.summarize_results', 'process.finish_staged_archives'}
+_gpu_samplers = {}
+
+@task_prerun.connect
+def start_metrics(task_id=None, task=None, **kwargs):
+    instrumentation.reset()
+    if task.name not in CPU_ONLY_TASKS:
+        _gpu_samplers[task_id] = instrumentation.GpuSampler().start()
+
+@task_postrun.connect
+def publish_metrics(task_id=None, task=None, state=None, **kwargs):
+    """Emit the task's stage timings as one structured event: a log line plus an entry in the metrics list."""
+    sampler = _gpu_samplers.pop(task_id, None)
+    if sampler is not None:
+        sampler.stop()
+    event = dict(instrumentation.snapshot(), task=task.name, task_id=task_id, state=state)
+    if not event['stages']:
+        return
+    logger.info(f"metrics {json.dumps(event)}")
+    try:
+        app.backend.client.rpush(instrumentation.METRICS_KEY, json.dumps(event))
+    except Exception as e:
+        logger.warning(f"Could not publish metrics for {task.name}: {e}")
+
+@app.task
+def vae_health():
+    """Report the VAE state of whichever worker process picks this up."""
+    return model_manager.health_check()
+
+def wait_for_uploads(uploads, file_path):
+    """Barrier at the end of a task: wait for background uploads and report any that failed."""
+    failures = uploads.flush()
+    for file_name, bucket, object_name in failures:
+        logger.error(f"Upload of {file_name} to {bucket}/{object_name} failed while processing {file_path}")
+    return not failures
+
+def output_views(single_pass):
+    """
+    Crop views per video a path writes: only the single-pass pipeline cuts CROP_VIEWS of them, the others one.
+    Modes with fewer windows than CROP_VIEWS (center, corner) are counted as the views they actually produce.
+    """
+    return view_count(CROP_VIEWS, CROP_VIEW_MODE) if single_pass else 1
+
+def job_params(target_width, target_height, target_fps, views=1):
+    return pipeline_params(target_width, target_height, target_fps, FRAMES_PER_SEGMENT, vae_model=VAE_MODEL_NAME,
+                           crop_views=views, crop_mode=CROP_VIEW_MODE)
+
+def start_progress(file_path, target_width, target_height, target_fps, content_hash=None, views=1, source=None):
+    """
+    Look the video up in the completion manifest; returns None if it is already done, else its ManifestProgress.
+    `views` must be the number of crop views the calling path actually writes, since it is part of the key.
+    The key is built from `source`, the identity the submitter knows the video by (a URL, a path it
+    submitted, or archive_member_source()); it defaults to file_path for videos submitted by path.
+    """
+    source = source or file_path
+    params = job_params(target_width, target_height, target_fps, views)
+    key = manifest_key(source, params)
+    manifest = Manifest()
+    if content_hash is None and os.path.exists(file_path):
+        content_hash = file_digest(file_path)
+    if manifest.is_complete(key, content_hash):
+        logger.info(f"Skipping {source}, already processed with these parameters")
+        return None
+
+    progress = ManifestProgress(manifest, key, source, params, content_hash)
+    if progress.resume_segment:
+        logger.info(f"Resuming {file_path} from segment {progress.resume_segment}")
+    return progress
+
+def process_video_single_pass(file_path, output_dir, target_width=256, target_height=256, bucket_name="kinetics-400", upload_video=True, target_fps=TARGET_FPS,
+                              progress=None, views=CROP_VIEWS):
+    """Decode the source once with ffmpeg and stream cropped frames straight into the VAE encoder.
+
+    The cropped mp4 is only encoded (in the same ffmpeg pass) when it is going to be uploaded.
+    """
+    video_name = os.path.splitext(os.path.basename(file_path))[0]
+    if views > 1:
+        return process_video_views(file_path, output_dir, target_width, target_height, bucket_name, target_fps, progress, views)
+
+    resized_file = None
+    if bucket_name and upload_video:
+        resized_file = os.path.join(output_dir, f"{video_name}.mp4")
+        if os.path.abspath(resized_file) == os.path.abspath(file_path):
+            resized_file = os.path.join(output_dir, f"{video_name}_cropped.mp4")
+
+    uploads = get_upload_queue()
+    seed = crop_seed(progress.key) if progress else None
+    frames = stream_video_frames(file_path, target_width, target_height, mp4_output=resized_file, target_fps=target_fps, seed=seed)
+    vae_features_path = extract_vae_features_from_frames(
+        frames, video_name, output_dir, bucket_name=bucket_name, uploader=uploads,
+        start_segment=progress.resume_segment if progress else 0,
+        on_segment=progress.segment_done if progress else None,
+    )
+    logger.info(f"Extracted VAE features for {file_path} in a single decode pass")
+
+    if resized_file:
+        uploads.submit(resized_file, bucket_name, f"{video_name}.mp4", delete_after=True)
+
+    if bucket_name and vae_features_path:
+        uploads.submit(vae_features_path, bucket_name, f"{os.path.basename(vae_features_path)}")
+
+    succeeded = wait_for_uploads(uploads, file_path)
+    if succeeded and progress:
+        progress.complete()
+    os.remove(file_path)
+    return succeeded
+
+
+def process_video_views(file_path, output_dir, target_width, target_height, bucket_name, target_fps, progress=None,
+                        views=CROP_VIEWS, mode=CROP_VIEW_MODE):
+    """
+    Single-pass multi-crop: decode once, cut `views` crops from every sampled frame and encode each view
+    as its own latent sequence. The crop plan is seeded from the manifest key and saved as <video>_views.json.
+    """
+    video_name = os.path.splitext(os.path.basename(file_path))[0]
+    original_width, original_height = get_video_dimensions(file_path)
+    if original_width is None or original_height is None:
+        return False
+    if target_width > original_width or target_height > original_height:
+        logger.info(f"{file_path} is smaller than the crop, encoding a single resized view")
+        return process_video_single_pass(file_path, output_dir, target_width, target_height, bucket_name, False, target_fps, progress,
+                                         views=1)
+
+    seed = crop_seed(progress.key) if progress else None
+    plan = crop_views(original_width, original_height, target_width, target_height, views, mode, seed)
+    metadata_path = os.path.join(output_dir, f"{video_name}_views.json")
+    with open(metadata_path, 'w') as f:
+        json.dump({'source': os.path.basename(file_path), 'mode': mode, 'seed': seed, 'views': plan}, f, indent=2)
+
+    uploads = get_upload_queue()
+    extract_vae_features_from_views(
+        stream_video_views(file_path, plan, target_fps), video_name, len(plan), output_dir, bucket_name=bucket_name,
+        uploader=uploads, start_segment=progress.resume_segment if progress else 0,
+        on_segment=progress.segment_done if progress else None,
+    )
+    logger.info(f"Extracted VAE features for {len(plan)} {mode} views of {file_path} in a single decode pass")
+    if bucket_name:
+        uploads.submit(metadata_path, bucket_name, f"vae_features/{video_name}_views.json")
+
+    succeeded = wait_for_uploads(uploads, file_path)
+    if succeeded and progress:
+        progress.complete(views=plan)
+    os.remove(file_path)
+    return succeeded
+
+
+def cropped_clip_path(file_path, output_dir):
+    """Where the cropped clip of a video goes; never the source file itself."""
+    video_name = os.path.splitext(os.path.basename(file_path))[0]
+    clip_path = os.path.join(output_dir, f"{video_name}.mp4")
+    if os.path.abspath(clip_path) == os.path.abspath(file_path):
+        clip_path = os.path.join(output_dir, f"{video_name}_cropped.mp4")
+    return clip_path
+
+def preprocess_clip(file_path, output_dir, target_width, target_height, progress, keep_source=False):
+    """CPU stage: convert to mp4 if necessary, then crop. Returns the cropped clip path, or None on failure."""
+    file_ext = os.path.splitext(file_path)[1]
+    if file_ext == ".avi":
+        converted_file = os.path.join(output_dir, os.path.basename(file_path).replace(".avi", ""))
+        if not convert_avi_to_mp4(file_path, converted_file):  # appends .mp4 itself
+            logger.error(f"Error converting {file_path}")
+            return None
+        logger.info(f"Converted {file_path} to .mp4")
+        if not keep_source:
+            os.remove(file_path)
+        file_path = f"{converted_file}.mp4"
+        keep_source = False  # the converted copy is ours to remove
+
+    clip_path = cropped_clip_path(file_path, output_dir)
+    cropped = random_crop_video(file_path, clip_path, crop_width=target_width, crop_height=target_height, seed=crop_seed(progress.key),
+                                keep_input=keep_source)
+    if not cropped or not os.path.exists(clip_path):
+        logger.error(f"Error cropping {file_path}")
+        return None
+    logger.info(f"Resized and cropped {file_path} to {target_width}x{target_height}")
+    return clip_path
+
+def encode_clip(clip_path, video_name, source_path, output_dir, bucket_name, target_fps, progress, uploads):
+    """GPU stage: extract VAE features from a cropped clip, wait for uploads and record completion."""
+    vae_features_path = extract_vae_features(clip_path, output_dir, bucket_name=bucket_name, target_fps=target_fps, uploader=uploads,
+                                             start_segment=progress.resume_segment, on_segment=progress.segment_done,
+                                             video_name=video_name)
+    logger.info(f"Extracted VAE features for {source_path}")
+
+    if bucket_name and vae_features_path:
+        uploads.submit(vae_features_path, bucket_name, f"{os.path.basename(vae_features_path)}")
+
+    succeeded = wait_for_uploads(uploads, source_path)
+    logger.info(f"Finished uploads for {source_path}")
+    if succeeded:
+        progress.complete()
+
+    if os.path.exists(clip_path):
+        os.remove(clip_path)
+        logger.info(f"Deleted resized file {clip_path} after processing")
+
+    return succeeded
+
+
 @app.task 
-def process_video(file_path, output_dir, target_width=256, target_height=256, bucket_name="kinetics-400"):
-    """Process the video - convert if necessary, resize, crop, then extract VAE features, and upload to S3."""
+def process_video(file_path, output_dir, target_width=256, target_height=256, bucket_name="kinetics-400", single_pass=False, upload_video=True, target_fps=TARGET_FPS,
+                  source=None):
+    """
+    Process the video - convert if necessary, resize, crop, then extract VAE features, and upload to S3.
+    `source` is the video's manifest identity when file_path is only a local copy (see start_progress).
+    """
     
     logger.info(f"Starting processing for video: {file_path}")
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    file_ext = os.path.splitext(file_path)[1]
-    if file_ext == ".avi":
-        converted_file = os.path.join(output_dir, os.path.basename(file_path).replace(".avi", ".mp4"))
-        if not convert_avi_to_mp4(file_path, converted_file):
-            logger.error(f"Error converting {file_path}")
+    views = output_views(single_pass)
+    progress = start_progress(file_path, target_width, target_height, target_fps, views=views, source=source)
+    if progress is None:
+        if os.path.exists(file_path):
+            os.remove(file_path)  # every other path consumes the source too
+        return True
+
+    if single_pass:
+        return process_video_single_pass(file_path, output_dir, target_width, target_height, bucket_name, upload_video, target_fps, progress,
+                                         views)
+
+    video_name = os.path.splitext(os.path.basename(file_path))[0]
+    clip_path = preprocess_clip(file_path, output_dir, target_width, target_height, progress)
+    if clip_path is None:
+        return False
+
+    uploads = get_upload_queue()
+    uploads.submit(clip_path, bucket_name, f"{video_name}.mp4")
+    return encode_clip(clip_path, video_name, file_path, output_dir, bucket_name, target_fps, progress, uploads)
+
+
+@app.task
+def preprocess_video(file_path, output_dir, target_width=256, target_height=256, bucket_name="kinetics-400", target_fps=TARGET_FPS,
+                     keep_source=False, source=None):
+    """
+    CPU-queue stage of the staged pipeline: convert and crop, then hand the clip on to encode_video.
+    Returns None when the video is already complete and False when it could not be preprocessed.
+
+    The clip is uploaded before returning so a GPU worker on another host can fetch it; a GPU worker
+    on the same host reads it straight from disk.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    content_hash = file_digest(file_path) if os.path.exists(file_path) else None
+    progress = start_progress(file_path, target_width, target_height, target_fps, content_hash, source=source)
+    if progress is None:
+        if not keep_source and os.path.exists(file_path):
+            os.remove(file_path)
+        return None
+
+    clip_path = preprocess_clip(file_path, output_dir, target_width, target_height, progress, keep_source)
+    if clip_path is None:
+        return False
+
+    video_name = os.path.splitext(os.path.basename(file_path))[0]
+    if bucket_name:
+        uploads = get_upload_queue()
+        uploads.submit(clip_path, bucket_name, f"{video_name}.mp4")
+        if not wait_for_uploads(uploads, file_path):
             return False
-        logger.info(f"Converted {file_path} to .mp4")
-        os.remove(file_path)
-        file_path = converted_file
+    return {
+        'file_path': file_path,
+        'source': source or file_path,
+        'video_name': video_name,
+        'clip_path': clip_path,
+        'clip_key': f"{video_name}.mp4",
+        'content_hash': content_hash,
+    }
 
-    resized_file = os.path.join(output_dir, os.path.basename(file_path))
-    random_crop_video(file_path, resized_file, crop_width=target_width, crop_height=target_height)
-    upload_file_to_s3(resized_file, bucket_name, f"{os.path.basename(resized_file)}")
-    logger.info(f"Resized and cropped {file_path} to 256x256")
 
-    vae_features_path = extract_vae_features(resized_file, output_dir, bucket_name=bucket_name)
-    logger.info(f"Extracted VAE features for {file_path}")
+@app.task
+def encode_video(clip, output_dir, target_width=256, target_height=256, bucket_name="kinetics-400", target_fps=TARGET_FPS):
+    """
+    GPU-queue stage of the staged pipeline: encode a clip produced by preprocess_video.
+    Failures are returned as False rather than raised, so the chord waiting on the archive's encodes still completes.
+    """
+    if not clip:
+        return clip is None  # None: already complete, False: preprocessing failed
 
-    if bucket_name and vae_features_path:
-        upload_file_to_s3(vae_features_path, bucket_name, f"{os.path.basename(vae_features_path)}")
-        logger.info(f"Uploaded VAE features {vae_features_path} to S3")
+    os.makedirs(output_dir, exist_ok=True)
+    clip_path = clip['clip_path']
+    try:
+        if not os.path.exists(clip_path):
+            clip_path = os.path.join(output_dir, os.path.basename(clip_path))
+            if not download_file_from_s3(bucket_name, clip['clip_key'], clip_path):
+                return False
+
+        progress = start_progress(clip['file_path'], target_width, target_height, target_fps, clip['content_hash'],
+                                  source=clip.get('source'))
+        if progress is None:
+            os.remove(clip_path)
+            return True
+        return encode_clip(clip_path, clip['video_name'], clip['file_path'], output_dir, bucket_name, target_fps, progress,
+                           get_upload_queue())
+    except Exception as e:
+        logger.error(f"Error encoding {clip['source']}: {e}")
+        return False
+
+
+@app.task
+def process_video_group(file_paths, output_dir, target_width=256, target_height=256, bucket_name="kinetics-400", upload_video=True, target_fps=TARGET_FPS):
+    """
+    Process several videos in single-pass mode and pack all of their latents into shared fp16 shards.
+
+    Videos the manifest records as complete are skipped. A video that fails to decode is logged and left out
+    of the manifest, like a failed video of an archive, while the rest of the group carries on; the segments
+    it stored before failing stay in the shard.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    uploads = get_upload_queue()
+    shard_writer = LatentShardWriter(output_dir, prefix=f"latents_{uuid.uuid4().hex[:12]}", bucket_name=bucket_name, uploader=uploads)
+    resized_files = {}
+    progresses = {}
+    failed = set()
+
+    def video_frames(file_path, frames):
+        # decode errors surface while the frames are pulled, inside encode_frame_streams
+        count = 0
+        try:
+            for frame in frames:
+                count += 1
+                yield frame
+        except SoftTimeLimitExceeded:
+            raise
+        except Exception as e:
+            logger.error(f"Error processing {file_path} in a video group: {e}")
+            failed.add(file_path)
+            return
+        if not count:
+            logger.error(f"No frames decoded from {file_path}")
+            failed.add(file_path)
+
+    def streams():
+        for file_path in file_paths:
+            try:
+                progress = start_progress(file_path, target_width, target_height, target_fps)
+            except Exception as e:
+                logger.error(f"Error looking up {file_path} in the manifest: {e}")
+                failed.add(file_path)
+                continue
+            if progress is None:
+                continue
+            progresses[file_path] = progress
+            video_name = os.path.splitext(os.path.basename(file_path))[0]
+            resized_file = None
+            if bucket_name and upload_video:
+                resized_file = os.path.join(output_dir, f"{video_name}_cropped.mp4")
+                resized_files[file_path] = (video_name, resized_file)
+            logger.info(f"Starting processing for video: {file_path}")
+            frames = stream_video_frames(file_path, target_width, target_height, mp4_output=resized_file, target_fps=target_fps,
+                                         seed=crop_seed(progress.key))
+            yield video_name, video_frames(file_path, frames)
+
+    encode_frame_streams(streams(), output_dir, bucket_name=bucket_name, shard_writer=shard_writer)
+    shard_paths = shard_writer.close()
+    logger.info(f"Packed VAE features for {len(progresses) - len(failed & set(progresses))} videos into {len(shard_paths)} shards"
+                f" ({len(failed)} failed)")
+
+    for file_path, (video_name, resized_file) in resized_files.items():
+        if not os.path.exists(resized_file):
+            continue
+        if file_path in failed:
+            os.remove(resized_file)
+        else:
+            uploads.submit(resized_file, bucket_name, f"{video_name}.mp4", delete_after=True)
+
+    if wait_for_uploads(uploads, ', '.join(file_paths)):
+        # shards are only durable once uploaded, so videos are marked done all at once
+        for file_path, progress in progresses.items():
+            if file_path not in failed:
+                progress.complete(shards=[os.path.basename(path) for path in shard_paths])
+    for file_path in file_paths:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    return shard_paths
+
+
+def process_archive(url, output_dir, target_width=256, target_height=256, bucket_name="kinetics-400", single_pass=False, target_fps=TARGET_FPS,
+                    staged=False, encodes=None):
+    """
+    Stream one tar.gz shard, process every video in it and record the shard in the manifest.
+
+    The shard is never stored or fully extracted: videos are spooled to tmpfs one at a time while
+    the rest of the archive keeps downloading and decompressing on a background thread.
+
+    With staged=True the videos are only preprocessed here: an encode_video signature per clip is
+    appended to `encodes` and the shard is left 'encoding', for finish_staged_archives to record
+    once those encodes have run.
+    """
+    params = job_params(target_width, target_height, target_fps, output_views(single_pass and not staged))
+    key = manifest_key(url, params)
+    manifest = Manifest()
+    if manifest.is_complete(key):
+        logger.info(f"Skipping archive {url}, already processed")
+        return {'url': url, 'status': 'skipped'}
+
+    archive_dir = os.path.join(output_dir, archive_name(url))
+    failed = 0
+    archive_encodes = []
+
+    def handle_video(video_path, member_name):
+        # the video sits in the tmpfs spool while the next members are being decompressed
+        nonlocal failed
+        source = archive_member_source(url, member_name)
+        try:
+            if staged:
+                clip = preprocess_video(video_path, archive_dir, target_width, target_height, bucket_name, target_fps, source=source)
+                if clip:
+                    archive_encodes.append(encode_video.si(clip, archive_dir, target_width, target_height, bucket_name,
+                                                           target_fps).set(queue=GPU_QUEUE))
+                elif clip is False:
+                    failed += 1
+            elif not process_video(video_path, archive_dir, target_width, target_height, bucket_name, single_pass, target_fps=target_fps,
+                                   source=source):
+                failed += 1
+        except SoftTimeLimitExceeded:
+            raise
+        except Exception as e:
+            logger.error(f"Error processing {video_path} from {url}: {e}")
+            failed += 1
+        return video_path
+
+    video_paths = ingest_archive(url, handle_video)
+
+    if staged:
+        encodes.extend(archive_encodes)
+        return {'url': url, 'status': 'encoding', 'videos': len(video_paths), 'failed': failed, 'encodes': len(archive_encodes)}
+    if not failed:
+        manifest.put(key, {'source': url, 'params': params, 'status': 'complete', 'videos': len(video_paths)})
+    return {'url': url, 'status': 'complete' if not failed else 'partial', 'videos': len(video_paths), 'failed': failed}
+
+
+@app.task(bind=True)
+def process_archives(self, urls, output_dir, target_width=256, target_height=256, bucket_name="kinetics-400", single_pass=False,
+                     target_fps=TARGET_FPS, staged=STAGED_PIPELINE):
+    """
+    Process a small group of tar.gz shards. Failures are reported per shard rather than raised, so a chord callback still runs.
+
+    In staged mode the task replaces itself with a chord of the shards' encode_video tasks on the GPU queue and
+    finish_staged_archives, so whatever waits on this task (the submitter's chord) waits for the encodes too.
+    """
+    results = []
+    encodes = [] if staged else None
+    for url in urls:
+        try:
+            results.append(process_archive(url, output_dir, target_width, target_height, bucket_name, single_pass, target_fps, staged,
+                                           encodes))
+        except SoftTimeLimitExceeded:
+            logger.error(f"Time limit reached while processing {url}")
+            results.extend({'url': pending, 'status': 'timeout'} for pending in urls[len(results):])
+            break
+        except Exception as e:
+            logger.error(f"Error processing archive {url}: {e}")
+            results.append({'url': url, 'status': 'failed', 'error': str(e)})
+    if encodes:
+        finish = finish_staged_archives.s(results, target_width, target_height, target_fps).set(queue=CPU_QUEUE)
+        return self.replace(chord(encodes, finish))
+    if staged:
+        return finish_staged_archives([], results, target_width, target_height, target_fps)
+    return results
+
+
+@app.task
+def finish_staged_archives(encoded, results, target_width=256, target_height=256, target_fps=TARGET_FPS):
+    """
+    Chord callback of the staged pipeline, run once every encode_video of a process_archives task has returned.
+    Counts the failed encodes of each shard, records fully processed shards in the manifest and returns the
+    per-shard results in the shape process_archives returns them.
+    """
+    params = job_params(target_width, target_height, target_fps)
+    manifest = Manifest()
+    encoded = iter(encoded)
+    for result in results:
+        if result['status'] != 'encoding':
+            continue
+        outcomes = [next(encoded) for _ in range(result.pop('encodes'))]
+        result['failed'] += sum(not ok for ok in outcomes)
+        if result['failed']:
+            result['status'] = 'partial'
+        else:
+            manifest.put(manifest_key(result['url'], params), {'source': result['url'], 'params': params, 'status': 'complete',
+                                                              'videos': result['videos']})
+            result['status'] = 'complete'
+    return results
 
-    if os.path.exists(resized_file):
-        os.remove(resized_file)
-        logger.info(f"Deleted resized file {resized_file} after processing")
 
-    return True
+@app.task
+def summarize_results(group_results):
+    """Chord callback: flatten the per-shard results of every process_archives task into one summary."""
+    results = [result for group in group_results for result in (group or [])]
+    summary = {'archives': len(results), 'videos': 0, 'failed_videos': 0, 'by_status': {}, 'failed_archives': []}
+    for result in results:
+        status = result['status']
+        summary['by_status'][status] = summary['by_status'].get(status, 0) + 1
+        summary['videos'] += result.get('videos', 0)
+        summary['failed_videos'] += result.get('failed', 0)
+        if status in ('failed', 'timeout', 'partial'):
+            summary['failed_archives'].append(result['url'])
+    return summary
@@ -0,0 +1,24 @@
+"""
+Celery queue names and task routes, shared by the workers (process.py), the submitter
+(download_kinetics.py), the worker bootstrap (vast_celery_setup.py) and the autoscaler.
+
+Kept free of heavy imports so the submitting side can route tasks without loading the pipeline.
+"""
+import os
+
+# CPU-bound stages (download, ffmpeg) and GPU-bound stages (VAE encode) go to separate queues, so each
+# host can run a CPU worker pool and a GPU worker pool with their own concurrency.
+CPU_QUEUE = os.getenv('CPU_QUEUE', 'cpu')
+GPU_QUEUE = os.getenv('GPU_QUEUE', 'gpu')
+QUEUES = (CPU_QUEUE, GPU_QUEUE)
+
+TASK_ROUTES = {
+    'process.process_archives': {'queue': CPU_QUEUE},
+    'process.preprocess_video': {'queue': CPU_QUEUE},
+    'process.summarize_results': {'queue': CPU_QUEUE},
+    'process.finish_staged_archives': {'queue': CPU_QUEUE},
+    'process.encode_video': {'queue': GPU_QUEUE},
+    'process.process_video': {'queue': GPU_QUEUE},
+    'process.process_video_group': {'queue': GPU_QUEUE},
+    'process.vae_health': {'queue': GPU_QUEUE},
+}
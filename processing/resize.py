@@ -1,79 +1,86 @@
 import os
-import subprocess
+import shutil
 import ffmpeg
 import random
+from instrumentation import timed
+from video_probe import probe_video
+
+VIEW_MODES = ('random', 'center', 'corner', 'jitter')
+MAX_VIEWS = {'center': 1, 'corner': 5}  # modes with a fixed set of windows
+JITTER_RANGE = (0.6, 1.0)  # region side as a fraction of the largest window with the crop's aspect ratio
 
 def get_video_dimensions(file_path):
-    """Get the dimensions of the video using ffprobe."""
-    try:
-        result = subprocess.run(
-            [
-                'ffprobe',
-                '-v', 'error',
-                '-select_streams', 'v:0',
-                '-show_entries', 'stream=width,height',
-                '-of', 'default=noprint_wrappers=1:nokey=1',
-                file_path
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True
-        )
-        width, height = map(int, result.stdout.decode().strip().split('\n'))
-        return width, height
-    except subprocess.CalledProcessError as e:
-        print(f"Error getting video dimensions: {e.stderr.decode()}")
+    """Get the dimensions of the video from its (cached) probe."""
+    metadata = probe_video(file_path)
+    if metadata is None:
         return None, None
+    return metadata['width'], metadata['height']
+
+
+def fit_dimensions(original_width, original_height, target_width, target_height):
+    """Largest even dimensions that keep the aspect ratio and fit inside the target."""
+    aspect_ratio = original_width / original_height
+    if target_width / aspect_ratio <= target_height:
+        new_width = target_width
+        new_height = int(target_width / aspect_ratio)
+    else:
+        new_width = int(target_height * aspect_ratio)
+        new_height = target_height
+
+    new_width -= new_width % 2
+    new_height -= new_height % 2
+    return new_width, new_height
 
 
-def resize_video(input_file, output_file, target_width, target_height):
-    """Resize the video to the target dimensions."""
+def resize_video(input_file, output_file, target_width, target_height, keep_input=False):
+    """Resize the video to the target dimensions. Returns True once output_file is written, else False."""
     try:
         original_width, original_height = get_video_dimensions(input_file)
         if original_width is None or original_height is None:
-            return
-        
-        aspect_ratio = original_width / original_height
-        if target_width / aspect_ratio <= target_height:
-            new_width = target_width
-            new_height = int(target_width / aspect_ratio)
-        else:
-            new_width = int(target_height * aspect_ratio)
-            new_height = target_height
-
-        new_width -= new_width % 2
-        new_height -= new_height % 2
+            return False
         
+        new_width, new_height = fit_dimensions(original_width, original_height, target_width, target_height)
         ffmpeg.input(input_file).filter('scale', new_width, new_height).output(output_file).run()
-        os.remove(input_file)
+        if not keep_input:
+            os.remove(input_file)
         print(f"Resized video saved to: {output_file}")
+        return True
     except Exception as e:
         print(f"Error resizing video: {e}")
+        return False
+
 
+@timed('crop')
+def random_crop_video(input_file, output_file, crop_width=256, crop_height=256, seed=None, keep_input=False):
+    """Apply random cropping to a video, but skip cropping if video dimensions are already 256x256.
 
-def random_crop_video(input_file, output_file, crop_width=256, crop_height=256):
-    """Apply random cropping to a video, but skip cropping if video dimensions are already 256x256."""
+    Pass a seed to make the crop offsets reproducible. The input is removed afterwards unless keep_input is set.
+    Returns True once output_file is written and False on failure, which the 'crop' stage counts as an error.
+    """
     try:
         # Get the dimensions of the video
         original_width, original_height = get_video_dimensions(input_file)
         if original_width is None or original_height is None:
-            return
+            return False
 
         # If the video is already 256x256, no cropping is needed
         if original_width == crop_width and original_height == crop_height:
             print(f"Video {input_file} is already {crop_width}x{crop_height}, skipping cropping.")
-            os.rename(input_file, output_file)  # Simply rename/move the file
-            return
+            if keep_input:
+                shutil.copy(input_file, output_file)
+            else:
+                os.rename(input_file, output_file)  # Simply rename/move the file
+            return True
 
         # Ensure the crop size is less than the original dimensions
         if crop_width > original_width or crop_height > original_height:
             print("Crop dimensions exceed original video dimensions. Resizing instead.")
-            resize_video(input_file, output_file, crop_width, crop_height)
-            return
+            return resize_video(input_file, output_file, crop_width, crop_height, keep_input)
 
         # Calculate random crop starting point
-        x_offset = random.randint(0, original_width - crop_width)
-        y_offset = random.randint(0, original_height - crop_height)
+        rng = random.Random(seed) if seed is not None else random
+        x_offset = rng.randint(0, original_width - crop_width)
+        y_offset = rng.randint(0, original_height - crop_height)
 
         print(f"Cropping video at x: {x_offset}, y: {y_offset}, width: {crop_width}, height: {crop_height}")
 
@@ -81,7 +88,72 @@ def random_crop_video(input_file, output_file, crop_width=256, crop_height=256):
         ffmpeg.input(input_file).crop(crop_width, crop_height, x_offset, y_offset).output(output_file).run()
 
         # Remove the original file after cropping
-        os.remove(input_file)
+        if not keep_input:
+            os.remove(input_file)
         print(f"Cropped video saved to: {output_file}")
+        return True
     except Exception as e:
         print(f"Error cropping video: {e}")
+        return False
+
+
+def view_count(count, mode='random'):
+    """How many views crop_views plans when `count` are requested in `mode`."""
+    return min(count, MAX_VIEWS.get(mode, count))
+
+
+def crop_views(original_width, original_height, crop_width=256, crop_height=256, count=1, mode='random', seed=None,
+               jitter=JITTER_RANGE):
+    """
+    Plan `count` crop windows of a frame. Each view is a dict with the source region (x, y, width, height)
+    that is then scaled to crop_width x crop_height, so it can be recorded alongside the outputs.
+
+    random: uniform offsets. center: the centre window (a single view). corner: the four corners, then
+    the centre (at most five views). jitter: random regions whose side is a random fraction of the largest
+    window with the crop's aspect ratio, scaled back to the crop size.
+    The crop must fit inside the frame; the same seed always plans the same views.
+    """
+    if mode not in VIEW_MODES:
+        raise ValueError(f"Unknown crop view mode {mode!r}, expected one of {VIEW_MODES}")
+    rng = random.Random(seed)
+    max_x, max_y = original_width - crop_width, original_height - crop_height
+
+    if mode == 'random':
+        windows = [(rng.randint(0, max_x), rng.randint(0, max_y), crop_width, crop_height) for _ in range(count)]
+    elif mode == 'center':
+        windows = [(max_x // 2, max_y // 2, crop_width, crop_height)]
+    elif mode == 'corner':
+        corners = [(0, 0), (max_x, 0), (0, max_y), (max_x, max_y), (max_x // 2, max_y // 2)]
+        windows = [(x, y, crop_width, crop_height) for x, y in corners[:count]]
+    else:
+        largest = min(original_width / crop_width, original_height / crop_height)
+        windows = []
+        for _ in range(count):
+            scale = largest * rng.uniform(*jitter)
+            width = min(original_width, max(2, int(crop_width * scale) // 2 * 2))
+            height = min(original_height, max(2, int(crop_height * scale) // 2 * 2))
+            windows.append((rng.randint(0, original_width - width), rng.randint(0, original_height - height), width, height))
+
+    return [
+        {'index': index, 'mode': mode, 'x': x, 'y': y, 'width': width, 'height': height,
+         'output_width': crop_width, 'output_height': crop_height}
+        for index, (x, y, width, height) in enumerate(windows)
+    ]
+
+
+def view_filter(view):
+    """ffmpeg filter for one planned view: crop the region, then scale it if it is not already crop-sized."""
+    video_filter = f"crop={view['width']}:{view['height']}:{view['x']}:{view['y']}"
+    if (view['width'], view['height']) != (view['output_width'], view['output_height']):
+        video_filter += f",scale={view['output_width']}:{view['output_height']}"
+    return video_filter
+
+
+def views_filter_graph(views):
+    """filter_complex that decodes once, splits the stream and labels each cropped view [v0], [v1], ..."""
+    if len(views) == 1:
+        return f"[0:v]{view_filter(views[0])}[v0]"
+    splits = ''.join(f"[s{i}]" for i in range(len(views)))
+    branches = ';'.join(f"[s{i}]{view_filter(view)}[v{i}]" for i, view in enumerate(views))
+    return f"[0:v]split={len(views)}{splits};{branches}"
+
@@ -0,0 +1,104 @@
+import os
+import queue
+import shutil
+import tarfile
+import tempfile
+import threading
+import urllib.request
+from archives import archive_name, is_video_member
+from instrumentation import stage
+
+# Videos are spooled to tmpfs when there is one, so a shard never has to be extracted to disk.
+DEFAULT_SPOOL_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+SPOOL_DIR = os.getenv('INGEST_SPOOL_DIR', DEFAULT_SPOOL_DIR)
+MAX_SPOOLED_VIDEOS = int(os.getenv('INGEST_MAX_SPOOLED_VIDEOS', '4'))
+# Seconds a connect or a single read may stall before the download fails, instead of hanging the task
+INGEST_TIMEOUT = float(os.getenv('INGEST_TIMEOUT', '60'))
+
+_DONE = object()
+
+
+def open_archive_stream(source, timeout=INGEST_TIMEOUT):
+    """Sequential file-like object over a local tar.gz or an http(s) URL; a stalled download raises after `timeout`."""
+    if os.path.exists(source):
+        return open(source, 'rb')
+    return urllib.request.urlopen(source, timeout=timeout)
+
+
+def iter_archive_videos(source, spool_dir, timeout=INGEST_TIMEOUT):
+    """
+    Stream a tar.gz in one forward pass and yield (member name, spooled path) for every video.
+
+    Nothing but the current member is ever written; the archive itself never touches the disk.
+    """
+    with open_archive_stream(source, timeout) as stream, tarfile.open(fileobj=stream, mode='r|gz') as archive:
+        for member in archive:
+            if not is_video_member(member):
+                continue
+            # flatten member paths so nothing can be written outside spool_dir
+            video_path = os.path.join(spool_dir, os.path.basename(member.name))
+            with stage('ingest') as counter, archive.extractfile(member) as src, open(video_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+                counter.bytes += member.size
+            yield member.name, video_path
+
+
+def ingest_archive(source, handle_video, spool_root=SPOOL_DIR, max_spooled=MAX_SPOOLED_VIDEOS, timeout=INGEST_TIMEOUT):
+    """
+    Download and decompress `source` on a background thread while handle_video(path, member name)
+    processes the videos already spooled. At most max_spooled videos wait in the spool at once.
+
+    The spooled path is local to this worker; the member name is what identifies the video across
+    runs. handle_video may consume (delete) the file it is given; anything left over is removed
+    after it returns. Returns the list of handle_video results in archive order.
+
+    A download or decompression error on the reader thread, including a read that stalls for longer
+    than `timeout`, is raised here once the videos spooled before it have been handled.
+    """
+    spool_dir = os.path.join(spool_root, f"ingest_{archive_name(source)}")
+    os.makedirs(spool_dir, exist_ok=True)
+    videos = queue.Queue(maxsize=max_spooled)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                videos.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def reader():
+        try:
+            for member_name, video_path in iter_archive_videos(source, spool_dir, timeout):
+                if stop.is_set():
+                    return
+                put((member_name, video_path))
+        except Exception as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+
+    results = []
+    try:
+        while True:
+            item = videos.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            member_name, video_path = item
+            try:
+                results.append(handle_video(video_path, member_name))
+            finally:
+                if os.path.exists(video_path):
+                    os.remove(video_path)
+    finally:
+        stop.set()
+        thread.join()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+    print(f"Ingested {len(results)} videos from {source}")
+    return results
@@ -1,29 +1,152 @@
+import queue
+import threading
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError
 from dotenv import load_dotenv
+from instrumentation import timed
 import os
 
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', '10'))  # parts in flight per multipart upload
+S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD', str(16 * 1024 * 1024)))
+S3_UPLOAD_WORKERS = int(os.getenv('S3_UPLOAD_WORKERS', '4'))  # files uploaded in parallel by an UploadQueue
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_THRESHOLD,
+    max_concurrency=S3_MAX_CONCURRENCY,
+    use_threads=True,
+)
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Return the S3 client shared by this process, creating it on first use.
+
+    Clients are thread-safe once built but must not cross a fork, so a forked
+    Celery worker child builds its own.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = boto3.client(
+                's3',
+                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+                config=Config(max_pool_connections=S3_MAX_CONCURRENCY * S3_UPLOAD_WORKERS),
+            )
+            _client_pid = os.getpid()
+        return _client
+
+
+@timed('upload')
 def upload_file_to_s3(file_name, bucket, object_name=None):
     """
     Upload a file to an S3 bucket using stored AWS credentials.
-    
+
     :param file_name: File to upload
     :param bucket: Bucket to upload to
     :param object_name: S3 object name. If not specified, file_name is used.
+    :return: True if the upload succeeded, else False
     """
     if object_name is None:
         object_name = file_name
 
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-    )
-
     try:
-        s3_client.upload_file(file_name, bucket, object_name)
+        get_s3_client().upload_file(file_name, bucket, object_name, Config=TRANSFER_CONFIG)
         print(f"File uploaded to {bucket}/{object_name}")
+        return True
     except NoCredentialsError:
         print("Credentials not available or incorrect.")
     except Exception as e:
         print(f"Failed to upload {file_name} to S3: {str(e)}")
+    return False
+
+
+def download_file_from_s3(bucket, object_name, file_name):
+    """Download an S3 object to a local file with the shared client; returns True on success."""
+    try:
+        get_s3_client().download_file(bucket, object_name, file_name, Config=TRANSFER_CONFIG)
+        print(f"File downloaded from {bucket}/{object_name}")
+        return True
+    except Exception as e:
+        print(f"Failed to download {bucket}/{object_name} from S3: {str(e)}")
+        return False
+
+
+class UploadQueue:
+    """Upload files on background threads so the caller can hand them off and keep working."""
+
+    def __init__(self, num_workers=S3_UPLOAD_WORKERS, max_pending=64):
+        # bounded, so a producer that outruns the network blocks instead of filling the disk
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._failures = []
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(num_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, file_name, bucket, object_name=None, delete_after=False, on_success=None):
+        """
+        Queue a file for upload. With delete_after the local file is removed once it is uploaded;
+        on_success is called from the upload thread after a successful upload.
+        """
+        self._queue.put((file_name, bucket, object_name, delete_after, on_success))
+
+    def flush(self):
+        """Wait for every queued upload to finish; returns (and clears) the (file, bucket, key) triples that failed."""
+        self._queue.join()
+        with self._lock:
+            failures, self._failures = self._failures, []
+        return failures
+
+    def close(self):
+        failures = self.flush()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        return failures
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                file_name, bucket, object_name, delete_after, on_success = item
+                try:
+                    uploaded = upload_file_to_s3(file_name, bucket, object_name)
+                    if uploaded:
+                        if delete_after and os.path.exists(file_name):
+                            os.remove(file_name)
+                        if on_success is not None:
+                            on_success()
+                except Exception as e:
+                    # a failing callback (a manifest write, say) must not take the thread down with the rest of the queue
+                    print(f"Failed to finish the upload of {file_name}: {str(e)}")
+                    uploaded = False
+                if not uploaded:
+                    with self._lock:
+                        self._failures.append((file_name, bucket, object_name))
+            finally:
+                self._queue.task_done()
+
+
+_upload_queue = None
+_upload_queue_pid = None
+
+
+def get_upload_queue():
+    """The UploadQueue shared by this process (recreated after a fork, since threads do not survive one)."""
+    global _upload_queue, _upload_queue_pid
+    with _client_lock:
+        if _upload_queue is None or _upload_queue_pid != os.getpid():
+            _upload_queue = UploadQueue()
+            _upload_queue_pid = os.getpid()
+        return _upload_queue
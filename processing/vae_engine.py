@@ -0,0 +1,265 @@
+"""
+Encoder-only VAE inference engines.
+
+Only the encoder half of the AutoencoderKL (encoder + quant_conv) is kept; the decoder is never
+moved to the device and is freed once the encoder has been split off. Backends:
+
+    eager        plain PyTorch
+    compile      torch.compile (VAE_COMPILE_MODE)
+    torchscript  traced and frozen once, saved under VAE_ENGINE_CACHE and reloaded on later starts
+    onnx         exported once to VAE_ENGINE_CACHE and run with onnxruntime
+
+VAE_CHANNELS_LAST=1 switches weights and inputs to channels_last (eager, compile, torchscript).
+VAE_CPU_THREADS sets the intra-op thread count on CPU workers. The exported backends run in fp32
+whatever VAE_PRECISION says.
+
+    python3 vae_engine.py parity [--backends eager compile torchscript onnx] [--batch-size 4] [--video <file>]
+"""
+import copy
+import hashlib
+import os
+import time
+from types import SimpleNamespace
+import torch
+
+VAE_ENGINES = ('eager', 'compile', 'torchscript', 'onnx')
+VAE_ENGINE = os.getenv('VAE_ENGINE', 'eager')
+VAE_CHANNELS_LAST = os.getenv('VAE_CHANNELS_LAST', '0') == '1'
+VAE_COMPILE_MODE = os.getenv('VAE_COMPILE_MODE', 'default')
+VAE_CPU_THREADS = int(os.getenv('VAE_CPU_THREADS', '0'))  # 0 keeps torch's default (one per core)
+VAE_ENGINE_CACHE = os.getenv('VAE_ENGINE_CACHE', os.path.expanduser('~/.cache/vidforge/vae_engine'))
+EXPORT_SIZE = 256  # example input used for tracing and export; batch, height and width stay dynamic
+
+
+def _diagonal_gaussian(moments):
+    try:
+        from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
+    except ImportError:  # diffusers < 0.26
+        from diffusers.models.vae import DiagonalGaussianDistribution
+    return DiagonalGaussianDistribution(moments)
+
+
+def configure_cpu_threads(threads=VAE_CPU_THREADS):
+    """Set torch's intra-op thread count; inter-op parallelism is not used by the encoder, so keep it at 1."""
+    if threads:
+        torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # can only be set before the first parallel op in the process
+    return torch.get_num_threads()
+
+
+class EncoderOnly(torch.nn.Module):
+    """encoder + quant_conv of an AutoencoderKL: frames as encode() takes them to posterior moments (N, 2C, h, w)."""
+
+    def __init__(self, vae):
+        super().__init__()
+        self.encoder = vae.encoder
+        self.quant_conv = getattr(vae, 'quant_conv', None)
+
+    def forward(self, x):
+        moments = self.encoder(x)
+        if self.quant_conv is not None:
+            moments = self.quant_conv(moments)
+        return moments
+
+
+def split_encoder(vae):
+    """An EncoderOnly module in eval mode without gradients; the decoder is left behind with `vae`."""
+    module = EncoderOnly(vae)
+    module.eval()
+    module.requires_grad_(False)
+    return module
+
+
+def weights_fingerprint(module):
+    """Short hash of the first conv's weights, so a changed checkpoint under the same name is re-exported."""
+    return hashlib.sha256(module.encoder.conv_in.weight.detach().float().cpu().numpy().tobytes()).hexdigest()[:16]
+
+
+def artifact_path(model_name, fingerprint, backend, device, channels_last, cache_dir=VAE_ENGINE_CACHE):
+    """Cache file for an exported encoder; the name changes with anything that changes the export."""
+    identity = f"{model_name}|{fingerprint}|{backend}|{device.type}|{int(channels_last)}|{torch.__version__}"
+    digest = hashlib.sha256(identity.encode()).hexdigest()[:16]
+    suffix = '.onnx' if backend == 'onnx' else '.pt'
+    return os.path.join(cache_dir, f"vae_encoder_{backend}_{digest}{suffix}")
+
+
+def _example_input(device, channels_last):
+    x = torch.zeros((1, 3, EXPORT_SIZE, EXPORT_SIZE), device=device)
+    return x.to(memory_format=torch.channels_last) if channels_last else x
+
+
+def _save_atomically(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _torchscript(module, path, device, channels_last):
+    if os.path.exists(path):
+        return torch.jit.load(path, map_location=device)
+    with torch.inference_mode(False), torch.no_grad():
+        traced = torch.jit.trace(module, _example_input(device, channels_last), check_trace=False)
+        traced = torch.jit.freeze(traced.eval())
+    _save_atomically(path, lambda tmp_path: torch.jit.save(traced, tmp_path))
+    print(f"Saved TorchScript encoder to {path}")
+    return traced
+
+
+def _onnx(module, path, device, threads):
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError("VAE_ENGINE=onnx needs onnxruntime (onnxruntime-gpu on CUDA hosts); "
+                          "install it or pick another engine") from e
+
+    if not os.path.exists(path):
+        # export from a copy: .float().cpu() converts in place, and `module` shares its weights with the loaded VAE
+        export_module = copy.deepcopy(module).float().cpu()
+        with torch.no_grad():
+            _save_atomically(path, lambda tmp_path: torch.onnx.export(
+                export_module, _example_input(torch.device('cpu'), False), tmp_path,
+                input_names=['frames'], output_names=['moments'], opset_version=17,
+                dynamic_axes={'frames': {0: 'batch', 2: 'height', 3: 'width'},
+                              'moments': {0: 'batch', 2: 'latent_height', 3: 'latent_width'}},
+            ))
+        print(f"Exported ONNX encoder to {path}")
+
+    options = onnxruntime.SessionOptions()
+    if threads:
+        options.intra_op_num_threads = threads
+    providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if device.type == 'cuda' else ['CPUExecutionProvider']
+    session = onnxruntime.InferenceSession(path, options, providers=providers)
+
+    def run(x):
+        moments = session.run(['moments'], {'frames': x.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(moments).to(device)
+    return run
+
+
+class VAEEncoderEngine:
+    """
+    Drop-in for the AutoencoderKL in BatchedVAEEncoder: encode(x).latent_dist gives the same
+    DiagonalGaussianDistribution, computed by the encoder half only, on the chosen backend.
+    """
+
+    def __init__(self, vae, backend=VAE_ENGINE, device=None, channels_last=VAE_CHANNELS_LAST, model_name=None,
+                 threads=VAE_CPU_THREADS, cache_dir=VAE_ENGINE_CACHE):
+        if backend not in VAE_ENGINES:
+            raise ValueError(f"Unknown VAE engine {backend!r}, expected one of {VAE_ENGINES}")
+        self.backend = backend
+        self.device = torch.device(device) if device is not None else next(vae.parameters()).device
+        self.channels_last = channels_last and backend != 'onnx'
+        self.model_name = model_name or getattr(getattr(vae, 'config', None), '_name_or_path', None) or 'vae'
+        self.artifact = None
+        if self.device.type == 'cpu':
+            configure_cpu_threads(threads)
+
+        module = split_encoder(vae).to(self.device)
+        if self.channels_last:
+            module = module.to(memory_format=torch.channels_last)
+        self.module = module
+
+        if backend == 'eager':
+            self._forward = module
+        elif backend == 'compile':
+            self._forward = torch.compile(module, mode=VAE_COMPILE_MODE)
+        elif backend == 'torchscript':
+            self.artifact = artifact_path(self.model_name, weights_fingerprint(module), backend, self.device,
+                                          self.channels_last, cache_dir)
+            self._forward = _torchscript(module, self.artifact, self.device, self.channels_last)
+        else:
+            self.artifact = artifact_path(self.model_name, weights_fingerprint(module), backend, self.device, False, cache_dir)
+            self._forward = _onnx(module, self.artifact, self.device, threads)
+
+    def parameters(self):
+        return self.module.parameters()
+
+    def moments(self, x):
+        x = x.to(self.device)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self._forward(x)
+
+    def encode(self, x):
+        return SimpleNamespace(latent_dist=_diagonal_gaussian(self.moments(x).float()))
+
+    def describe(self):
+        return {
+            'engine': self.backend,
+            'device': str(self.device),
+            'channels_last': self.channels_last,
+            'threads': torch.get_num_threads() if self.device.type == 'cpu' else None,
+            'artifact': self.artifact,
+        }
+
+
+def parity_check(reference, engine, frames, repeats=3):
+    """
+    Compare an engine's posterior mean and log-variance against the full reference AutoencoderKL on the
+    same (N, 3, H, W) frames, and time both. Returns a dict with the max abs / relative errors and ms per batch.
+    """
+    def timed_moments(encode):
+        encode(frames)  # warm-up (compilation, allocator growth)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            result = encode(frames)
+        if engine.device.type == 'cuda':
+            torch.cuda.synchronize()
+        return result, (time.perf_counter() - start) / repeats * 1000
+
+    with torch.inference_mode():
+        expected, reference_ms = timed_moments(lambda x: reference.encode(x.to(engine.device)).latent_dist)
+        actual, engine_ms = timed_moments(engine.encode)
+        actual = actual.latent_dist
+
+    result = {'engine': engine.backend, 'channels_last': engine.channels_last, 'reference_ms': reference_ms, 'engine_ms': engine_ms}
+    for name in ('mean', 'logvar'):
+        want, got = getattr(expected, name).float(), getattr(actual, name).float()
+        error = (got - want).abs().max().item()
+        result[f'{name}_max_abs_error'] = error
+        result[f'{name}_max_rel_error'] = error / max(want.abs().max().item(), 1e-12)
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+    from model_manager import VAE_MODEL_NAME, get_device, load_vae
+
+    parser = argparse.ArgumentParser(description="Check encoder-only engines against the full VAE and time them.")
+    parser.add_argument('command', choices=['parity'])
+    parser.add_argument('--backends', nargs='+', choices=VAE_ENGINES, default=list(VAE_ENGINES))
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--video', default=None, help="encode frames of this video instead of random input")
+    parser.add_argument('--tolerance', type=float, default=1e-3, help="max relative error of the mean to pass")
+    args = parser.parse_args()
+
+    device = get_device()
+    torch.manual_seed(0)
+    if args.video:
+        from vae_feature_extraction import read_video_frames, transform
+        frames = []
+        for frame in read_video_frames(args.video):
+            frames.append(transform(frame))
+            if len(frames) == args.batch_size:
+                break
+        frames = torch.stack(frames).to(device)
+    else:
+        frames = torch.rand((args.batch_size, 3, EXPORT_SIZE, EXPORT_SIZE), device=device)
+
+    reference = load_vae(device)
+    failed = False
+    print(f"{'engine':<13}{'ref ms':>9}{'engine ms':>11}{'mean rel err':>14}{'logvar rel err':>16}")
+    for backend in args.backends:
+        # the engine converts the modules it is given in place, so it gets its own copy of the weights
+        engine = VAEEncoderEngine(copy.deepcopy(reference), backend, device=device, channels_last=args.channels_last, model_name=VAE_MODEL_NAME)
+        result = parity_check(reference, engine, frames)
+        ok = result['mean_max_rel_error'] <= args.tolerance
+        failed |= not ok
+        print(f"{backend:<13}{result['reference_ms']:>9.1f}{result['engine_ms']:>11.1f}"
+              f"{result['mean_max_rel_error']:>14.2e}{result['logvar_max_rel_error']:>16.2e}  {'ok' if ok else 'MISMATCH'}")
+    raise SystemExit(1 if failed else 0)
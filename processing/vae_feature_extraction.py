@@ -1,60 +1,369 @@
+import contextlib
+import itertools
+import json
+import threading
+from collections import deque
 import torch
-from diffusers import AutoencoderKL
 from torchvision import transforms
-import cv2
 import os
 from upload_to_s3 import upload_file_to_s3
+from model_manager import get_encoder, VAE_MODEL_NAME
+from instrumentation import stage, timed
+from decode_backends import open_decoder
+from frame_dedup import FRAME_DEDUP, FrameDeduplicator
+from latent_codec import LATENT_POLICY, LATENT_SAMPLE_SEED, pack_latents, sample_generator, select_latents
+
+VAE_BATCH_SIZE = int(os.getenv('VAE_BATCH_SIZE', '16'))
+VAE_PRECISION = os.getenv('VAE_PRECISION', 'fp32')  # fp32, fp16 or bf16
+
+TARGET_FPS = 4
+FRAMES_PER_SEGMENT = 20  # 4 FPS for 5 seconds = 20 frames
+
+AUTOCAST_DTYPES = {
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
 
-vae_model = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse")
-vae_model.eval()
 
 transform = transforms.Compose([
     transforms.ToTensor(),
     transforms.Resize((256, 256)),
 ])
 
-def extract_vae_features(video_file, output_dir, bucket_name=None):
-    # Ensure the output directory exists
+
+class BatchedVAEEncoder:
+    """Collect frames (from one or several videos) and run them through the VAE in batches."""
+
+    def __init__(self, model=None, batch_size=VAE_BATCH_SIZE, precision=VAE_PRECISION, device=None, policy=LATENT_POLICY,
+                 seed=LATENT_SAMPLE_SEED):
+        self.model = model if model is not None else get_encoder()
+        self.batch_size = max(1, int(batch_size))
+        self.precision = precision
+        self.device = device or self.model.device
+        self.policy = policy
+        self.seed = seed
+        # 'sample' draws from one generator per video (keyed on the owner's video_name), so a video gets the
+        # same latents whichever videos it shares batches with
+        self._generators = {}
+        self._frames = []
+        self._owners = []
+
+    def add(self, owner, frame_tensor):
+        """Queue one (3, H, W) frame; returns [(owner, latent), ...] for any batch that got encoded."""
+        self._frames.append(frame_tensor)
+        self._owners.append(owner)
+        if len(self._frames) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Encode whatever is still queued, even if it is less than a full batch."""
+        if not self._frames:
+            return []
+        batch = torch.stack(self._frames)
+        owners = self._owners
+        self._frames, self._owners = [], []
+        generators = [self._generator_for(owner) for owner in owners] if self.policy == 'sample' else None
+        return list(zip(owners, self.encode(batch, generators)))
+
+    def encode(self, batch, generators=None):
+        """
+        Encode a (N, 3, H, W) batch and return what the latent policy keeps, as fp32 on the CPU.
+
+        generators holds one generator per row for the 'sample' policy; without it the batch samples
+        from the generator of an unnamed video.
+        """
+        if self.policy == 'sample' and generators is None:
+            generators = [self._generator_for(None)] * len(batch)
+        with stage('vae_encode') as counter:
+            batch = batch.to(self.device, non_blocking=True)
+            with torch.inference_mode(), self._autocast():
+                latents = select_latents(self.model.encode(batch).latent_dist, self.policy, generators)
+            latents = latents.float().cpu()  # waits for the device, so the timing is the real encode time
+            counter.frames += len(batch)
+        return latents
+
+    def _generator_for(self, owner):
+        name = getattr(owner, 'video_name', owner)
+        if name not in self._generators:
+            self._generators[name] = sample_generator(name, self.seed, self.device)
+        return self._generators[name]
+
+    def _autocast(self):
+        dtype = AUTOCAST_DTYPES.get(self.precision)
+        if dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=dtype)
+
+
+class SegmentWriter:
+    """Group the per-frame latents of one video into fixed-size segments saved as .pt files.
+
+    segment_stride defaults to frames_per_segment; a smaller stride gives overlapping windows,
+    a larger one leaves gaps between segments. With a shard_writer the segments are appended
+    to a packed latent shard instead of being saved and uploaded one by one. With an uploader
+    (an UploadQueue) segment uploads happen in the background.
+
+    start_segment numbers the first segment written when resuming a video, and on_segment(index)
+    is called once a segment is safely stored (uploaded, when there is a bucket).
+
+    Frames skipped by the dedup filter call reuse() instead of going through the encoder; they
+    repeat the latent of the last encoded frame, so segments keep one latent per sampled frame.
+    """
+
+    def __init__(self, video_name, output_dir, bucket_name=None, frames_per_segment=FRAMES_PER_SEGMENT, segment_stride=None,
+                 shard_writer=None, uploader=None, start_segment=0, on_segment=None):
+        self.video_name = video_name
+        self.output_dir = output_dir
+        self.bucket_name = bucket_name
+        self.shard_writer = shard_writer
+        self.uploader = uploader
+        self.frames_per_segment = frames_per_segment
+        self.segment_stride = segment_stride or frames_per_segment
+        self.on_segment = on_segment
+        self.batch_index = start_segment
+        self.feature_path = None
+        self._latents = []
+        self._unsaved = 0
+        self._skip = 0
+        # one entry per frame sent to the encoder and not yet returned: how many reused frames follow it
+        self._in_flight = deque()
+        self._last_latent = None
+
+    def expect(self):
+        """Note that a frame of this video was queued on the encoder; its latent comes back through add()."""
+        self._in_flight.append(0)
+
+    def reuse(self):
+        """The next frame repeats the latent of the last encoded one, which may still be in flight."""
+        if self._in_flight:
+            self._in_flight[-1] += 1
+        else:
+            self._append(self._last_latent)
+
+    def add(self, latent):
+        repeats = self._in_flight.popleft() if self._in_flight else 0
+        self._last_latent = latent
+        for _ in range(1 + repeats):
+            self._append(latent)
+
+    def _append(self, latent):
+        if self._skip:
+            self._skip -= 1
+            return
+        self._latents.append(latent)
+        self._unsaved += 1
+        if len(self._latents) >= self.frames_per_segment:
+            self._save("Saved batch of VAE features")
+
+    def close(self):
+        """Save the trailing partial segment and return the path of the last segment written."""
+        if self._unsaved:
+            self._save("Saved final VAE features")
+        return self.feature_path
+
+    def _save(self, message):
+        if self.shard_writer is not None:
+            self.shard_writer.append(self.video_name, self.batch_index, torch.stack(self._latents))
+            feature_path = None
+        else:
+            feature_path = os.path.join(self.output_dir, f"{self.video_name}_vae_features_batch_{self.batch_index}.pt")
+            torch.save(pack_latents(torch.stack(self._latents)), feature_path)
+            print(f"{message}: {feature_path}")
+            self._store(feature_path)
+        drop = min(self.segment_stride, len(self._latents))
+        del self._latents[:drop]
+        self._skip = self.segment_stride - drop
+        self._unsaved = 0
+        self.feature_path = feature_path
+        self.batch_index += 1
+
+    def _store(self, feature_path):
+        segment = self.batch_index
+        on_success = (lambda: self.on_segment(segment)) if self.on_segment else None
+        if not self.bucket_name:
+            if on_success:
+                on_success()
+            return
+
+        object_name = f"vae_features/{os.path.basename(feature_path)}"
+        if self.uploader is not None:
+            self.uploader.submit(feature_path, self.bucket_name, object_name, on_success=on_success)
+        elif upload_file_to_s3(feature_path, self.bucket_name, object_name) and on_success:
+            on_success()
+
+
+def _dispatch(encoded):
+    for writer, latent in encoded:
+        writer.add(latent)
+
+
+def _is_duplicate(deduplicator, frame):
+    """Run the dedup check as its own stage; the frames it counts are the ones that skip the VAE."""
+    if not deduplicator.enabled:
+        return False
+    with stage('dedup') as counter:
+        duplicate = deduplicator.is_duplicate(frame)
+        counter.frames += int(duplicate)
+    return duplicate
+
+
+def _record_dedup(deduplicator, video_name, output_dir, bucket_name=None, uploader=None):
+    """Save which frames of a video reused a latent as <video_name>_dedup.json, next to its features."""
+    if not deduplicator.enabled:
+        return None
+    summary = deduplicator.summary()
+    record_path = os.path.join(output_dir, f"{video_name}_dedup.json")
+    with open(record_path, 'w') as f:
+        json.dump(summary, f)
+    print(f"Reused latents for {summary['reused']}/{summary['frames']} frames of {video_name} "
+          f"({summary['skip_ratio']:.1%} skipped, {summary['method']} <= {summary['threshold']})")
+    if bucket_name:
+        object_name = f"vae_features/{os.path.basename(record_path)}"
+        if uploader is not None:
+            uploader.submit(record_path, bucket_name, object_name)
+        else:
+            upload_file_to_s3(record_path, bucket_name, object_name)
+    return summary
+
+
+def read_video_frames(video_file, target_fps=TARGET_FPS, backend=None):
+    """Yield the BGR frames of a video sampled at target_fps (None keeps every frame).
+
+    backend picks the decoder (DECODE_BACKEND by default); skipped frames are never converted into arrays.
+    """
+    with open_decoder(video_file, backend=backend, color='bgr') as decoder:
+        yield from decoder.iter_frames(target_fps)
+
+
+def encode_frame_streams(streams, output_dir, bucket_name=None, encoder=None, frames_per_segment=FRAMES_PER_SEGMENT, segment_stride=None,
+                         shard_writer=None, uploader=None, start_segment=0, on_segment=None, dedup=FRAME_DEDUP):
+    """
+    Encode (video_name, frames) streams through one shared batched encoder; returns the last feature path per video.
+
+    With start_segment, the sampled frames of earlier segments are skipped without being encoded.
+    With dedup ('diff' or 'dhash'), near-duplicate frames reuse the previous latent instead of being
+    encoded, and the reused frames are recorded in <video_name>_dedup.json.
+    """
     os.makedirs(output_dir, exist_ok=True)
+    encoder = encoder or BatchedVAEEncoder()
+    skip_frames = start_segment * (segment_stride or frames_per_segment)
 
-    video_name = os.path.splitext(os.path.basename(video_file))[0]
-    cap = cv2.VideoCapture(video_file)
-    
-    vae_features = []
-    segment_frame_count = 0
-    frames_per_segment = 20  # 4 FPS for 5 seconds = 20 frames
-    batch_index = 0
+    writers = []
+    for video_name, frames in streams:
+        writer = SegmentWriter(video_name, output_dir, bucket_name=bucket_name,
+                               frames_per_segment=frames_per_segment, segment_stride=segment_stride,
+                               shard_writer=shard_writer, uploader=uploader,
+                               start_segment=start_segment, on_segment=on_segment)
+        writers.append(writer)
+        deduplicator = FrameDeduplicator(dedup, start_index=skip_frames)
+        frames = itertools.islice(frames, skip_frames, None)
+        while True:
+            # decoding (or reading the ffmpeg pipe), the dedup check and the tensor transform, timed apart from the VAE
+            with stage('decode') as counter:
+                frame = next(frames, None)
+                if frame is not None:
+                    duplicate = _is_duplicate(deduplicator, frame)
+                    if not duplicate:
+                        frame_tensor = transform(frame)
+                    counter.frames += 1
+            if frame is None:
+                break
+            if duplicate:
+                writer.reuse()
+                continue
+            writer.expect()
+            # Frames from consecutive videos share batches, so short clips still fill the GPU.
+            _dispatch(encoder.add(writer, frame_tensor))
+        _record_dedup(deduplicator, video_name, output_dir, bucket_name, uploader)
 
+    _dispatch(encoder.flush())
+    return [writer.close() for writer in writers]
+
+
+def extract_vae_features_many(video_files, output_dir, bucket_name=None, encoder=None, target_fps=TARGET_FPS,
+                              frames_per_segment=FRAMES_PER_SEGMENT, segment_stride=None, shard_writer=None, uploader=None,
+                              dedup=FRAME_DEDUP):
+    """Encode several video files through one shared batched encoder."""
+    streams = (
+        (os.path.splitext(os.path.basename(video_file))[0], read_video_frames(video_file, target_fps))
+        for video_file in video_files
+    )
+    return encode_frame_streams(streams, output_dir, bucket_name=bucket_name, encoder=encoder,
+                                frames_per_segment=frames_per_segment, segment_stride=segment_stride,
+                                shard_writer=shard_writer, uploader=uploader, dedup=dedup)
+
+
+def extract_vae_features_from_frames(frames, video_name, output_dir, bucket_name=None, batch_size=VAE_BATCH_SIZE,
+                                     frames_per_segment=FRAMES_PER_SEGMENT, segment_stride=None, uploader=None,
+                                     start_segment=0, on_segment=None, dedup=FRAME_DEDUP):
+    """Encode an already-sampled stream of BGR frames, e.g. from the fused ffmpeg pipeline."""
+    encoder = BatchedVAEEncoder(batch_size=batch_size)
+    return encode_frame_streams([(video_name, frames)], output_dir, bucket_name=bucket_name, encoder=encoder,
+                                frames_per_segment=frames_per_segment, segment_stride=segment_stride,
+                                uploader=uploader, start_segment=start_segment, on_segment=on_segment, dedup=dedup)[0]
+
+
+def extract_vae_features_from_views(view_frames, video_name, view_count, output_dir, bucket_name=None, batch_size=VAE_BATCH_SIZE,
+                                    frames_per_segment=FRAMES_PER_SEGMENT, segment_stride=None, uploader=None,
+                                    start_segment=0, on_segment=None, dedup=FRAME_DEDUP):
+    """
+    Encode a stream of (K, H, W, 3) multi-view frames (see fused_pipeline.stream_video_views); every view
+    gets its own segments, named <video_name>_view<k>. Returns the last feature path of each view.
+
+    on_segment(index) fires once segment `index` is stored for all K views.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    encoder = BatchedVAEEncoder(batch_size=batch_size)
+    stored = {}
+    lock = threading.Lock()
+
+    def view_segment_done(segment):
+        # the writers call back from upload threads
+        with lock:
+            stored[segment] = stored.get(segment, 0) + 1
+            finished = stored[segment] == view_count
+        if finished and on_segment:
+            on_segment(segment)
+
+    writers = [
+        SegmentWriter(f"{video_name}_view{k}", output_dir, bucket_name=bucket_name, frames_per_segment=frames_per_segment,
+                      segment_stride=segment_stride, uploader=uploader, start_segment=start_segment,
+                      on_segment=view_segment_done)
+        for k in range(view_count)
+    ]
+    skip_frames = start_segment * (segment_stride or frames_per_segment)
+    deduplicator = FrameDeduplicator(dedup, start_index=skip_frames)
+    views = itertools.islice(view_frames, skip_frames, None)
     while True:
-        ret, frame = cap.read()
-        if not ret:
+        with stage('decode') as counter:
+            frame_views = next(views, None)
+            if frame_views is not None:
+                # the views of one frame are deduplicated together, so they stay in step
+                duplicate = _is_duplicate(deduplicator, frame_views)
+                tensors = [] if duplicate else [transform(view) for view in frame_views]
+                counter.frames += len(frame_views)
+        if frame_views is None:
             break
+        if duplicate:
+            for writer in writers:
+                writer.reuse()
+        for writer, frame_tensor in zip(writers, tensors):
+            writer.expect()
+            _dispatch(encoder.add(writer, frame_tensor))
+
+    _dispatch(encoder.flush())
+    _record_dedup(deduplicator, video_name, output_dir, bucket_name, uploader)
+    return [writer.close() for writer in writers]
+
 
-        if segment_frame_count < frames_per_segment:
-            frame_tensor = transform(frame).unsqueeze(0)
-            with torch.no_grad():
-                latents = vae_model.encode(frame_tensor)
-            vae_features.append(latents.squeeze(0))
-
-            segment_frame_count += 1
-
-        if segment_frame_count >= frames_per_segment:
-            feature_path = os.path.join(output_dir, f"{video_name}_vae_features_batch_{batch_index}.pt")
-            torch.save(torch.stack(vae_features), feature_path) 
-            print(f"Saved batch of VAE features: {feature_path}")
-            if bucket_name:
-                upload_file_to_s3(feature_path, bucket_name, f"vae_features/{os.path.basename(feature_path)}")
-            vae_features.clear()
-            segment_frame_count = 0 
-            batch_index += 1 
-
-    cap.release()
-
-    if vae_features:
-        feature_path = os.path.join(output_dir, f"{video_name}_vae_features_batch_{batch_index}.pt")
-        torch.save(torch.stack(vae_features), feature_path)
-        print(f"Saved final VAE features: {feature_path}")
-        if bucket_name:
-            upload_file_to_s3(feature_path, bucket_name, f"vae_features/{os.path.basename(feature_path)}")
-
-    return feature_path
+@timed('extract')
+def extract_vae_features(video_file, output_dir, bucket_name=None, batch_size=VAE_BATCH_SIZE, target_fps=TARGET_FPS,
+                         frames_per_segment=FRAMES_PER_SEGMENT, segment_stride=None, uploader=None,
+                         start_segment=0, on_segment=None, video_name=None, dedup=FRAME_DEDUP):
+    video_name = video_name or os.path.splitext(os.path.basename(video_file))[0]
+    return extract_vae_features_from_frames(read_video_frames(video_file, target_fps), video_name, output_dir,
+                                            bucket_name=bucket_name, batch_size=batch_size,
+                                            frames_per_segment=frames_per_segment, segment_stride=segment_stride,
+                                            uploader=uploader, start_segment=start_segment, on_segment=on_segment,
+                                            dedup=dedup)
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from archives import VIDEO_EXTENSIONS
+
+PROBE_CACHE_SIZE = int(os.getenv('PROBE_CACHE_SIZE', '4096'))
+PROBE_WORKERS = int(os.getenv('PROBE_WORKERS', '8'))
+PROBE_INDEX_NAME = '.video_probe.json'  # sidecar index written next to the videos, or into an index_dir
+
+_lock = threading.Lock()
+_cache = OrderedDict()
+
+
+def _cache_key(path):
+    """Identity of a file's current contents: its path plus mtime and size, so an edited file is re-probed."""
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def _frame_rate(rate):
+    """ffprobe rates are fractions like '30000/1001'; '0/0' means unknown."""
+    numerator, _, denominator = (rate or '0/0').partition('/')
+    try:
+        return float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def _parse(output, path, size, mtime_ns):
+    info = json.loads(output)
+    streams = info.get('streams') or []
+    if not streams:
+        return None
+    stream, container = streams[0], info.get('format', {})
+    fps = _frame_rate(stream.get('avg_frame_rate')) or _frame_rate(stream.get('r_frame_rate'))
+    duration = float(stream.get('duration') or container.get('duration') or 0) or None
+    frame_count = int(stream['nb_frames']) if stream.get('nb_frames', 'N/A').isdigit() else None
+    if frame_count is None and fps and duration:
+        frame_count = round(fps * duration)  # estimate for containers (e.g. webm) that do not store it
+    return {
+        'path': os.path.abspath(path),
+        'size': size,
+        'mtime_ns': mtime_ns,
+        'width': stream.get('width'),
+        'height': stream.get('height'),
+        'fps': fps,
+        'duration': duration,
+        'frame_count': frame_count,
+        'codec': stream.get('codec_name'),
+        'pix_fmt': stream.get('pix_fmt'),
+        'bit_rate': int(container['bit_rate']) if str(container.get('bit_rate', '')).isdigit() else None,
+    }
+
+
+def _remember(key, metadata):
+    with _lock:
+        _cache[key] = metadata
+        _cache.move_to_end(key)
+        while len(_cache) > PROBE_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def probe_video(path):
+    """
+    Width, height, fps, duration, frame count and codec of a video's first video stream, from a
+    single ffprobe call. Results are cached per path+mtime+size. Returns None if the file cannot be probed.
+    """
+    try:
+        key = _cache_key(path)
+    except OSError as e:
+        print(f"Error probing {path}: {e}")
+        return None
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    try:
+        result = subprocess.run(
+            [
+                'ffprobe',
+                '-v', 'error',
+                '-select_streams', 'v:0',
+                '-show_entries', 'stream=width,height,avg_frame_rate,r_frame_rate,nb_frames,duration,codec_name,pix_fmt'
+                                 ':format=duration,bit_rate',
+                '-of', 'json',
+                path,
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+        metadata = _parse(result.stdout, path, key[2], key[1])
+    except subprocess.CalledProcessError as e:
+        print(f"Error probing {path}: {e.stderr.decode()}")
+        return None
+    except OSError as e:  # no ffprobe on this host; decoders fall back to their own metadata
+        print(f"Error probing {path}: {e}")
+        return None
+    except (ValueError, KeyError) as e:
+        print(f"Error reading probe output for {path}: {e}")
+        return None
+
+    if metadata is not None:
+        _remember(key, metadata)
+    return metadata
+
+
+def index_path(directory, index_dir=None):
+    """Where a directory's index lives: next to its videos, or in index_dir under a name unique to the directory."""
+    if index_dir is None:
+        return os.path.join(directory, PROBE_INDEX_NAME)
+    directory = os.path.abspath(directory)
+    digest = hashlib.sha256(directory.encode()).hexdigest()[:12]
+    return os.path.join(index_dir, f"{os.path.basename(directory)}_{digest}{PROBE_INDEX_NAME}")
+
+
+def load_index(directory, index_dir=None):
+    """
+    The sidecar index of a directory as {file name: metadata}, keeping only entries that still match
+    their file's mtime and size. Valid entries also seed the in-process cache.
+    """
+    path = index_path(directory, index_dir)
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable probe index {path}: {e}")
+        return {}
+
+    valid = {}
+    for name, metadata in entries.items():
+        try:
+            key = _cache_key(os.path.join(directory, name))
+        except OSError:
+            continue
+        if (key[1], key[2]) == (metadata.get('mtime_ns'), metadata.get('size')):
+            valid[name] = metadata
+            _remember(key, metadata)
+    return valid
+
+
+def probe_directory(directory, workers=PROBE_WORKERS, write_index=True, index_dir=None):
+    """
+    Probe every video in a directory in parallel and return {file name: metadata}.
+
+    Files already described by the sidecar index are not reopened; the refreshed index is written
+    back (atomically) so the next caller, a dataset or a scheduler, can plan from it directly.
+    With index_dir the index is kept there instead of in the (possibly read-only) video directory;
+    an index that cannot be written is skipped with a message, never an error.
+    """
+    names = sorted(f for f in os.listdir(directory) if f.lower().endswith(VIDEO_EXTENSIONS))
+    index = {name: metadata for name, metadata in load_index(directory, index_dir).items() if name in names}
+    missing = [name for name in names if name not in index]
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=workers) as pool:  # each probe is its own ffprobe process
+            for name, metadata in zip(missing, pool.map(probe_video, (os.path.join(directory, n) for n in missing))):
+                if metadata is not None:
+                    index[name] = metadata
+        print(f"Probed {len(missing)} videos in {directory} ({len(names) - len(missing)} from the index)")
+
+    if write_index and missing:
+        _write_index(index, index_path(directory, index_dir))
+    return index
+
+
+def _write_index(index, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not write probe index {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Usage: python3 video_probe.py <video_dir | video_file> ...")
+        sys.exit(1)
+    for target in sys.argv[1:]:
+        if os.path.isdir(target):
+            index = probe_directory(target)
+            total = sum(metadata['duration'] or 0 for metadata in index.values())
+            print(f"{target}: {len(index)} videos, {total / 3600:.2f} hours, index at {index_path(target)}")
+        else:
+            print(json.dumps(probe_video(target), indent=2))
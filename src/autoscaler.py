@@ -0,0 +1,386 @@
+"""
+Scale Vast.ai workers with the backlog.
+
+Every interval the controller reads the Redis queue lengths and each worker's completed-task count,
+turns them into per-instance throughput and an ETA for the backlog, and adds or removes instances
+so the ETA stays near a target without the fleet ever costing more than the $/hr budget.
+Instances are drained (their workers stop consuming and finish their current tasks) before they
+are destroyed; launches and drains run in the background so the loop keeps sampling meanwhile.
+
+    python3 autoscaler.py --budget 3.0 --target-eta 3600
+"""
+import argparse
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import redis
+from celery import Celery
+from vast_celery_setup import (
+    launch_vast_ai_instances, setup_celery_workers_on_vast, instance_for_worker, worker_host_name, run_vastai,
+)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing'))
+from queues import QUEUES
+
+BUDGET_DPH = float(os.getenv('AUTOSCALE_BUDGET_DPH', '2.0'))      # cap on the fleet's total $/hr
+MAX_OFFER_DPH = float(os.getenv('AUTOSCALE_MAX_OFFER_DPH', '0.5'))  # dph_total filter for a single offer
+TARGET_ETA = float(os.getenv('AUTOSCALE_TARGET_ETA', '3600'))      # seconds the backlog should take to drain
+MIN_INSTANCES = int(os.getenv('AUTOSCALE_MIN_INSTANCES', '0'))
+INTERVAL = int(os.getenv('AUTOSCALE_INTERVAL', '60'))
+COOLDOWN = int(os.getenv('AUTOSCALE_COOLDOWN', '600'))             # seconds between scaling actions
+DRAIN_TIMEOUT = int(os.getenv('AUTOSCALE_DRAIN_TIMEOUT', '1800'))
+DRAIN_POLL = int(os.getenv('AUTOSCALE_DRAIN_POLL', '10'))           # seconds between checks of a draining instance
+# Tasks per second one instance is assumed to finish before any rate has been measured
+DEFAULT_INSTANCE_RATE = float(os.getenv('AUTOSCALE_DEFAULT_INSTANCE_RATE', '0.01'))
+
+
+class VastProvider:
+    """
+    Rents, prices and destroys Vast.ai instances through the vastai CLI.
+
+    A provider has offer_dph (the most one instance may cost), instances(), rent(), bootstrap() and destroy();
+    launch() is rent() then bootstrap(). A rented instance is reported by instances() straight away, while
+    its workers are still being set up. Only instances this provider rented are reported or destroyed,
+    never others on the account.
+    """
+
+    def __init__(self, max_offer_dph=MAX_OFFER_DPH):
+        self.offer_dph = max_offer_dph
+        self.owned = set()
+
+    def instances(self):
+        """{instance_id: dph_total} for the instances this provider launched and that still exist."""
+        listed = {instance['id']: instance.get('dph_total') or 0.0 for instance in run_vastai('show', 'instances') or []}
+        return {instance_id: dph for instance_id, dph in listed.items() if instance_id in self.owned}
+
+    def rent(self, count, max_dph):
+        """Rent up to count instances costing at most max_dph each; returns their IDs."""
+        instance_ids = launch_vast_ai_instances(count, min(max_dph, self.offer_dph))
+        self.owned.update(instance_ids)
+        return instance_ids
+
+    def bootstrap(self, instance_ids):
+        """Start the Celery workers on rented instances, destroying the ones that fail; returns those that started."""
+        results = setup_celery_workers_on_vast(instance_ids)
+        for instance_id, ok in results.items():
+            if not ok:
+                self.destroy(instance_id)
+        return [instance_id for instance_id, ok in results.items() if ok]
+
+    def launch(self, count, max_dph):
+        """Rent and bootstrap up to count instances costing at most max_dph each; returns the ones whose workers started."""
+        return self.bootstrap(self.rent(count, max_dph))
+
+    def destroy(self, instance_id):
+        print(f"Destroying instance {instance_id}")
+        run_vastai('destroy', 'instance', str(instance_id))
+        self.owned.discard(instance_id)
+
+
+class FakeProvider:
+    """In-memory provider for exercising the controller without renting anything."""
+
+    def __init__(self, dph=0.3, initial=0):
+        self.offer_dph = dph
+        self._next_id = 1
+        self.running = {}
+        self.destroyed = []
+        self.launch(initial, dph)
+
+    def instances(self):
+        return dict(self.running)
+
+    def rent(self, count, max_dph):
+        if self.offer_dph > max_dph:
+            return []
+        launched = list(range(self._next_id, self._next_id + count))
+        self._next_id += count
+        self.running.update((instance_id, self.offer_dph) for instance_id in launched)
+        return launched
+
+    def bootstrap(self, instance_ids):
+        return list(instance_ids)
+
+    def launch(self, count, max_dph):
+        return self.bootstrap(self.rent(count, max_dph))
+
+    def destroy(self, instance_id):
+        self.running.pop(instance_id, None)
+        self.destroyed.append(instance_id)
+
+
+class QueueMonitor:
+    """Backlog and throughput as seen from the broker: Redis list lengths plus Celery worker stats."""
+
+    def __init__(self, celery_app, queues=QUEUES):
+        self.app = celery_app
+        self.redis = redis.Redis.from_url(celery_app.conf.broker_url)
+        self.queues = queues
+        self._last_totals = None
+        self._last_time = None
+
+    def queue_lengths(self):
+        return {queue: self.redis.llen(queue) for queue in self.queues}
+
+    def stop_consuming(self, workers):
+        """Tell the named workers to stop taking tasks from every queue."""
+        for queue in self.queues:
+            self.app.control.cancel_consumer(queue, destination=workers)
+
+    def active_tasks(self, workers):
+        """Number of tasks the named workers are running."""
+        active = self.app.control.inspect(destination=workers, timeout=5).active() or {}
+        return sum(len(tasks) for tasks in active.values())
+
+    def sample(self):
+        """
+        One observation: queued and active task counts per queue, and tasks/s per worker since the last sample.
+        Worker names are '<queue>@<host>' as started by celery_worker_commands.
+        """
+        inspect = self.app.control.inspect(timeout=5)
+        stats = inspect.stats() or {}
+        active = inspect.active() or {}
+        now = time.time()
+
+        totals = {worker: sum(info.get('total', {}).values()) for worker, info in stats.items()}
+        rates = {}
+        if self._last_totals is not None:
+            elapsed = now - self._last_time
+            for worker, total in totals.items():
+                if worker in self._last_totals and elapsed > 0:
+                    rates[worker] = max(0, total - self._last_totals[worker]) / elapsed
+        self._last_totals, self._last_time = totals, now
+
+        return {
+            'queued': self.queue_lengths(),
+            'active': {worker: len(tasks) for worker, tasks in active.items()},
+            'rates': rates,
+            'workers': sorted(stats),
+        }
+
+
+def instance_rates(sample):
+    """Tasks/s per instance, summed over its workers."""
+    rates = {}
+    for worker, rate in sample['rates'].items():
+        instance_id = instance_for_worker(worker)
+        if instance_id is not None:
+            rates[instance_id] = rates.get(instance_id, 0.0) + rate
+    return rates
+
+
+def backlog(sample):
+    return sum(sample['queued'].values()) + sum(sample['active'].values())
+
+
+def desired_instances(sample, current, budget_dph, instance_dph, target_eta=TARGET_ETA, min_instances=MIN_INSTANCES,
+                      default_rate=DEFAULT_INSTANCE_RATE):
+    """
+    How many instances would drain the backlog within target_eta, clamped to the budget.
+    Returns (desired count, measured tasks/s per instance, ETA in seconds at the current size).
+    """
+    rates = [rate for rate in instance_rates(sample).values() if rate > 0]
+    per_instance = sum(rates) / len(rates) if rates else default_rate
+    work = backlog(sample)
+    eta = work / (per_instance * current) if current and per_instance else math.inf
+    desired = math.ceil(work / (per_instance * target_eta)) if work else 0
+    max_by_budget = int(budget_dph // instance_dph) if instance_dph > 0 else desired
+    return max(min_instances, min(desired, max_by_budget)), per_instance, eta
+
+
+class Autoscaler:
+    """
+    Controller loop: sample the broker, decide a fleet size, launch or drain-and-destroy to reach it.
+
+    Each instance is counted once: a launch is pending (its count and $/hr reserved against the budget)
+    only until the provider has rented it, after which it is part of provider.instances(). Instances
+    being drained still cost money but no longer count towards the fleet size.
+    """
+
+    def __init__(self, celery_app, provider, budget_dph=BUDGET_DPH, target_eta=TARGET_ETA, min_instances=MIN_INSTANCES,
+                 interval=INTERVAL, cooldown=COOLDOWN, drain_timeout=DRAIN_TIMEOUT, monitor=None, drain_poll=DRAIN_POLL):
+        self.app = celery_app
+        self.provider = provider
+        self.monitor = monitor or QueueMonitor(celery_app)
+        self.budget_dph = budget_dph
+        self.target_eta = target_eta
+        self.min_instances = min_instances
+        self.interval = interval
+        self.cooldown = cooldown
+        self.drain_timeout = drain_timeout
+        self.drain_poll = drain_poll
+        self._last_action = 0.0
+        self._last_step = None
+        self.dollars = 0.0  # fleet cost so far, integrated over the sampled $/hr
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = 0             # instances asked for but not rented yet
+        self._reserved_dph = 0.0      # budget held for them
+        self._bootstrapping = set()   # rented, workers not started yet
+        self._draining = set()
+        self._futures = []
+        self._launcher = ThreadPoolExecutor(max_workers=1)
+        self._drainer = ThreadPoolExecutor(max_workers=4)
+
+    def step(self):
+        """One control iteration; returns what it observed and decided."""
+        sample = self.monitor.sample()
+        fleet = self.provider.instances()
+        with self._lock:
+            pending, reserved_dph = self._pending, self._reserved_dph
+            draining = set(self._draining) & set(fleet)
+            bootstrapping = set(self._bootstrapping)
+        current = len(fleet) - len(draining) + pending
+        spend = sum(fleet.values())
+        now = time.time()
+        if self._last_step is not None:
+            self.dollars += spend * (now - self._last_step) / 3600
+        self._last_step = now
+        instance_dph = spend / len(fleet) if fleet else self.provider.offer_dph
+        desired, per_instance, eta = desired_instances(sample, current, self.budget_dph, instance_dph, self.target_eta,
+                                                       self.min_instances)
+        decision = {'backlog': backlog(sample), 'instances': current, 'desired': desired, 'dph': spend,
+                    'pending': pending, 'draining': len(draining),
+                    'tasks_per_instance_per_s': per_instance, 'eta_seconds': eta}
+        print(f"[autoscaler] backlog {decision['backlog']}, {current} instances (${spend:.2f}/hr, {pending} pending, "
+              f"{len(draining)} draining), {per_instance:.3f} tasks/s each, ETA {eta / 60:.0f} min, want {desired}")
+
+        if time.time() - self._last_action < self.cooldown:
+            return decision
+        if desired > current:
+            self._scale_up(desired - current, self.budget_dph - spend - reserved_dph)
+            self._last_action = time.time()
+        elif desired < current and not pending and not bootstrapping:
+            candidates = {instance_id: dph for instance_id, dph in fleet.items() if instance_id not in draining}
+            for instance_id in self._idle_instances(sample, candidates)[:current - desired]:
+                self._start_drain(instance_id)
+            self._last_action = time.time()
+        return decision
+
+    def _scale_up(self, count, remaining_budget):
+        max_dph = remaining_budget / count if count else 0
+        if max_dph <= 0:
+            return
+        with self._lock:
+            self._pending += count
+            self._reserved_dph += count * max_dph
+
+        def launch():
+            instance_ids = []
+            try:
+                instance_ids = self.provider.rent(count, max_dph)
+                with self._lock:
+                    self._bootstrapping.update(instance_ids)
+            finally:
+                # from here on the rented instances are counted (and priced) through provider.instances()
+                with self._lock:
+                    self._pending -= count
+                    self._reserved_dph -= count * max_dph
+            try:
+                started = self.provider.bootstrap(instance_ids)
+                print(f"[autoscaler] launched {len(started)} of {count} instances")
+            finally:
+                with self._lock:
+                    self._bootstrapping.difference_update(instance_ids)
+
+        # bootstrapping takes minutes; keep sampling meanwhile
+        self._submit(self._launcher, launch)
+
+    def _idle_instances(self, sample, fleet):
+        """Instances sorted least busy first, so the ones with no active tasks are drained first."""
+        busy = {}
+        for worker, count in sample['active'].items():
+            instance_id = instance_for_worker(worker)
+            busy[instance_id] = busy.get(instance_id, 0) + count
+        return sorted(fleet, key=lambda instance_id: busy.get(instance_id, 0))
+
+    def _start_drain(self, instance_id):
+        with self._lock:
+            self._draining.add(instance_id)
+
+        def drain():
+            try:
+                self.drain_and_destroy(instance_id)
+            finally:
+                with self._lock:
+                    self._draining.discard(instance_id)
+
+        self._submit(self._drainer, drain)
+
+    def _submit(self, executor, job):
+        def logged():
+            try:
+                job()
+            except Exception as e:
+                print(f"[autoscaler] background job failed: {e}")
+
+        future = executor.submit(logged)
+        with self._lock:
+            self._futures = [f for f in self._futures if not f.done()] + [future]
+        return future
+
+    def wait(self, timeout=None):
+        """Block until the launches and drains started so far have finished."""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures, timeout)
+
+    def drain_and_destroy(self, instance_id):
+        """
+        Stop the instance's workers from taking new tasks, wait for the active ones, then destroy it.
+        Blocks for up to drain_timeout; step() runs it in the background. stop() cuts the wait short.
+        """
+        workers = [f"{queue}@{worker_host_name(instance_id)}" for queue in self.monitor.queues]
+        self.monitor.stop_consuming(workers)
+        deadline = time.time() + self.drain_timeout
+        while self.monitor.active_tasks(workers):
+            if time.time() >= deadline:
+                print(f"[autoscaler] instance {instance_id} still busy after {self.drain_timeout}s, destroying anyway")
+                break
+            if self._stop.wait(self.drain_poll):
+                break
+        # with acks_late, anything still running is redelivered to another worker
+        self.provider.destroy(instance_id)
+
+    def run(self, until=None):
+        """Run until stop() is called or until() returns True."""
+        while not self._stop.is_set() and not (until and until()):
+            try:
+                self.step()
+            except Exception as e:
+                print(f"[autoscaler] step failed: {e}")
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+    def shutdown(self):
+        """Stop the loop and destroy every instance."""
+        self.stop()
+        self._launcher.shutdown(wait=True)
+        self._drainer.shutdown(wait=True)
+        for instance_id in self.provider.instances():
+            self.provider.destroy(instance_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scale Vast.ai Celery workers with the queue backlog.")
+    parser.add_argument('--budget', type=float, default=BUDGET_DPH, help="maximum total $/hr for the fleet")
+    parser.add_argument('--max-offer-dph', type=float, default=MAX_OFFER_DPH, help="maximum $/hr for a single instance")
+    parser.add_argument('--target-eta', type=float, default=TARGET_ETA, help="seconds the backlog should take to drain")
+    parser.add_argument('--min-instances', type=int, default=MIN_INSTANCES)
+    parser.add_argument('--interval', type=int, default=INTERVAL)
+    parser.add_argument('--fake', action='store_true', help="use an in-memory provider instead of renting instances")
+    args = parser.parse_args()
+
+    redis_ip = os.getenv('IP_ADDRESS')
+    app = Celery('vidforge', broker=f'redis://{redis_ip}:6379/0', backend=f'redis://{redis_ip}:6379/1')
+    provider = FakeProvider() if args.fake else VastProvider(args.max_offer_dph)
+    autoscaler = Autoscaler(app, provider, args.budget, args.target_eta, args.min_instances, args.interval)
+    try:
+        autoscaler.run()
+    except KeyboardInterrupt:
+        autoscaler.stop()
@@ -1,12 +1,18 @@
+import json
 import sys
 import subprocess
+import threading
 import time
-from vast_celery_setup import launch_vast_ai_instances, setup_celery_worker_on_vast
-from celery import Celery
-import math
+from autoscaler import Autoscaler, VastProvider
+from celery import Celery, chord
 from dotenv import load_dotenv
 import os
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing'))
+from manifest import Manifest, manifest_key, pipeline_params
+from queues import CPU_QUEUE, TASK_ROUTES
+import instrumentation
+
 def start_redis():
     """Start Redis server in the background."""
     print("Starting Redis server...")
@@ -14,26 +20,66 @@ def start_redis():
     time.sleep(2)  # Give Redis a couple of seconds to start up
     return redis_process
 
-def start_vast_celery_workers(num_instances):
-    """Launch GPU instances on Vast.ai and setup Celery workers on them."""
-    instance_ids = launch_vast_ai_instances(num_instances)
-    for instance_id in instance_ids:
-        setup_celery_worker_on_vast(instance_id)
-    return instance_ids
-
-def check_celery_tasks(celery_app):
-    """Check the status of Celery tasks to see if all tasks are finished."""
-    inspector = celery_app.control.inspect()
-    while True:
-        active_tasks = inspector.active() or {}
-        reserved_tasks = inspector.reserved() or {}
-
-        if not active_tasks and not reserved_tasks:
-            print("All Celery tasks are finished.")
-            break
-
-        print("Waiting for Celery tasks to finish...")
-        time.sleep(10)  # Check every 10 seconds
+def start_autoscaler(celery_app, until):
+    """Scale Vast.ai workers with the backlog on a background thread until `until()` is true."""
+    autoscaler = Autoscaler(celery_app, VastProvider())
+    threading.Thread(target=autoscaler.run, kwargs={'until': until}, daemon=True).start()
+    return autoscaler
+
+GROUP_SIZE = int(os.getenv('ARCHIVES_PER_TASK', '1'))
+ARCHIVE_TIME_LIMIT = int(os.getenv('ARCHIVE_TIME_LIMIT', '7200'))
+
+def filter_completed(items, params=None):
+    """
+    Drop items the completion manifest already records as processed with these pipeline parameters.
+    Items are manifest sources: archive URLs, video paths or URLs as submitted, or archive_member_source() values.
+    """
+    params = params or pipeline_params()
+    manifest = Manifest()
+    pending = [item for item in items if not manifest.is_complete(manifest_key(item, params))]
+    skipped = len(items) - len(pending)
+    if skipped:
+        print(f"Skipping {skipped} already processed items.")
+    return pending
+
+def submit_archive_tasks(celery_app, urls, output_dir, group_size=GROUP_SIZE, time_limit=ARCHIVE_TIME_LIMIT):
+    """
+    Enqueue one process_archives task per group of `group_size` shards, joined by a chord whose
+    callback summarizes every result. Returns the chord's AsyncResult.
+
+    Both go to the CPU queue explicitly; the workers consume nothing else, so a task left on Celery's
+    default queue would never run.
+    """
+    groups = [urls[i:i + group_size] for i in range(0, len(urls), group_size)]
+    header = [
+        celery_app.signature(
+            'process.process_archives',
+            args=[group, output_dir],
+            queue=CPU_QUEUE,
+            time_limit=time_limit * len(group),
+            soft_time_limit=time_limit * len(group) - 300,
+        )
+        for group in groups
+    ]
+    print(f"Submitting {len(urls)} archives as {len(header)} tasks ({group_size} per task)")
+    return chord(header)(celery_app.signature('process.summarize_results', queue=CPU_QUEUE))
+
+def collect_metrics(celery_app, clear=False):
+    """Stage events published by the workers' tasks (see process.publish_metrics)."""
+    client = celery_app.backend.client
+    if clear:
+        client.delete(instrumentation.METRICS_KEY)
+        return []
+    return [json.loads(event) for event in client.lrange(instrumentation.METRICS_KEY, 0, -1)]
+
+def wait_for_results(result):
+    """Block on the result backend until the chord callback has summarized every task."""
+    summary = result.get(propagate=True)
+    print(f"All Celery tasks are finished: {summary['archives']} archives, {summary['videos']} videos, "
+          f"{summary['failed_videos']} failed videos, by status {summary['by_status']}")
+    for url in summary['failed_archives']:
+        print(f"Needs a rerun: {url}")
+    return summary
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
@@ -46,10 +92,6 @@ if __name__ == "__main__":
     # Start Redis server
     redis_process = start_redis()
 
-    # Launch Vast.ai instances and set up Celery workers
-    num_vast_instances = 2 
-    vast_instance_ids = start_vast_celery_workers(num_vast_instances)
-
     # init Celery app
     # app = Celery('vidforge', broker='redis://localhost:6379/0')
     # Update Celery to connect to the global Redis server
@@ -57,7 +99,9 @@ if __name__ == "__main__":
 
     # Replace 'localhost' with your global Redis server IP.
     GLOBAL_REDIS_IP = os.getenv('IP_ADDRESS')
-    app = Celery('vidforge', broker=f'redis://{GLOBAL_REDIS_IP}:6379/0')
+    app = Celery('vidforge', broker=f'redis://{GLOBAL_REDIS_IP}:6379/0', backend=f'redis://{GLOBAL_REDIS_IP}:6379/1')
+    app.conf.task_routes = TASK_ROUTES
+    autoscaler = None
 
     try:
         # Read URLs from the .txt file and submit them as tasks
@@ -65,29 +109,22 @@ if __name__ == "__main__":
 
         with open(url_list, 'r') as f:
             urls = f.read().splitlines()
-        
-        # Split URLs into chunks for each worker
-        chunk_size = math.ceil(len(urls) / num_vast_instances)
-        url_chunks = [urls[i:i + chunk_size] for i in range(0, len(urls), chunk_size)]
-
-        # # Submit the download tasks to the Celery worker
-        # for chunk in url_chunks:
-        #     app.send_task('process.download_tar_file', args=[chunk, output_dir])  # Assuming you want to handle tar.gz files
-        #     # For other file types, you can create another task if necessary
-
-        # Submit the download tasks to the Celery worker (tasks will be sent to global Redis)
-        for chunk in url_chunks:
-            app.send_task('process.process_video', args=[chunk, output_dir])  # Correct task name
+        urls = [url for url in filter_completed(urls) if url.strip()]
 
-        # Wait for tasks to finish
-        check_celery_tasks(app)
+        # One small task per shard group: workers that finish early just take the next task
+        collect_metrics(app, clear=True)  # only report on this run's tasks
+        started = time.time()
+        result = submit_archive_tasks(app, urls, output_dir)
+        # Vast.ai workers are added while the backlog is large and drained as it empties
+        autoscaler = start_autoscaler(app, until=result.ready)
+        wait_for_results(result)
+        instrumentation.report(collect_metrics(app), time.time() - started, dollars=autoscaler.dollars)
 
     finally:
         # Cleanup: Stop Redis and terminate all Vast.ai instances
         print("Stopping Redis...")
         redis_process.terminate()
 
-        for instance_id in vast_instance_ids:
-            print(f"Terminating instance {instance_id}...")
-            subprocess.run(['vastai', 'destroy', 'instance', str(instance_id)])
+        if autoscaler is not None:
+            autoscaler.shutdown()
         print("Vast.ai instances terminated.")
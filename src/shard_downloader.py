@@ -0,0 +1,225 @@
+"""
+Parallel, resumable download of the Kinetics tar.gz shards listed in a k400_*_path.txt file.
+
+Each shard is fetched into <name>.part and renamed once its size (and md5, when known) checks out,
+so an interrupted run picks up where it stopped with an HTTP Range request. A shard already on disk
+is only skipped if it can be verified the same way; otherwise it is resumed like a .part file.
+
+    python3 shard_downloader.py kinetics-dataset/k400_targz/k400_train_path.txt <output_dir> [--workers 8] [--submit]
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing'))
+from queues import CPU_QUEUE
+
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '8'))
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', '5'))
+DOWNLOAD_BACKOFF = float(os.getenv('DOWNLOAD_BACKOFF', '2'))  # seconds, doubled after every failed attempt
+DOWNLOAD_TIMEOUT = int(os.getenv('DOWNLOAD_TIMEOUT', '60'))
+CHUNK_SIZE = 1 << 20
+
+_MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class DownloadError(Exception):
+    pass
+
+
+def read_url_list(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def shard_path(url, output_dir):
+    return os.path.join(output_dir, os.path.basename(url.split('?')[0]))
+
+
+def remote_info(url, timeout=DOWNLOAD_TIMEOUT):
+    """HEAD the shard: returns (size or None, md5 or None). S3 ETags of single-part uploads are the md5."""
+    request = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        size = response.headers.get('Content-Length')
+        match = _MD5_ETAG.match(response.headers.get('ETag', ''))
+    return (int(size) if size is not None else None), (match.group(1) if match else None)
+
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_verified(path, size, expected_md5):
+    """True if a downloaded file matches the expected size and md5; with neither known it cannot be trusted."""
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if expected_md5:
+        return file_md5(path) == expected_md5
+    return size is not None
+
+
+def _fetch(url, part_path, timeout):
+    """One attempt: append the missing tail of the shard to part_path. Returns the bytes received."""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header('Range', f'bytes={offset}-')
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset:  # nothing left to fetch
+            return 0
+        raise
+    with response:
+        # a server that ignores Range answers 200 with the whole file
+        mode = 'ab' if offset and response.status == 206 else 'wb'
+        received = 0
+        with open(part_path, mode) as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                f.write(chunk)
+                received += len(chunk)
+    return received
+
+
+def download_shard(url, output_dir, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF, timeout=DOWNLOAD_TIMEOUT,
+                   expected_md5=None):
+    """
+    Download one shard with resume, retries and verification. Returns its stats dict;
+    raises DownloadError once every attempt has failed.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    path = shard_path(url, output_dir)
+    part_path = f"{path}.part"
+    stats = {'url': url, 'path': path, 'size': None, 'bytes': 0, 'seconds': 0.0, 'attempts': 0,
+             'resumed_from': os.path.getsize(part_path) if os.path.exists(part_path) else 0, 'skipped': False}
+
+    start = time.time()
+    delay = backoff
+    info = None
+    while True:
+        stats['attempts'] += 1
+        try:
+            if info is None:
+                info = remote_info(url, timeout)
+                stats['size'] = info[0]
+                expected_md5 = expected_md5 or info[1]
+                if os.path.exists(path):
+                    if is_verified(path, info[0], expected_md5):
+                        stats['skipped'] = True
+                        return stats
+                    # possibly truncated by an earlier run: let the server confirm or complete it with a Range request
+                    os.replace(path, part_path)
+                    stats['resumed_from'] = os.path.getsize(part_path)
+            size = info[0]
+            stats['bytes'] += _fetch(url, part_path, timeout)
+            actual = os.path.getsize(part_path)
+            if size is not None and actual != size:
+                if actual > size:
+                    os.remove(part_path)
+                raise DownloadError(f"size mismatch: got {actual} bytes, expected {size}")
+            if expected_md5 and file_md5(part_path) != expected_md5:
+                os.remove(part_path)  # corrupt data cannot be resumed
+                raise DownloadError("md5 mismatch")
+            os.replace(part_path, path)
+            break
+        except (OSError, DownloadError) as e:  # URLError and socket timeouts are OSErrors
+            if stats['attempts'] > retries:
+                raise DownloadError(f"{url}: giving up after {stats['attempts']} attempts: {e}") from e
+            print(f"Retrying {url} in {delay:.0f}s (attempt {stats['attempts']}): {e}")
+            time.sleep(delay)
+            delay *= 2
+
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def download_shards(urls, output_dir, workers=DOWNLOAD_WORKERS, on_complete=None, checksums=None):
+    """
+    Download every shard with at most `workers` concurrent fetches. on_complete(stats) is called
+    from the calling thread as each shard lands, so processing can start before the rest finish.
+    checksums optionally maps a shard's file name to its md5. Returns (completed stats, failed urls).
+    """
+    checksums = checksums or {}
+    completed, failed = [], []
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(download_shard, url, output_dir, expected_md5=checksums.get(os.path.basename(shard_path(url, output_dir)))): url
+            for url in urls
+        }
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                print(f"Failed to download {url}: {e}")
+                failed.append(url)
+                continue
+            completed.append(stats)
+            if stats['skipped']:
+                print(f"[{len(completed)}/{len(urls)}] {os.path.basename(stats['path'])} already downloaded")
+            else:
+                rate = stats['bytes'] / stats['seconds'] / 1e6 if stats['seconds'] else 0.0
+                print(f"[{len(completed)}/{len(urls)}] {os.path.basename(stats['path'])}: {stats['bytes'] / 1e6:.1f} MB "
+                      f"in {stats['seconds']:.1f}s ({rate:.1f} MB/s, {stats['attempts']} attempts)")
+            if on_complete is not None:
+                on_complete(stats)
+
+    elapsed = time.time() - started
+    total = sum(stats['bytes'] for stats in completed)
+    print(f"Downloaded {total / 1e9:.2f} GB in {elapsed:.1f}s ({total / elapsed / 1e6 if elapsed else 0.0:.1f} MB/s aggregate); "
+          f"{len(completed)} shards ok, {len(failed)} failed")
+    return completed, failed
+
+
+def read_checksums(path):
+    """Parse an md5sum-style file ('<md5>  <file name>' per line) into {file name: md5}."""
+    checksums = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                checksums[os.path.basename(parts[1].lstrip('*'))] = parts[0].lower()
+    return checksums
+
+
+def submit_on_complete(celery_app, output_dir):
+    """
+    on_complete callback that queues process_archives for each shard as soon as it is on disk.
+    The workers must see the same path (same host or a shared volume). The task goes to the CPU
+    queue explicitly, since the workers consume nothing else.
+    """
+    def submit(stats):
+        celery_app.send_task('process.process_archives', args=[[stats['path']], output_dir], queue=CPU_QUEUE)
+    return submit
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download Kinetics tar.gz shards in parallel with resume.")
+    parser.add_argument('url_list', help="k400_*_path.txt with one shard URL per line")
+    parser.add_argument('output_dir')
+    parser.add_argument('--workers', type=int, default=DOWNLOAD_WORKERS)
+    parser.add_argument('--checksums', default=None, help="optional md5sum-style file for the shards")
+    parser.add_argument('--submit', action='store_true', help="queue process_archives for each shard as it completes")
+    args = parser.parse_args()
+
+    on_complete = None
+    if args.submit:
+        from celery import Celery
+        redis_ip = os.getenv('IP_ADDRESS')
+        app = Celery('vidforge', broker=f'redis://{redis_ip}:6379/0', backend=f'redis://{redis_ip}:6379/1')
+        on_complete = submit_on_complete(app, args.output_dir)
+
+    checksums = read_checksums(args.checksums) if args.checksums else None
+    _, failed = download_shards(read_url_list(args.url_list), args.output_dir, args.workers, on_complete, checksums)
+    sys.exit(1 if failed else 0)
@@ -1,101 +1,200 @@
 import subprocess
+import sys
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor
 from celery import Celery
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing'))
+from queues import CPU_QUEUE, GPU_QUEUE
+
 app = Celery('process', broker='redis://localhost:6379/0')
 
 SSH_KEY_PATH = os.getenv('SSH_KEY_PATH')
 LOCAL_PROCESSING_PATH = os.getenv('LOCAL_PROCESSING_PATH')
 NUM_INSTANCES = 2
 
+# Per-host worker pools: ffmpeg work on the cpu queue, VAE encoding on the gpu queue.
+CPU_WORKER_CONCURRENCY = int(os.getenv('CPU_WORKER_CONCURRENCY', '4'))
+GPU_WORKER_CONCURRENCY = int(os.getenv('GPU_WORKER_CONCURRENCY', '1'))
+# Clips each GPU process keeps reserved, so the device never waits for the next one.
+GPU_PREFETCH_MULTIPLIER = int(os.getenv('GPU_PREFETCH_MULTIPLIER', '4'))
+
+# Offers are ranked by GPU TFLOPS per $/hr; hosts below this download bandwidth (Mbps) are scored down
+# proportionally, since a worker that cannot fetch shards fast enough leaves its GPU idle.
+TARGET_INET_DOWN = float(os.getenv('VAST_TARGET_INET_DOWN', '500'))
+READY_TIMEOUT = int(os.getenv('VAST_READY_TIMEOUT', '900'))
+READY_POLL_INTERVAL = int(os.getenv('VAST_READY_POLL_INTERVAL', '10'))
+BOOTSTRAP_PARALLELISM = int(os.getenv('VAST_BOOTSTRAP_PARALLELISM', '16'))
+
+# Image the instances boot from. Point this at an image built from worker_dockerfile() to skip all installs.
+WORKER_IMAGE = os.getenv('WORKER_IMAGE', 'pytorch/pytorch')
+REQUIREMENTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'requirements.txt')
+VAE_MODEL_NAME = os.getenv('VAE_MODEL_NAME', 'stabilityai/sd-vae-ft-mse')
+SUBMITTER_ONLY_REQUIREMENTS = {'vastai-cli'}
+# Succeeds only on a host that already has everything a worker needs, baked image or earlier bootstrap.
+PROVISIONED_CHECK = (
+    "python3 -c \"import celery, redis, diffusers, cv2, boto3, dotenv\" && command -v redis-server && command -v ffmpeg"
+)
+
+def run_vastai(*args):
+    """Run one vastai CLI command with --raw and return its decoded JSON, or None if it failed."""
+    result = subprocess.run(['vastai', *args, '--raw'], capture_output=True, text=True)
+    try:
+        return json.loads(result.stdout)
+    except json.JSONDecodeError:
+        print(f"vastai {' '.join(args)} failed: {result.stderr or result.stdout}")
+        return None
+
+def offer_score(offer, target_inet_down=TARGET_INET_DOWN):
+    """Price/performance of an offer: TFLOPS per $/hr, scaled down when bandwidth is below target."""
+    dph = offer.get('dph_total') or 0
+    if dph <= 0:
+        return 0.0
+    bandwidth = min(1.0, (offer.get('inet_down') or 0) / target_inet_down)
+    return (offer.get('total_flops') or 0) * bandwidth / dph
+
 def search_vast_ai_offers(max_dph=0.5):
-    """Search for suitable GPU offers on Vast.ai and extract offer IDs."""
+    """Search Vast.ai once for GPU offers under max_dph and return them, best price/performance first."""
     print(f"Searching for GPU offers with max $/hr <= {max_dph}...")
-    
-    result = subprocess.run(
-        ['vastai', 'search', 'offers', f'dph_total<={max_dph}', '--raw'],  # Filters for cheaper GPUs
-        capture_output=True,
-        text=True
-    )
-
-    # Debugging: Print the raw output from the CLI command
-    print("Raw output from Vast.ai search:", result.stdout)
-    
-    if result.stdout:
-        try:
-            offers = json.loads(result.stdout)
-            offer_ids = [offer['id'] for offer in offers]  # Iterate over the list directly
-            
-            if offer_ids:
-                print(f"Found {len(offer_ids)} offers.")
-                return offer_ids  # Return all available offer IDs for further processing
-            else:
-                print("No suitable offers found.")
-                return None
-        except json.JSONDecodeError:
-            print("Failed to decode JSON.")
-            return None
-    else:
+    offers = run_vastai('search', 'offers', f'dph_total<={max_dph}')
+    if not offers:
         print("No offers found or failed to get offers.")
-        return None
+        return []
 
-def launch_vast_ai_instances(num_instances=10):
-    """Launch GPU instances on Vast.ai and return their IDs."""
-    instance_ids = []
+    offers = sorted(offers, key=offer_score, reverse=True)
+    print(f"Found {len(offers)} offers; best: " + ", ".join(
+        f"{offer['id']} ({offer.get('gpu_name')}, ${offer.get('dph_total', 0):.3f}/hr, "
+        f"{offer.get('total_flops', 0):.1f} TFLOPS, {offer.get('inet_down', 0):.0f} Mbps)"
+        for offer in offers[:3]))
+    return offers
 
-    for _ in range(num_instances):
-        offer_ids = search_vast_ai_offers()
-        if not offer_ids:
-            print("No suitable offers found. Exiting.")
+def launch_vast_ai_instances(num_instances=10, max_dph=0.5, image=WORKER_IMAGE):
+    """
+    Rent up to num_instances distinct offers, best ranked first, and return the new instance IDs.
+    An offer that is taken before we get to it is skipped in favour of the next one.
+    """
+    instance_ids = []
+    for offer in search_vast_ai_offers(max_dph):
+        if len(instance_ids) == num_instances:
             break
+        print(f"Launching instance with offer ID: {offer['id']}")
+        instance_info = run_vastai('create', 'instance', str(offer['id']), '--image', image, '--disk', '32')
+        if not instance_info or not instance_info.get('new_contract'):
+            continue
+        instance_ids.append(instance_info['new_contract'])
+        print(f"Instance launched: {instance_info['new_contract']}")
 
-        offer_id = offer_ids[0]  # Just picking the first offer for simplicity
-        print(f"Launching instance with offer ID: {offer_id}")
-        result = subprocess.run(
-            ['vastai', 'create', 'instance', str(offer_id), '--image', 'pytorch/pytorch', '--disk', '32', '--raw'],
-            capture_output=True,
-            text=True
-        )
+    if len(instance_ids) < num_instances:
+        print(f"Only {len(instance_ids)} of {num_instances} instances could be launched.")
+    return instance_ids
 
-        # Parse the result to extract the new contract (instance ID)
-        try:
-            instance_info = json.loads(result.stdout)
-            instance_id = instance_info['new_contract']
-            print(f"Instance launched: {instance_id}")
-            instance_ids.append(instance_id)
-        except json.JSONDecodeError:
-            print(f"Failed to launch instance: {result.stderr}")
-            continue
+def wait_for_instance(instance_id, timeout=READY_TIMEOUT, poll_interval=READY_POLL_INTERVAL):
+    """
+    Poll `vastai show instance` until the instance is running and reachable over SSH.
+    Returns (user@host, port), or None on timeout.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = run_vastai('show', 'instance', str(instance_id))
+        if info and info.get('actual_status') == 'running' and info.get('ssh_host') and info.get('ssh_port'):
+            user_host, port = f"root@{info['ssh_host']}", str(info['ssh_port'])
+            probe = subprocess.run(
+                ['ssh', '-i', SSH_KEY_PATH, '-p', port, '-o', 'StrictHostKeyChecking=no', '-o', 'ConnectTimeout=10',
+                 '-o', 'BatchMode=yes', user_host, 'true'],
+                capture_output=True,
+            )
+            if probe.returncode == 0:
+                return user_host, port
+        time.sleep(poll_interval)
+    print(f"Instance {instance_id} was not ready after {timeout}s")
+    return None
 
-        time.sleep(2)  # To prevent overloading the API
+def worker_requirements(requirements_path=REQUIREMENTS_PATH):
+    """Worker-side packages from requirements.txt, without comments, blanks or submitter-only tools."""
+    with open(requirements_path) as f:
+        lines = [line.split('#')[0].strip() for line in f]
+    return [line for line in lines if line and line not in SUBMITTER_ONLY_REQUIREMENTS]
 
-    return instance_ids
+def worker_dockerfile(requirements_path=REQUIREMENTS_PATH, base_image='pytorch/pytorch', vae_model=VAE_MODEL_NAME):
+    """
+    Dockerfile for a worker image with system packages, Python requirements and the VAE weights baked in.
+    The pipeline code itself is still copied at bootstrap, so the image only changes with its dependencies.
+    """
+    requirements = ' '.join(f"'{requirement}'" for requirement in worker_requirements(requirements_path))
+    return "\n".join([
+        f"FROM {base_image}",
+        "ENV DEBIAN_FRONTEND=noninteractive",
+        "RUN apt-get update && apt-get install -y --no-install-recommends ffmpeg redis-server libgl1 libglib2.0-0 "
+        "&& rm -rf /var/lib/apt/lists/*",
+        f"RUN python3 -m pip install --no-cache-dir {requirements}",
+        f"ENV VAE_MODEL_NAME={vae_model}",
+        f"RUN python3 -c \"from diffusers import AutoencoderKL; AutoencoderKL.from_pretrained('{vae_model}')\"",
+        "WORKDIR /root",
+        "",
+    ])
 
-def setup_celery_worker_on_vast(instance_id, max_retries=5, retry_delay=20):
-    """SSH into the instance, upload local files, install Celery, Redis, and Python dependencies, then start the Celery worker."""
-    
-    # Wait for the instance to be ready
-    time.sleep(60)  # Increased wait time to ensure the instance is fully ready
+def write_worker_dockerfile(path, **kwargs):
+    with open(path, 'w') as f:
+        f.write(worker_dockerfile(**kwargs))
+    print(f"Wrote worker Dockerfile to {path}; build and push it, then set WORKER_IMAGE to skip per-host installs.")
+    return path
 
-    # Fetch the SSH URL from Vast.ai CLI
-    ssh_url_cmd = f"vastai ssh-url {instance_id}"
-    try:
-        ssh_url = subprocess.check_output(ssh_url_cmd, shell=True).decode("utf-8").strip()
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to fetch SSH URL: {e}")
-        return
+def worker_host_name(instance_id):
+    """Celery node host part for a Vast instance, so workers (cpu@vast-123) map back to their instance."""
+    return f"vast-{instance_id}"
+
+def instance_for_worker(worker_name):
+    """Inverse of worker_host_name: the instance ID behind a worker name like 'gpu@vast-123', or None."""
+    host = worker_name.partition('@')[2]
+    if not host.startswith('vast-'):
+        return None
+    instance_id = host[len('vast-'):]
+    return int(instance_id) if instance_id.isdigit() else instance_id
+
+def celery_worker_commands(broker_url, cpu_concurrency=CPU_WORKER_CONCURRENCY, gpu_concurrency=GPU_WORKER_CONCURRENCY,
+                           gpu_prefetch=GPU_PREFETCH_MULTIPLIER, host_name='%h'):
+    """
+    Shell commands that start the CPU-queue and GPU-queue worker pools on one host. Each pool is named
+    after the queue it consumes (<queue>@<host>), which is how the autoscaler finds and drains it.
+    """
+    queue_env = f"CPU_QUEUE={CPU_QUEUE} GPU_QUEUE={GPU_QUEUE}"
+    return [
+        f"CELERY_BROKER_URL={broker_url} {queue_env} nohup python3 -m celery -A process worker -Q {CPU_QUEUE} "
+        f"-n {CPU_QUEUE}@{host_name} --concurrency={cpu_concurrency} --prefetch-multiplier=1 -O fair --loglevel=info "
+        f"> cpu_worker.log 2>&1 &",
+        f"CELERY_BROKER_URL={broker_url} {queue_env} VAE_PRELOAD=1 nohup python3 -m celery -A process worker -Q {GPU_QUEUE} "
+        f"-n {GPU_QUEUE}@{host_name} --concurrency={gpu_concurrency} --prefetch-multiplier={gpu_prefetch} --loglevel=info "
+        f"> gpu_worker.log 2>&1 &",
+    ]
+
+def setup_celery_worker_on_vast(instance_id, max_retries=5, retry_delay=20, cpu_concurrency=CPU_WORKER_CONCURRENCY,
+                                gpu_concurrency=GPU_WORKER_CONCURRENCY, timings=None):
+    """
+    Wait for the instance, upload local files, install Celery, Redis, and Python dependencies unless the host
+    already has them, then start the Celery workers. Returns True once the workers are started.
+
+    Seconds spent in each phase are recorded in `timings` when a dict is passed.
+    """
+    timings = timings if timings is not None else {}
+    phase_start = time.time()
 
-    # Extract the address and port from the ssh_url
-    if ssh_url.startswith('ssh://'):
-        ssh_url = ssh_url.replace('ssh://', '')
+    def phase_done(name):
+        nonlocal phase_start
+        timings[name] = time.time() - phase_start
+        phase_start = time.time()
 
-    # Split the ssh_url into user, host, and port
-    user_host, port = ssh_url.rsplit(':', 1)
+    # Wait until the instance is running and accepts SSH connections
+    address = wait_for_instance(instance_id)
+    if address is None:
+        return False
+    user_host, port = address
+    phase_done('ready')
+    print(f"Instance {instance_id} ready after {timings['ready']:.0f}s")
 
     # Upload the local processing folder to the remote instance using scp
     scp_command = f"scp -i {SSH_KEY_PATH} -P {port} -r {LOCAL_PROCESSING_PATH} {user_host}:/root/"
@@ -113,7 +212,15 @@ def setup_celery_worker_on_vast(instance_id, max_retries=5, retry_delay=20):
                 time.sleep(retry_delay)
             else:
                 print("Max retries reached. Exiting.")
-                return
+                return False
+    phase_done('upload')
+
+    # A baked worker image (or an earlier bootstrap) already has every package and the VAE weights
+    provisioned = subprocess.run(f"ssh -i {SSH_KEY_PATH} -p {port} {user_host} '{PROVISIONED_CHECK}'", shell=True,
+                                 capture_output=True).returncode == 0
+    timings['provisioned'] = provisioned
+    if provisioned:
+        print(f"Instance {instance_id} is already provisioned, skipping installs")
 
     # Start Redis server in the background
     # start_redis_command = (
@@ -122,17 +229,16 @@ def setup_celery_worker_on_vast(instance_id, max_retries=5, retry_delay=20):
     # )
 
     # Start Redis server in the background
-    start_redis_command = (
-        "apt-get update && apt-get install -y redis-server && "
-        "redis-server --daemonize yes"  # Start Redis in daemon mode
-    )
+    start_redis_command = "redis-server --daemonize yes"  # Start Redis in daemon mode
+    if not provisioned:
+        start_redis_command = "apt-get update && apt-get install -y redis-server ffmpeg libgl1 libglib2.0-0 && " + start_redis_command
     print(f"Starting Redis server: {start_redis_command}")
     try:
         subprocess.run(f"ssh -i {SSH_KEY_PATH} -p {port} {user_host} '{start_redis_command}'", shell=True, check=True)
         print("Redis server installed and started.")
     except subprocess.CalledProcessError as e:
         print(f"Failed to install or start Redis server: {e}")
-        return
+        return False
 
     # Optionally, check if Redis is running
     check_redis_command = "redis-cli ping"
@@ -142,33 +248,36 @@ def setup_celery_worker_on_vast(instance_id, max_retries=5, retry_delay=20):
             print("Redis is running.")
         else:
             print("Redis is not running. Exiting.")
-            return
+            return False
     except subprocess.CalledProcessError as e:
         print(f"Failed to check Redis status: {e}")
-        return
+        return False
 
-    # Install the necessary dependencies
+    # Install the necessary dependencies and fetch the VAE weights, so the first task does not download them
+    requirements = ' '.join(worker_requirements())
     install_dependencies_command = (
         f"ssh -i {SSH_KEY_PATH} -p {port} {user_host} "
         f"'curl -sS https://bootstrap.pypa.io/get-pip.py -o get-pip.py && python3 get-pip.py && "
-        f"python3 -m pip install celery redis python-dotenv accelerate safetensors[torch] boto3 ffmpeg-python torch torchvision opencv-python diffusers && "
-        f"apt-get update && apt-get install -y libgl1-mesa-glx'"
+        f"python3 -m pip install {requirements} && "
+        f"python3 -c \"from diffusers import AutoencoderKL; AutoencoderKL.from_pretrained(\\\"{VAE_MODEL_NAME}\\\")\"'"
     )
 
-    print(f"Installing Celery and Redis, along with required Python packages: {install_dependencies_command}")
-    for attempt in range(max_retries):
-        try:
-            subprocess.run(install_dependencies_command, shell=True, check=True)
-            print(f"Celery, Redis, and required libraries installed on instance {instance_id}")
-            break
-        except subprocess.CalledProcessError as e:
-            print(f"Dependency installation failed on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                print(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-            else:
-                print("Max retries reached. Exiting.")
-                return
+    if not provisioned:
+        print(f"Installing Celery and Redis, along with required Python packages: {install_dependencies_command}")
+        for attempt in range(max_retries):
+            try:
+                subprocess.run(install_dependencies_command, shell=True, check=True)
+                print(f"Celery, Redis, and required libraries installed on instance {instance_id}")
+                break
+            except subprocess.CalledProcessError as e:
+                print(f"Dependency installation failed on attempt {attempt + 1}: {e}")
+                if attempt < max_retries - 1:
+                    print(f"Retrying in {retry_delay} seconds...")
+                    time.sleep(retry_delay)
+                else:
+                    print("Max retries reached. Exiting.")
+                    return False
+    phase_done('install')
 
     # # Start the Celery worker after installation
     # start_celery_command = (
@@ -182,11 +291,11 @@ def setup_celery_worker_on_vast(instance_id, max_retries=5, retry_delay=20):
     # Replace 'localhost' with your global Redis server IP.
     GLOBAL_REDIS_IP = os.getenv('IP_ADDRESS')
     # Replace localhost with the global Redis IP
+    worker_commands = celery_worker_commands(f"redis://{GLOBAL_REDIS_IP}:6379/0", cpu_concurrency, gpu_concurrency,
+                                             host_name=worker_host_name(instance_id))
     start_celery_command = (
         f"ssh -i {SSH_KEY_PATH} -p {port} {user_host} "
-        f"'cd /root/processing && "
-        f"export CELERY_BROKER_URL=redis://{GLOBAL_REDIS_IP}:6379/0 && "
-        f"python3 -m celery -A process worker --loglevel=info --concurrency=2 &'"
+        f"'cd /root/processing && {' '.join(worker_commands)}'"
     )
 
     print(f"Starting Celery worker: {start_celery_command}")
@@ -194,7 +303,8 @@ def setup_celery_worker_on_vast(instance_id, max_retries=5, retry_delay=20):
         try:
             subprocess.run(start_celery_command, shell=True, check=True)
             print(f"Celery worker started on instance {instance_id}")
-            break
+            phase_done('start')
+            return True
         except subprocess.CalledProcessError as e:
             print(f"Failed to start Celery worker on attempt {attempt + 1}: {e}")
             if attempt < max_retries - 1:
@@ -202,13 +312,43 @@ def setup_celery_worker_on_vast(instance_id, max_retries=5, retry_delay=20):
                 time.sleep(retry_delay)
             else:
                 print("Max retries reached. Exiting.")
-                return
+                return False
+
+def setup_celery_workers_on_vast(instance_ids, parallelism=BOOTSTRAP_PARALLELISM, **kwargs):
+    """
+    Bootstrap every instance concurrently and print how long each host took, phase by phase.
+    Returns {instance_id: True if its workers started}.
+    """
+    if not instance_ids:
+        return {}
+    timings = {instance_id: {} for instance_id in instance_ids}
+    with ThreadPoolExecutor(max_workers=min(parallelism, len(instance_ids))) as pool:
+        futures = {
+            instance_id: pool.submit(setup_celery_worker_on_vast, instance_id, timings=timings[instance_id], **kwargs)
+            for instance_id in instance_ids
+        }
+    results = {}
+    for instance_id, future in futures.items():
+        try:
+            results[instance_id] = bool(future.result())
+        except Exception as e:
+            print(f"Setting up instance {instance_id} failed: {e}")
+            results[instance_id] = False
+
+    print("Bootstrap time per host (seconds):")
+    for instance_id, phases in timings.items():
+        total = sum(value for name, value in phases.items() if name != 'provisioned')
+        detail = ', '.join(f"{name} {value:.0f}" for name, value in phases.items() if name != 'provisioned')
+        state = 'ok' if results[instance_id] else 'FAILED'
+        image = 'prebuilt' if phases.get('provisioned') else 'installed'
+        print(f"  {instance_id}: {total:.0f}s total ({detail}; {image}) {state}")
+    return results
 
 if __name__ == "__main__":
-    instance_ids = launch_vast_ai_instances(NUM_INSTANCES)
+    if len(sys.argv) == 3 and sys.argv[1] == '--write-dockerfile':
+        write_worker_dockerfile(sys.argv[2])
+        sys.exit(0)
 
-    if instance_ids:
-        for instance_id in instance_ids:
-            setup_celery_worker_on_vast(instance_id)
-    
-    print(f"All {NUM_INSTANCES} instances have been set up and are running Celery workers.")
+    instance_ids = launch_vast_ai_instances(NUM_INSTANCES)
+    results = setup_celery_workers_on_vast(instance_ids)
+    print(f"{sum(results.values())} of {NUM_INSTANCES} instances have been set up and are running Celery workers.")
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# the modules import each other by bare name, as they do on the workers
+for path in (ROOT, os.path.join(ROOT, 'processing'), os.path.join(ROOT, 'src')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
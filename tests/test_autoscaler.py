@@ -0,0 +1,236 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('celery')
+pytest.importorskip('redis')
+
+import autoscaler
+import queues
+from autoscaler import Autoscaler, FakeProvider, QueueMonitor
+
+
+class FakeMonitor:
+    """Scripted broker view: a backlog per queue and a set of busy instances."""
+
+    def __init__(self, queued=0):
+        self.queues = queues.QUEUES
+        self.queued = queued
+        self.busy = set()
+        self.stopped = []
+
+    def sample(self):
+        return {'queued': {queues.CPU_QUEUE: self.queued, queues.GPU_QUEUE: 0}, 'active': {}, 'rates': {}, 'workers': []}
+
+    def stop_consuming(self, workers):
+        self.stopped.append(workers)
+
+    def active_tasks(self, workers):
+        return sum(1 for worker in workers if autoscaler.instance_for_worker(worker) in self.busy)
+
+
+class GatedProvider(FakeProvider):
+    """FakeProvider whose rent() and bootstrap() block until released, like the minutes a real launch takes."""
+
+    def __init__(self, dph=0.3, initial=0):
+        self.rent_gate = threading.Event()
+        self.bootstrap_gate = threading.Event()
+        self.rent_calls = []
+        self.rent_gate.set()  # let the initial instances through
+        self.bootstrap_gate.set()
+        super().__init__(dph, initial)
+        self.rent_gate.clear()
+        self.bootstrap_gate.clear()
+        self.rent_calls = []
+
+    def rent(self, count, max_dph):
+        self.rent_calls.append((count, max_dph))
+        self.rent_gate.wait(5)
+        return super().rent(count, max_dph)
+
+    def bootstrap(self, instance_ids):
+        self.bootstrap_gate.wait(5)
+        return super().bootstrap(instance_ids)
+
+
+def make_autoscaler(provider, monitor, **kwargs):
+    kwargs = {'budget_dph': 2.0, 'target_eta': 3600, 'min_instances': 0, 'cooldown': 0, 'drain_poll': 0.01, **kwargs}
+    return Autoscaler(None, provider, monitor=monitor, **kwargs)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "condition not reached"
+        time.sleep(0.01)
+
+
+def test_scales_up_to_the_backlog():
+    provider, monitor = FakeProvider(), FakeMonitor(queued=100)
+    scaler = make_autoscaler(provider, monitor)
+    decision = scaler.step()
+    scaler.wait()
+    # 100 tasks at the default 0.01 tasks/s per instance need 3 instances to finish within the hour
+    assert decision['desired'] == 3
+    assert len(provider.instances()) == 3
+
+    decision = scaler.step()
+    scaler.wait()
+    assert decision['instances'] == 3
+    assert len(provider.instances()) == 3
+
+
+def test_scale_up_is_clamped_to_the_budget():
+    provider, monitor = FakeProvider(dph=0.5), FakeMonitor(queued=10000)
+    scaler = make_autoscaler(provider, monitor, budget_dph=2.0)
+    assert scaler.step()['desired'] == 4
+    scaler.wait()
+    assert len(provider.instances()) == 4
+
+
+def test_instances_being_bootstrapped_are_counted_once():
+    provider, monitor = GatedProvider(), FakeMonitor(queued=100)
+    provider.rent_gate.set()
+    scaler = make_autoscaler(provider, monitor)
+    scaler.step()
+    wait_for(lambda: len(provider.instances()) == 3)
+
+    # rented and listed by the provider, workers still starting: three instances, not six
+    decision = scaler.step()
+    assert decision['instances'] == 3 and decision['pending'] == 0
+    assert len(provider.rent_calls) == 1
+
+    provider.bootstrap_gate.set()
+    scaler.wait()
+
+
+def test_pending_launch_reserves_its_budget():
+    provider, monitor = GatedProvider(), FakeMonitor(queued=100)
+    scaler = make_autoscaler(provider, monitor, budget_dph=2.0)
+    scaler.step()
+    wait_for(lambda: provider.rent_calls)
+
+    monitor.queued = 10000
+    decision = scaler.step()
+    assert decision['instances'] == 3 and decision['pending'] == 3
+    # the whole budget is reserved for the three pending instances, so nothing else is rented
+    assert len(provider.rent_calls) == 1
+
+    provider.rent_gate.set()
+    provider.bootstrap_gate.set()
+    scaler.wait()
+    assert len(provider.instances()) == 3
+
+
+def test_scale_down_drains_in_the_background():
+    provider, monitor = FakeProvider(initial=3), FakeMonitor(queued=0)
+    monitor.busy = {1, 2, 3}
+    scaler = make_autoscaler(provider, monitor, drain_timeout=60)
+
+    started = time.time()
+    decision = scaler.step()
+    assert time.time() - started < 1
+    assert decision['desired'] == 0
+    wait_for(lambda: len(monitor.stopped) == 3)
+    assert provider.destroyed == []
+
+    # draining instances no longer count towards the fleet and are not drained twice
+    decision = scaler.step()
+    assert decision['instances'] == 0 and decision['draining'] == 3
+    assert len(monitor.stopped) == 3
+
+    monitor.busy = set()
+    scaler.wait()
+    assert sorted(provider.destroyed) == [1, 2, 3]
+    assert provider.instances() == {}
+
+
+def test_scale_down_keeps_min_instances():
+    provider, monitor = FakeProvider(initial=3), FakeMonitor(queued=0)
+    scaler = make_autoscaler(provider, monitor, min_instances=1)
+    scaler.step()
+    scaler.wait()
+    assert len(provider.instances()) == 1
+
+
+def test_drain_gives_up_after_the_timeout():
+    provider, monitor = FakeProvider(initial=1), FakeMonitor()
+    monitor.busy = {1}
+    scaler = make_autoscaler(provider, monitor, drain_timeout=0)
+    scaler.drain_and_destroy(1)
+    assert provider.destroyed == [1]
+
+
+def test_drain_uses_the_configured_queue_names():
+    provider, monitor = FakeProvider(initial=1), FakeMonitor()
+    make_autoscaler(provider, monitor).drain_and_destroy(1)
+    assert monitor.stopped == [[f"{queue}@vast-1" for queue in queues.QUEUES]]
+
+
+def test_queue_monitor_reads_the_shared_queue_config():
+    class App:
+        class conf:
+            broker_url = 'redis://localhost:6379/0'
+
+    assert QueueMonitor(App()).queues == queues.QUEUES
+    assert autoscaler.QUEUES is queues.QUEUES
+
+
+REDIS_TEST_URL = os.getenv('REDIS_TEST_URL', 'redis://localhost:6379/15')
+
+
+class IdleInspect:
+    """celery inspect() with one GPU task running on vast-1 and no completed-task history yet."""
+
+    def stats(self):
+        return {'cpu@vast-1': {'total': {}}, 'gpu@vast-1': {'total': {}}}
+
+    def active(self):
+        return {'cpu@vast-1': [], 'gpu@vast-1': [{'name': 'process.encode_video'}]}
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    """Celery app on a local Redis server, or on fakeredis when none is running; yields (app, client)."""
+    import redis
+    from celery import Celery
+
+    client = redis.Redis.from_url(REDIS_TEST_URL)
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        fakeredis = pytest.importorskip('fakeredis')
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(autoscaler.redis.Redis, 'from_url', classmethod(lambda cls, url: fakeredis.FakeRedis(server=server)))
+        client = redis.Redis.from_url(REDIS_TEST_URL)
+    client.delete(*queues.QUEUES)
+    app = Celery('autoscaler_test', broker=REDIS_TEST_URL)
+    monkeypatch.setattr(app.control, 'inspect', lambda **kwargs: IdleInspect())
+    yield app, client
+    client.delete(*queues.QUEUES)
+
+
+def test_queue_monitor_reads_the_backlog_from_redis(broker):
+    app, client = broker
+    client.rpush(queues.CPU_QUEUE, *[json.dumps({'task': 'process.process_archives', 'n': i}) for i in range(150)])
+    client.rpush(queues.GPU_QUEUE, *[json.dumps({'task': 'process.encode_video', 'n': i}) for i in range(30)])
+
+    monitor = QueueMonitor(app)
+    assert monitor.queue_lengths() == {queues.CPU_QUEUE: 150, queues.GPU_QUEUE: 30}
+    sample = monitor.sample()
+    assert autoscaler.backlog(sample) == 181
+    # 181 tasks at the default 0.01 tasks/s per instance: 6 instances drain them within the hour
+    assert autoscaler.desired_instances(sample, 0, budget_dph=3.0, instance_dph=0.3, target_eta=3600, min_instances=0)[0] == 6
+    assert autoscaler.desired_instances(sample, 0, budget_dph=1.0, instance_dph=0.3, target_eta=3600, min_instances=0)[0] == 3
+
+    provider = FakeProvider()
+    scaler = Autoscaler(app, provider, budget_dph=3.0, target_eta=3600, min_instances=0, cooldown=0)
+    assert scaler.step()['desired'] == 6
+    scaler.wait()
+    assert len(provider.instances()) == 6
+
+    client.ltrim(queues.CPU_QUEUE, 0, -101)  # 100 tasks were taken
+    assert monitor.queue_lengths()[queues.CPU_QUEUE] == 50
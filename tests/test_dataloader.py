@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import dataloader
+from dataloader import LatentDataset, VideoDataset
+from latent_shards import LatentShardReader, LatentShardWriter
+
+
+class TrackedReader(LatentShardReader):
+    opened = []
+
+    def __init__(self, shard_path):
+        super().__init__(shard_path)
+        self.closed = False
+        TrackedReader.opened.append(self)
+
+    def close(self):
+        self.closed = True
+        super().close()
+
+
+@pytest.fixture
+def readers(monkeypatch):
+    TrackedReader.opened = []
+    monkeypatch.setattr(dataloader, 'LatentShardReader', TrackedReader)
+    return TrackedReader.opened
+
+
+def write_shards(directory, shards=3, segments=4, frames=5):
+    """One shard per `shards`, `segments` entries each; entry values encode (shard, segment)."""
+    for shard in range(shards):
+        with LatentShardWriter(str(directory), prefix=f'latents_{shard}', dtype='float16') as writer:
+            for segment in range(segments):
+                writer.append(f'video_{shard}', segment, torch.full((frames, 4, 2, 2), shard * 10 + segment, dtype=torch.float32))
+
+
+def test_counts_shard_entries_without_opening_them(tmp_path, readers):
+    write_shards(tmp_path)
+    dataset = LatentDataset(str(tmp_path), seq_len=5)
+    assert len(dataset) == 12
+    assert readers == []
+
+    assert dataset[5][0, 0, 0, 0].item() == 11
+    assert len(readers) == 1
+
+
+def test_s3_source_only_downloads_the_indexes(tmp_path, monkeypatch, readers):
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    write_shards(tmp_path / 'local', shards=2)
+
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='latents')
+        for name in os.listdir(tmp_path / 'local'):
+            s3.upload_file(str(tmp_path / 'local' / name), 'latents', f'vae_shards/{name}')
+
+        cache = tmp_path / 'cache'
+        dataset = LatentDataset('s3://latents/vae_shards', seq_len=5, cache_dir=str(cache))
+        assert len(dataset) == 8
+        assert sorted(os.listdir(cache)) == ['latents_0_00000.json', 'latents_1_00000.json']
+
+        assert dataset[6][0, 0, 0, 0].item() == 12
+        assert 'latents_1_00000.bin' in os.listdir(cache)
+        assert 'latents_0_00000.bin' not in os.listdir(cache)
+
+
+def test_evicted_readers_are_closed(tmp_path, readers):
+    write_shards(tmp_path)
+    dataset = LatentDataset(str(tmp_path), seq_len=5, max_open_files=1)
+    for idx in range(len(dataset)):
+        shard, segment = divmod(idx, 4)
+        assert torch.all(dataset[idx] == shard * 10 + segment)
+
+    assert len(readers) == 3
+    assert [reader.closed for reader in readers] == [True, True, False]
+    assert readers[0]._mmap.closed and readers[0]._file.closed
+
+    dataset.close()
+    assert readers[2].closed
+
+
+def test_reader_in_use_is_closed_by_its_last_user(tmp_path, readers):
+    write_shards(tmp_path, shards=2)
+    dataset = LatentDataset(str(tmp_path), seq_len=5, max_open_files=1)
+    first_key, second_key = dataset.items[0][0], dataset.items[4][0]
+
+    first = dataset._acquire(first_key)
+    view = first[0]
+    dataset._release(dataset._acquire(second_key))
+    assert not first.closed  # evicted while still being read
+    assert torch.all(view == 0)
+
+    del view
+    dataset._release(first)
+    assert first.closed
+
+
+def test_loads_pt_segments(tmp_path):
+    torch.save(torch.ones((3, 4, 2, 2)), tmp_path / 'clip_vae_features_batch_0.pt')
+    dataset = LatentDataset(str(tmp_path), seq_len=5)
+    item = dataset[0]
+    assert item.shape == (5, 4, 2, 2) and torch.all(item == 1)
+
+
+@pytest.fixture
+def videos(tmp_path, monkeypatch):
+    cv2 = pytest.importorskip('cv2')
+    for name, frames in (('long.mp4', 12), ('short.mp4', 3)):
+        writer = cv2.VideoWriter(str(tmp_path / name), cv2.VideoWriter_fourcc(*'mp4v'), 10, (32, 24))
+        for index in range(frames):
+            writer.write(np.full((24, 32, 3), index * 20, dtype=np.uint8))
+        writer.release()
+
+    # containers can report 0 or -1 frames; whole-video mode must not depend on the count
+    open_decoder = dataloader.open_decoder
+
+    def bogus_count(*args, **kwargs):
+        decoder = open_decoder(*args, **kwargs)
+        decoder.frame_count = -1
+        return decoder
+
+    monkeypatch.setattr(dataloader, 'open_decoder', bogus_count)
+    return tmp_path
+
+
+def frame_levels(clip):
+    return [round(frame.float().mean().item() / 20) for frame in clip]
+
+
+def test_whole_video_mode_reads_to_the_end(videos):
+    dataset = VideoDataset(str(videos), backend='opencv')
+    lengths = {os.path.basename(path): dataset[i].shape for i, path in enumerate(dataset.video_files)}
+    assert lengths == {'long.mp4': (12, 3, 24, 32), 'short.mp4': (3, 3, 24, 32)}
+
+
+def test_clip_mode_pads_short_videos(videos):
+    dataset = VideoDataset(str(videos), clip_length=5, frame_stride=2, random_offset=False, backend='opencv')
+    for i, path in enumerate(dataset.video_files):
+        clip = dataset[i]
+        assert clip.shape == (5, 3, 24, 32)
+        if path.endswith('short.mp4'):
+            assert frame_levels(clip) == [0, 2, 2, 2, 2]
@@ -0,0 +1,113 @@
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+
+import decode_backends
+from decode_backends import FFmpegPipeDecoder, open_decoder, pipe_frames
+
+FRAMES = 12
+
+
+def write_video(path, frames=FRAMES, size=(64, 48), fps=10, step=20):
+    """Solid gray frames whose level encodes the frame index (`step` per frame)."""
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    for index in range(frames):
+        writer.write(np.full((size[1], size[0], 3), index * step, dtype=np.uint8))
+    writer.release()
+    return str(path)
+
+
+def levels(frames, step=20):
+    return [int(round(frame.mean() / step)) for frame in frames]
+
+
+def require(backend):
+    if backend == 'pyav':
+        pytest.importorskip('av')
+    if backend == 'ffmpeg' and shutil.which('ffmpeg') is None:
+        pytest.skip("ffmpeg is not installed")
+
+
+@pytest.fixture
+def video(tmp_path):
+    return write_video(tmp_path / 'clip.mp4')
+
+
+@pytest.fixture
+def no_ffprobe(monkeypatch):
+    monkeypatch.setattr(decode_backends, 'probe_video', lambda path: None)
+
+
+@pytest.mark.parametrize('backend', ['opencv', 'pyav', 'ffmpeg'])
+def test_reads_every_frame_without_ffprobe(video, no_ffprobe, backend):
+    require(backend)
+    with open_decoder(video, backend=backend) as decoder:
+        assert decoder.size == (64, 48) and decoder.fps == 10
+        frames = decoder.read_all()
+    assert frames.shape == (FRAMES, 48, 64, 3)
+    assert levels(frames) == list(range(FRAMES))
+
+
+@pytest.mark.parametrize('backend', ['opencv', 'pyav', 'ffmpeg'])
+def test_get_batch_and_resize(video, no_ffprobe, backend):
+    require(backend)
+    with open_decoder(video, backend=backend, size=(32, 24), color='bgr') as decoder:
+        out, count = decoder.get_batch([2, 5, 8, 40])
+    assert out.shape == (4, 24, 32, 3) and count == 3
+    assert levels(out[:3]) == [2, 5, 8]
+
+
+@pytest.mark.parametrize('backend', ['opencv', 'pyav', 'ffmpeg'])
+def test_target_fps_subsamples(tmp_path, no_ffprobe, backend):
+    # the ffmpeg backend samples with build_sample_filter's select expression, the others with FrameSampler
+    require(backend)
+    video = write_video(tmp_path / 'clip.mp4', frames=30, fps=30, step=8)
+    with open_decoder(video, backend=backend) as decoder:
+        assert levels(decoder.iter_frames(target_fps=4), step=8) == [0, 8, 15, 23]
+    with open_decoder(video, backend=backend) as decoder:
+        assert levels(decoder.iter_frames(target_fps=10), step=8) == list(range(0, 30, 3))
+
+
+def test_ffmpeg_failure_raises_after_the_frames(tmp_path, no_ffprobe):
+    require('ffmpeg')
+    video = write_video(tmp_path / 'clip.mp4')
+    decoder = FFmpegPipeDecoder(video)
+    (tmp_path / 'clip.mp4').write_bytes(b'not a video any more')
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        list(decoder.iter_frames())
+    assert error.value.stderr
+
+
+def test_pipe_frames_raises_on_a_non_zero_exit():
+    script = "import sys; sys.stdout.buffer.write(bytes(12)); sys.stderr.write('boom'); sys.exit(3)"
+    frames = pipe_frames([sys.executable, '-c', script], (2, 2, 3))
+    assert next(frames).shape == (2, 2, 3)
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        next(frames)
+    assert error.value.returncode == 3 and error.value.stderr == b'boom'
+
+
+def test_ffmpeg_backend_falls_back_to_opencv_for_the_frame_size(video, no_ffprobe):
+    decoder = FFmpegPipeDecoder(video)
+    assert decoder.source_size == decoder.size == (64, 48)
+    assert decoder.fps == 10 and decoder.frame_count == FRAMES
+
+    resized = FFmpegPipeDecoder(video, size=(32, 24))
+    assert resized.source_size == (64, 48) and resized.size == (32, 24)
+
+
+def test_ffmpeg_backend_rejects_a_video_it_cannot_size(tmp_path, no_ffprobe):
+    path = tmp_path / 'broken.mp4'
+    path.write_bytes(b'not a video')
+    with pytest.raises(ValueError, match='frame size could not be probed'):
+        FFmpegPipeDecoder(str(path))
+
+
+def test_unknown_backend(video):
+    with pytest.raises(ValueError, match='Unknown decode backend'):
+        open_decoder(video, backend='gstreamer')
@@ -0,0 +1,152 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from frame_dedup import FrameDeduplicator
+from manifest import manifest_key, pipeline_params
+
+
+def frame(level, size=(48, 64)):
+    return np.full(size + (3,), level, dtype=np.uint8)
+
+
+def duplicates(deduplicator, levels):
+    return [deduplicator.is_duplicate(frame(level)) for level in levels]
+
+
+def test_diff_reuses_frames_within_the_threshold_of_the_last_encoded_one():
+    deduplicator = FrameDeduplicator('diff', threshold=1.0, max_run=0)
+    # a slow drift of 0.6 gray levels per frame is compared against the last *encoded* frame, not the previous one
+    assert duplicates(deduplicator, [100, 100, 101, 101, 102, 150]) == [False, True, True, True, False, False]
+    assert deduplicator.reused == [1, 2, 3]
+
+
+def test_dhash_ignores_brightness_but_not_structure():
+    gradient = np.tile(np.linspace(0, 200, 64, dtype=np.uint8), (48, 1))[..., None].repeat(3, axis=-1)
+    deduplicator = FrameDeduplicator('dhash', max_run=0)
+    assert not deduplicator.is_duplicate(gradient)
+    assert deduplicator.is_duplicate(gradient + 40)
+    assert not deduplicator.is_duplicate(gradient[:, ::-1])
+
+
+def test_max_run_forces_an_encode():
+    deduplicator = FrameDeduplicator('diff', max_run=3)
+    assert duplicates(deduplicator, [7] * 9) == [False, True, True, True, False, True, True, True, False]
+
+
+def test_off_never_deduplicates():
+    deduplicator = FrameDeduplicator('off')
+    assert not deduplicator.enabled
+    assert duplicates(deduplicator, [7, 7, 7]) == [False] * 3
+    assert deduplicator.frames == 3 and deduplicator.reused == []
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError, match='Unknown dedup method'):
+        FrameDeduplicator('ssim')
+
+
+def test_summary_counts_from_the_start_index():
+    deduplicator = FrameDeduplicator('diff', threshold=2, max_run=5, start_index=40)
+    duplicates(deduplicator, [10, 10, 60, 61])
+    assert deduplicator.summary() == {
+        'method': 'diff', 'threshold': 2.0, 'max_run': 5, 'start_index': 40, 'frames': 4,
+        'encoded': 2, 'reused': 2, 'skip_ratio': 0.5, 'reused_frames': [41, 43],
+    }
+
+
+def test_dedup_settings_are_part_of_the_manifest_key():
+    keys = {
+        manifest_key('clip.mp4', pipeline_params(frame_dedup=method, frame_dedup_threshold=threshold, frame_dedup_max_run=max_run))
+        for method, threshold, max_run in [('off', None, 20), ('diff', None, 20), ('diff', '2', 20), ('diff', None, 5), ('dhash', None, 20)]
+    }
+    assert len(keys) == 5
+    # without dedup the other dedup settings do not matter
+    assert manifest_key('clip.mp4', pipeline_params(frame_dedup='off', frame_dedup_max_run=5)) in keys
+
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+
+from vae_feature_extraction import BatchedVAEEncoder, SegmentWriter, encode_frame_streams
+
+
+class SegmentSink:
+    """Stands in for a LatentShardWriter and keeps the segments appended to it."""
+
+    def __init__(self):
+        self.segments = []
+
+    def append(self, video_id, segment, latents):
+        self.segments.append((video_id, segment, latents))
+
+
+def segment_writer(frames_per_segment=4, segment_stride=None):
+    sink = SegmentSink()
+    writer = SegmentWriter('clip', None, frames_per_segment=frames_per_segment, segment_stride=segment_stride, shard_writer=sink)
+    return writer, sink
+
+
+def levels(sink):
+    return [latents.flatten().tolist() for _, _, latents in sink.segments]
+
+
+def test_reused_frames_wait_for_the_latent_still_in_flight():
+    writer, sink = segment_writer()
+    writer.expect()            # frame 0
+    writer.expect()            # frame 1
+    writer.reuse()             # frames 2 and 3 repeat frame 1, whose latent is not back yet
+    writer.reuse()
+    writer.expect()            # frame 4
+    assert sink.segments == []
+
+    writer.add(torch.tensor([0.0]))
+    writer.add(torch.tensor([1.0]))
+    assert levels(sink) == [[0, 1, 1, 1]]
+    writer.add(torch.tensor([4.0]))
+    writer.reuse()             # nothing in flight: repeats frame 4 straight away
+    writer.close()
+    assert levels(sink) == [[0, 1, 1, 1], [4, 4]]
+    assert [segment for _, segment, _ in sink.segments] == [0, 1]
+
+
+def test_reuse_across_overlapping_segments():
+    writer, sink = segment_writer(frames_per_segment=4, segment_stride=2)
+    writer.expect()
+    for _ in range(4):
+        writer.reuse()
+    writer.expect()
+    writer.add(torch.tensor([0.0]))
+    writer.add(torch.tensor([5.0]))
+    writer.close()
+    assert levels(sink) == [[0, 0, 0, 0], [0, 0, 0, 5]]  # the tail is already covered by the second window
+
+
+class LevelModel(torch.nn.Module):
+    """Stands in for the VAE encoder: the latent of a frame is its mean gray level."""
+
+    device = torch.device('cpu')
+
+    def encode(self, batch):
+        mean = batch.mean(dim=(1, 2, 3)).view(-1, 1, 1, 1) * 255
+        return SimpleNamespace(latent_dist=SimpleNamespace(mean=mean))
+
+
+def test_deduplicated_streams_keep_one_latent_per_frame_across_batches(tmp_path):
+    # both videos share the encoder, so reused frames are dispatched while their latents are still queued
+    streams = [
+        ('clip_a', [frame(level) for level in [0, 0, 0, 50, 50, 100, 100, 100]]),
+        ('clip_b', [frame(level) for level in [200, 200, 30, 30, 30, 30]]),
+    ]
+    sink = SegmentSink()
+    encoder = BatchedVAEEncoder(LevelModel(), batch_size=3, device=torch.device('cpu'), policy='mean')
+    encode_frame_streams(streams, str(tmp_path), encoder=encoder, frames_per_segment=4, shard_writer=sink, dedup='diff')
+
+    saved = {(video_id, segment): [round(value) for value in latents.flatten().tolist()]
+             for video_id, segment, latents in sink.segments}
+    assert saved == {
+        ('clip_a', 0): [0, 0, 0, 50], ('clip_a', 1): [50, 100, 100, 100],
+        ('clip_b', 0): [200, 200, 30, 30], ('clip_b', 1): [30, 30],
+    }
+    assert (tmp_path / 'clip_a_dedup.json').exists() and (tmp_path / 'clip_b_dedup.json').exists()
@@ -0,0 +1,70 @@
+import re
+
+import pytest
+
+pytest.importorskip('ffmpeg')
+
+from decode_backends import FrameSampler, build_sample_filter
+from fused_pipeline import build_crop_filter, build_ffmpeg_command
+
+
+def sampler_indices(source_fps, target_fps, frames):
+    sampler = FrameSampler(source_fps, target_fps)
+    return [index for index in range(frames) if sampler.keep(index)]
+
+
+def select_indices(sample_filter, source_fps, frames):
+    """Evaluate build_sample_filter's select expression the way ffmpeg does, frame by frame."""
+    rate, epsilon = re.fullmatch(r"select='gte\(t\*([\d.]+)\+([\d.]+),selected_n\)'", sample_filter).groups()
+    selected = []
+    for index in range(frames):
+        t = index / source_fps
+        if t * float(rate) + float(epsilon) >= len(selected):
+            selected.append(index)
+    return selected
+
+
+def test_sampler_keeps_the_first_frame_of_every_tick():
+    assert sampler_indices(30, 4, 60) == [0, 8, 15, 23, 30, 38, 45, 53]
+    assert sampler_indices(25, 4, 25) == [0, 7, 13, 19]
+    assert sampler_indices(24, 4, 24) == [0, 6, 12, 18]
+    assert sampler_indices(4, 4, 5) == sampler_indices(3, 4, 5) == [0, 1, 2, 3, 4]  # never duplicates or skips
+
+
+@pytest.mark.parametrize('source_fps', [24, 25, 29.97, 30, 50, 59.94, 60])
+@pytest.mark.parametrize('target_fps', [1, 4, 7.5, 10])
+def test_select_filter_keeps_the_sampler_indices(source_fps, target_fps):
+    frames = int(source_fps * 20)
+    assert select_indices(build_sample_filter(target_fps), source_fps, frames) == sampler_indices(source_fps, target_fps, frames)
+
+
+def test_no_sample_filter_without_a_target():
+    assert build_sample_filter(None) is None
+    assert build_sample_filter(0) is None
+
+
+def test_command_without_mp4_output():
+    command = build_ffmpeg_command('in.mp4', 'crop=256:256:10:20', target_fps=4)
+    assert command == ['ffmpeg', '-v', 'error', '-y', '-i', 'in.mp4', '-vf', f"crop=256:256:10:20,{build_sample_filter(4)}", '-an',
+                       '-vsync', '0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+    assert build_ffmpeg_command('in.mp4', None) == ['ffmpeg', '-v', 'error', '-y', '-i', 'in.mp4', '-an',
+                                                     '-vsync', '0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+
+
+def test_command_with_mp4_output_samples_only_the_raw_branch():
+    command = build_ffmpeg_command('in.mp4', 'crop=256:256:10:20', mp4_output='out.mp4', target_fps=4)
+    graph = command[command.index('-filter_complex') + 1]
+    assert graph == f"[0:v]crop=256:256:10:20,split=2[enc][full];[full]{build_sample_filter(4)}[raw]"
+    assert command[command.index('out.mp4') - 2:command.index('out.mp4') + 1] == ['-f', 'mp4', 'out.mp4']
+    assert command[command.index('[enc]') - 1] == '-map'
+    assert command[-9:] == ['-map', '[raw]', '-vsync', '0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+
+    unsampled = build_ffmpeg_command('in.mp4', None, mp4_output='out.mp4')
+    assert unsampled[unsampled.index('-filter_complex') + 1] == "[0:v]null,split=2[enc][raw]"
+
+
+def test_crop_filter_is_seeded():
+    assert build_crop_filter(256, 256) == (None, 256, 256)
+    assert build_crop_filter(640, 360, seed=7) == build_crop_filter(640, 360, seed=7)
+    video_filter, width, height = build_crop_filter(640, 360, seed=7)
+    assert re.fullmatch(r'crop=256:256:\d+:\d+', video_filter) and (width, height) == (256, 256)
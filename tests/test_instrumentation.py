@@ -0,0 +1,54 @@
+import pytest
+
+import instrumentation
+from instrumentation import timed
+
+
+@pytest.fixture(autouse=True)
+def clean_counters():
+    instrumentation.reset()
+    yield
+    instrumentation.reset()
+
+
+def errors(stage):
+    return instrumentation.snapshot()['stages'][stage]['errors']
+
+
+def test_false_return_and_exceptions_count_as_errors():
+    @timed('work', input_path_arg=None)
+    def work(result):
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    work(True)
+    work(None)  # a plain None is a success unless none_is_error is set
+    work(False)
+    with pytest.raises(ValueError):
+        work(ValueError())
+    assert instrumentation.snapshot()['stages']['work']['calls'] == 4
+    assert errors('work') == 2
+
+
+def test_failed_crop_is_counted(tmp_path, monkeypatch):
+    pytest.importorskip('ffmpeg')
+    import resize
+
+    monkeypatch.setattr(resize, 'probe_video', lambda path: None)
+    source = tmp_path / 'clip.mp4'
+    source.write_bytes(b'not a video')
+    assert resize.random_crop_video(str(source), str(tmp_path / 'out.mp4')) is False
+    assert errors('crop') == 1
+
+
+def test_uncropped_video_is_passed_through(tmp_path, monkeypatch):
+    pytest.importorskip('ffmpeg')
+    import resize
+
+    monkeypatch.setattr(resize, 'probe_video', lambda path: {'width': 256, 'height': 256})
+    source = tmp_path / 'clip.mp4'
+    source.write_bytes(b'already 256x256')
+    assert resize.random_crop_video(str(source), str(tmp_path / 'out.mp4'), keep_input=True) is True
+    assert (tmp_path / 'out.mp4').read_bytes() == b'already 256x256'
+    assert errors('crop') == 0
@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from latent_codec import (LATENT_DTYPES, LATENT_POLICIES, dequantize_int8, load_latents, pack_latents, quantize_int8,
+                          unpack_latents)
+from latent_shards import LatentShardReader, LatentShardWriter
+
+
+def segment(frames=5, channels=4, seed=0):
+    """(T, C, H, W) latents with a different range per channel, as VAE channels have."""
+    generator = torch.Generator().manual_seed(seed)
+    spread = torch.arange(1, channels + 1, dtype=torch.float32).view(1, channels, 1, 1)
+    return torch.randn((frames, channels, 6, 8), generator=generator) * spread + spread
+
+
+def channel_max_error(restored, latents):
+    return (restored - latents).abs().transpose(0, 1).reshape(latents.shape[1], -1).max(dim=1).values
+
+
+def test_int8_round_trip_stays_within_half_a_step_per_channel():
+    latents = segment()
+    q, scale, zero_point = quantize_int8(latents)
+    assert q.dtype == torch.int8 and q.shape == latents.shape
+    assert scale.shape == zero_point.shape == (latents.shape[1],)
+    assert q.min() == -128 and q.max() == 127  # each channel's range is spread over the full int8 range
+
+    error = channel_max_error(dequantize_int8(q, scale, zero_point), latents)
+    assert torch.all(error <= scale * 0.5 + 1e-6)
+
+
+def test_int8_constant_channel():
+    latents = torch.full((2, 3, 4, 4), 0.25)
+    q, scale, zero_point = quantize_int8(latents)
+    assert torch.allclose(dequantize_int8(q, scale, zero_point), latents, atol=1e-6)
+
+
+@pytest.mark.parametrize('policy', LATENT_POLICIES)
+@pytest.mark.parametrize('dtype', LATENT_DTYPES)
+def test_pack_unpack_round_trip(tmp_path, policy, dtype):
+    channels = 8 if policy == 'mean_logvar' else 4
+    latents = segment(channels=channels)
+    packed = pack_latents(latents, dtype, policy)
+    if policy == 'mean' and dtype != 'int8':
+        assert torch.is_tensor(packed)  # plain mean latents stay bare tensors, as older runs saved them
+    else:
+        assert packed['policy'] == policy and packed['dtype'] == dtype
+
+    path = tmp_path / 'clip_vae_features_batch_0.pt'
+    torch.save(packed, path)
+    restored = load_latents(path)
+    assert restored.dtype == torch.float32 and restored.shape == latents.shape
+    rtol, atol = {'fp32': (0, 0), 'fp16': (1e-3, 1e-4), 'int8': (0, (latents.max() - latents.min()).item() / 255)}[dtype]
+    assert torch.allclose(restored, latents, rtol=rtol, atol=atol)
+    assert torch.equal(unpack_latents(packed), restored)
+
+
+def test_unknown_dtype():
+    with pytest.raises(ValueError, match='Unknown latent dtype'):
+        pack_latents(segment(), 'int4')
+
+
+def test_int8_shard_reads_back_dequantized(tmp_path):
+    segments = {('clip_a', 0): segment(seed=1), ('clip_a', 1): segment(seed=2), ('clip_b', 0): segment(frames=3, seed=3)}
+    with LatentShardWriter(str(tmp_path), dtype='int8', policy='mean') as writer:
+        for (video_id, index), latents in segments.items():
+            writer.append(video_id, index, latents)
+    shard_path, = writer.shard_paths
+    assert (tmp_path / 'latents_00000.bin').stat().st_size == sum(latents.numel() for latents in segments.values())
+
+    with LatentShardReader(shard_path) as reader:
+        assert reader.dtype == torch.int8 and reader.policy == 'mean' and len(reader) == 3
+        for (video_id, index), latents in segments.items():
+            restored = reader.get(video_id, index)
+            _, scale, _ = quantize_int8(latents)
+            assert restored.dtype == torch.float32 and restored.shape == latents.shape
+            assert torch.all(channel_max_error(restored, latents) <= scale * 0.5 + 1e-6)
+
+
+class PosteriorModel(torch.nn.Module):
+    """Stands in for the VAE encoder: a fixed posterior per frame, so only the sampling noise varies."""
+
+    device = torch.device('cpu')
+
+    def encode(self, batch):
+        mean = batch[:, :1, :4, :4].repeat(1, 4, 1, 1)
+        return SimpleNamespace(latent_dist=SimpleNamespace(mean=mean, std=torch.ones_like(mean)))
+
+
+def encode_streams(streams, batch_size, seed=0):
+    from vae_feature_extraction import BatchedVAEEncoder
+
+    encoder = BatchedVAEEncoder(PosteriorModel(), batch_size=batch_size, device=torch.device('cpu'), policy='sample', seed=seed)
+    latents = {name: [] for name, _ in streams}
+    encoded = []
+    for frames in zip(*(frames for _, frames in streams)):
+        for (name, _), frame in zip(streams, frames):
+            encoded += encoder.add(SimpleNamespace(video_name=name), frame)
+    encoded += encoder.flush()
+    for owner, latent in encoded:
+        latents[owner.video_name].append(latent)
+    return {name: torch.stack(values) for name, values in latents.items()}
+
+
+def test_sample_policy_is_seeded_per_video():
+    pytest.importorskip('torchvision')
+    frames = [torch.rand((3, 8, 8), generator=torch.Generator().manual_seed(i)) for i in range(6)]
+    alone = encode_streams([('clip_a', frames)], batch_size=4)
+    shared = encode_streams([('clip_a', frames), ('clip_b', frames)], batch_size=3)
+
+    # the same video samples the same latents whatever it shares batches with
+    assert torch.equal(alone['clip_a'], shared['clip_a'])
+    # other videos (or seeds) draw their own noise for identical frames
+    assert not torch.equal(shared['clip_a'], shared['clip_b'])
+    assert not torch.equal(alone['clip_a'], encode_streams([('clip_a', frames)], batch_size=4, seed=1)['clip_a'])
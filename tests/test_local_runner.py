@@ -0,0 +1,51 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+pytest.importorskip('celery')
+pytest.importorskip('torch')
+
+from local_runner import iter_videos
+from manifest import archive_member_source
+
+
+def write_archive(path, names):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for name in names:
+            data = os.urandom(50_000)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    path.write_bytes(buffer.getvalue())
+    return str(path)
+
+
+def test_archive_members_are_read_one_at_a_time(tmp_path):
+    archive = write_archive(tmp_path / 'part_0.tar.gz', ['train/a.mp4', 'train/notes.txt', 'train/b.mp4'])
+    out = tmp_path / 'out'
+    videos = iter_videos(['/data/clip.mp4'], [archive], str(out))
+
+    assert next(videos) == ('/data/clip.mp4', None)
+    assert not out.exists()  # nothing is read from an archive before its first member is asked for
+
+    path, source = next(videos)
+    assert source == archive_member_source(archive, 'train/a.mp4')
+    assert os.listdir(os.path.dirname(path)) == ['a.mp4']
+    os.remove(path)  # the preprocess job consumes extracted members
+
+    path, source = next(videos)
+    assert source == archive_member_source(archive, 'train/b.mp4')
+    assert os.listdir(os.path.dirname(path)) == ['b.mp4']
+    assert next(videos, None) is None
+
+
+def test_unreadable_archive_is_skipped(tmp_path, capsys):
+    missing = str(tmp_path / 'part_0.tar.gz')
+    good = write_archive(tmp_path / 'part_1.tar.gz', ['train/c.mp4'])
+    sources = [source for _, source in iter_videos([], [missing, good], str(tmp_path / 'out'))]
+
+    assert sources == [archive_member_source(good, 'train/c.mp4')]
+    assert f"Error reading archive {missing}" in capsys.readouterr().out
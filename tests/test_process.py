@@ -0,0 +1,179 @@
+import os
+
+import pytest
+
+pytest.importorskip('celery')
+pytest.importorskip('torch')
+
+import process
+from celery.backends.cache import CacheBackend
+from manifest import Manifest, archive_member_source, file_digest, manifest_key, pipeline_params
+from resize import crop_views
+
+
+@pytest.fixture
+def manifest(tmp_path, monkeypatch):
+    manifest = Manifest(str(tmp_path / 'manifest'))
+    monkeypatch.setattr(process, 'Manifest', lambda: manifest)
+    monkeypatch.setattr(process, 'CROP_VIEWS', 3)
+    return manifest
+
+
+def params(views):
+    return pipeline_params(256, 256, process.TARGET_FPS, process.FRAMES_PER_SEGMENT, vae_model=process.VAE_MODEL_NAME,
+                           crop_views=views, crop_mode=process.CROP_VIEW_MODE)
+
+
+def test_single_view_paths_key_on_one_view(manifest, tmp_path):
+    video = tmp_path / 'clip.mp4'
+    video.write_bytes(b'not really a video')
+    manifest.put(manifest_key(str(video), params(1)), {'status': 'complete', 'content_hash': file_digest(str(video))})
+
+    assert process.start_progress(str(video), 256, 256, process.TARGET_FPS, views=process.output_views(False)) is None
+    assert process.start_progress(str(video), 256, 256, process.TARGET_FPS, views=process.output_views(True)) is not None
+
+
+@pytest.mark.parametrize('mode, planned', [('random', 3), ('jitter', 3), ('center', 1), ('corner', 3)])
+def test_view_count_matches_the_views_each_mode_plans(monkeypatch, mode, planned):
+    monkeypatch.setattr(process, 'CROP_VIEWS', 3)
+    monkeypatch.setattr(process, 'CROP_VIEW_MODE', mode)
+    assert len(crop_views(640, 360, 256, 256, 3, mode, seed=0)) == process.output_views(True) == planned
+    assert process.output_views(False) == 1
+
+
+def test_corner_mode_has_five_views(monkeypatch):
+    monkeypatch.setattr(process, 'CROP_VIEWS', 8)
+    monkeypatch.setattr(process, 'CROP_VIEW_MODE', 'corner')
+    assert len(crop_views(640, 360, 256, 256, 8, 'corner')) == process.output_views(True) == 5
+    assert process.job_params(256, 256, process.TARGET_FPS, process.output_views(True))['crop_views'] == [5, 'corner']
+
+
+def test_archive_key_matches_the_views_its_videos_get(manifest, tmp_path):
+    url = 'https://example.com/k400/part_0.tar.gz'
+    manifest.put(manifest_key(url, params(1)), {'status': 'complete'})
+    assert process.process_archive(url, str(tmp_path))['status'] == 'skipped'
+    assert process.process_archive(url, str(tmp_path), staged=True)['status'] == 'skipped'
+
+    manifest.put(manifest_key(url, params(3)), {'status': 'complete'})
+    assert process.process_archive(url, str(tmp_path), single_pass=True)['status'] == 'skipped'
+
+
+def test_archive_videos_are_keyed_on_their_source_not_the_spool_path(manifest, tmp_path):
+    url = 'https://example.com/k400/part_0.tar.gz'
+    source = archive_member_source(url, 'train/abseiling/abc.mp4')
+    spooled = tmp_path / 'ingest_part_0' / 'abc.mp4'
+    spooled.parent.mkdir()
+    spooled.write_bytes(b'not really a video')
+    manifest.put(manifest_key(source, params(1)), {'status': 'complete', 'content_hash': file_digest(str(spooled))})
+    assert process.process_video(str(spooled), str(tmp_path / 'out'), source=source)
+    assert not spooled.exists()  # the already-complete early return still consumes the source
+
+
+def test_submitter_filters_on_the_same_keys(manifest, monkeypatch):
+    pytest.importorskip('dotenv')
+    download_kinetics = pytest.importorskip('download_kinetics')
+    monkeypatch.setattr(download_kinetics, 'Manifest', lambda: manifest)
+    url = 'https://example.com/k400/part_0.tar.gz'
+    done, pending = archive_member_source(url, 'a.mp4'), archive_member_source(url, 'b.mp4')
+    manifest.put(manifest_key(done, params(1)), {'status': 'complete'})
+
+    assert download_kinetics.filter_completed([done, pending], params(1)) == [pending]
+
+
+@pytest.fixture
+def staged_archive(manifest, tmp_path, monkeypatch):
+    """process_archives over a fake shard whose members preprocess to clips; encode_clip fails for 'bad' clips."""
+    members = {'part_0': ['a.mp4', 'b.mp4'], 'part_1': ['c.mp4', 'bad.mp4', 'broken.mp4']}
+    encoded = []
+
+    def ingest_archive(url, handle_video):
+        name = url.rsplit('/', 1)[-1].split('.')[0]
+        return [handle_video(str(tmp_path / member), f"train/{member}") for member in members[name]]
+
+    def preprocess_video(file_path, output_dir, *args, source=None):
+        if 'broken' in file_path:
+            return False
+        clip_path = tmp_path / ('clip_' + os.path.basename(file_path))
+        clip_path.write_bytes(b'clip')
+        return {'file_path': file_path, 'source': source, 'video_name': clip_path.stem, 'clip_path': str(clip_path),
+                'clip_key': clip_path.name, 'content_hash': None}
+
+    def encode_clip(clip_path, video_name, source_path, *args):
+        encoded.append(video_name)
+        if 'bad' in video_name:
+            raise RuntimeError("CUDA error")
+        return True
+
+    # eager chords still go through the result backend; keep it in memory instead of the workers' Redis
+    monkeypatch.setattr(process.app, '_backend_cache', CacheBackend(app=process.app, url='memory://'))
+    monkeypatch.setattr(process, 'ingest_archive', ingest_archive)
+    monkeypatch.setattr(process, 'preprocess_video', preprocess_video)
+    monkeypatch.setattr(process, 'encode_clip', encode_clip)
+    return encoded
+
+
+def test_staged_archives_finish_after_their_encodes(manifest, staged_archive, tmp_path):
+    urls = ['https://example.com/k400/part_0.tar.gz', 'https://example.com/k400/part_1.tar.gz']
+    results = process.process_archives.apply(args=[urls, str(tmp_path / 'out')], kwargs={'staged': True}).get()
+
+    assert staged_archive == ['clip_a', 'clip_b', 'clip_c', 'clip_bad']
+    assert results == [
+        {'url': urls[0], 'status': 'complete', 'videos': 2, 'failed': 0},
+        {'url': urls[1], 'status': 'partial', 'videos': 3, 'failed': 2},  # one failed encode, one failed preprocess
+    ]
+    assert manifest.is_complete(manifest_key(urls[0], params(1)))
+    assert not manifest.is_complete(manifest_key(urls[1], params(1)))
+
+
+def test_staged_archive_without_clips_is_finished_in_place(manifest, staged_archive, tmp_path, monkeypatch):
+    monkeypatch.setattr(process, 'preprocess_video', lambda *args, **kwargs: None)  # every video already complete
+    url = 'https://example.com/k400/part_0.tar.gz'
+    results = process.process_archives.apply(args=[[url], str(tmp_path / 'out')], kwargs={'staged': True}).get()
+    assert results == [{'url': url, 'status': 'complete', 'videos': 2, 'failed': 0}]
+    assert staged_archive == []
+
+
+class ShardSink:
+    """Stands in for a LatentShardWriter; close() returns one shard."""
+
+    def __init__(self, output_dir, **kwargs):
+        self.shard_path = os.path.join(output_dir, 'latents_00000.bin')
+
+    def close(self):
+        return [self.shard_path]
+
+
+def test_video_group_skips_completed_videos_and_isolates_failures(manifest, tmp_path, monkeypatch):
+    videos = {name: tmp_path / f"{name}.mp4" for name in ['done', 'good', 'bad', 'empty', 'last']}
+    for video in videos.values():
+        video.write_bytes(video.name.encode())
+    manifest.put(manifest_key(str(videos['done']), params(1)), {'status': 'complete', 'content_hash': file_digest(str(videos['done']))})
+
+    def stream_video_frames(file_path, *args, **kwargs):
+        if 'empty' in file_path:
+            return
+        yield 0
+        if 'bad' in file_path:
+            raise RuntimeError("ffmpeg exited with 1")
+        yield 1
+
+    decoded = {}
+
+    def encode_frame_streams(streams, *args, **kwargs):
+        for video_name, frames in streams:
+            decoded[video_name] = list(frames)
+
+    monkeypatch.setattr(process, 'stream_video_frames', stream_video_frames)
+    monkeypatch.setattr(process, 'encode_frame_streams', encode_frame_streams)
+    monkeypatch.setattr(process, 'LatentShardWriter', ShardSink)
+    monkeypatch.setattr(process, 'wait_for_uploads', lambda uploads, label: True)
+
+    out = tmp_path / 'out'
+    shards = process.process_video_group([str(video) for video in videos.values()], str(out), bucket_name=None)
+
+    assert shards == [str(out / 'latents_00000.bin')]
+    assert decoded == {'good': [0, 1], 'bad': [0], 'empty': [], 'last': [0, 1]}  # the bad video does not stop the group
+    completed = {name for name, video in videos.items() if manifest.is_complete(manifest_key(str(video), params(1)))}
+    assert completed == {'done', 'good', 'last'}
+    assert manifest.get(manifest_key(str(videos['good']), params(1)))['shards'] == ['latents_00000.bin']
+    assert not any(video.exists() for video in videos.values())
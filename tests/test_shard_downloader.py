@@ -0,0 +1,186 @@
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import shard_downloader
+from shard_downloader import DownloadError, download_shard, submit_on_complete
+
+CONTENT = os.urandom(3 * shard_downloader.CHUNK_SIZE + 12345)
+CONTENT_MD5 = hashlib.md5(CONTENT).hexdigest()
+
+
+class ShardServer(ThreadingHTTPServer):
+    """Serves CONTENT at any path, with Range support; failures and corruption are scripted per test."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ShardHandler)
+        self.content = CONTENT
+        self.send_length = True
+        self.send_etag = True
+        self.fail_gets = 0       # answer this many GETs with 503 first
+        self.corrupt_gets = 0    # then serve this many GETs with a flipped byte
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/k400/part_0.tar.gz"
+
+
+class ShardHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, status, length):
+        self.send_response(status)
+        if self.server.send_length:
+            self.send_header('Content-Length', str(length))
+        if self.server.send_etag:
+            self.send_header('ETag', f'"{CONTENT_MD5}"')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.server.requests.append(('HEAD', None))
+        self._headers(200, len(self.server.content))
+
+    def do_GET(self):
+        server = self.server
+        range_header = self.headers.get('Range')
+        server.requests.append(('GET', range_header))
+        if server.fail_gets:
+            server.fail_gets -= 1
+            self.send_error(503)
+            return
+        body = server.content
+        if server.corrupt_gets:
+            server.corrupt_gets -= 1
+            body = bytes([body[0] ^ 0xFF]) + body[1:]
+        status = 200
+        if range_header:
+            start = int(re.match(r'bytes=(\d+)-', range_header).group(1))
+            if start >= len(body):
+                self.send_error(416)
+                return
+            body, status = body[start:], 206
+        if not server.send_length:
+            self.close_connection = True
+        self._headers(status, len(body))
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = ShardServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(shard_downloader.time, 'sleep', delays.append)
+    return delays
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_downloads_and_verifies(server, tmp_path, sleeps):
+    stats = download_shard(server.url, str(tmp_path))
+    assert read(stats['path']) == CONTENT
+    assert stats['bytes'] == len(CONTENT) and stats['attempts'] == 1
+    assert not os.path.exists(stats['path'] + '.part')
+    assert sleeps == []
+
+
+def test_resumes_part_file_with_range_request(server, tmp_path, sleeps):
+    part_path = shard_downloader.shard_path(server.url, str(tmp_path)) + '.part'
+    with open(part_path, 'wb') as f:
+        f.write(CONTENT[:1000])
+
+    stats = download_shard(server.url, str(tmp_path))
+
+    assert ('GET', 'bytes=1000-') in server.requests
+    assert stats['resumed_from'] == 1000
+    assert stats['bytes'] == len(CONTENT) - 1000
+    assert read(stats['path']) == CONTENT
+
+
+def test_md5_mismatch_discards_the_data_and_retries(server, tmp_path, sleeps):
+    server.corrupt_gets = 1
+    stats = download_shard(server.url, str(tmp_path), backoff=1)
+    assert stats['attempts'] == 2
+    assert read(stats['path']) == CONTENT
+    assert sleeps == [1]
+
+
+def test_md5_mismatch_gives_up_without_keeping_data(server, tmp_path, sleeps):
+    with pytest.raises(DownloadError, match='md5 mismatch'):
+        download_shard(server.url, str(tmp_path), retries=1, backoff=0, expected_md5='0' * 32)
+    assert os.listdir(tmp_path) == []
+
+
+def test_retries_with_exponential_backoff(server, tmp_path, sleeps):
+    server.fail_gets = 3
+    stats = download_shard(server.url, str(tmp_path), retries=5, backoff=0.5)
+    assert stats['attempts'] == 4
+    assert sleeps == [0.5, 1.0, 2.0]
+    assert read(stats['path']) == CONTENT
+
+
+def test_gives_up_after_retries(server, tmp_path, sleeps):
+    server.fail_gets = 10
+    with pytest.raises(DownloadError, match='giving up after 3 attempts'):
+        download_shard(server.url, str(tmp_path), retries=2, backoff=1)
+    assert sleeps == [1, 2]
+
+
+def test_verified_file_is_skipped(server, tmp_path, sleeps):
+    path = shard_downloader.shard_path(server.url, str(tmp_path))
+    with open(path, 'wb') as f:
+        f.write(CONTENT)
+    stats = download_shard(server.url, str(tmp_path))
+    assert stats['skipped']
+    assert [method for method, _ in server.requests] == ['HEAD']
+
+
+def test_truncated_file_of_unknown_size_is_completed(server, tmp_path, sleeps):
+    server.send_length = server.send_etag = False  # nothing to verify the file on disk against
+    path = shard_downloader.shard_path(server.url, str(tmp_path))
+    with open(path, 'wb') as f:
+        f.write(CONTENT[:5000])
+
+    stats = download_shard(server.url, str(tmp_path))
+
+    assert not stats['skipped']
+    assert ('GET', 'bytes=5000-') in server.requests
+    assert read(path) == CONTENT
+
+
+def test_same_size_file_with_wrong_md5_is_downloaded_again(server, tmp_path, sleeps):
+    path = shard_downloader.shard_path(server.url, str(tmp_path))
+    with open(path, 'wb') as f:
+        f.write(b'\0' * len(CONTENT))
+    stats = download_shard(server.url, str(tmp_path), backoff=0)
+    assert not stats['skipped']
+    assert read(path) == CONTENT
+
+
+def test_submit_on_complete_targets_the_cpu_queue():
+    sent = []
+
+    class App:
+        def send_task(self, name, **kwargs):
+            sent.append((name, kwargs))
+
+    submit_on_complete(App(), '/data/out')({'path': '/data/shards/part_0.tar.gz'})
+    assert sent == [('process.process_archives',
+                     {'args': [['/data/shards/part_0.tar.gz'], '/data/out'], 'queue': shard_downloader.CPU_QUEUE})]
@@ -0,0 +1,108 @@
+import io
+import os
+import tarfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tar_ingest import ingest_archive
+
+MEMBERS = {
+    'train/abseiling/a.mp4': os.urandom(300_000),
+    'train/abseiling/notes.txt': b'not a video',
+    'train/bowling/b.mp4': os.urandom(200_000),
+}
+
+
+def make_archive():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for name, data in MEMBERS.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+ARCHIVE = make_archive()
+
+
+class ArchiveServer(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ArchiveHandler)
+        self.stall_after = None  # stop sending after this many bytes until released
+        self.release = threading.Event()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/k400/part_0.tar.gz"
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(ARCHIVE)))
+        self.end_headers()
+        if self.server.stall_after is None:
+            self.wfile.write(ARCHIVE)
+            return
+        self.wfile.write(ARCHIVE[:self.server.stall_after])
+        self.wfile.flush()
+        self.server.release.wait(10)
+
+
+@pytest.fixture
+def server():
+    server = ArchiveServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def collect(seen):
+    def handle_video(path, member_name):
+        with open(path, 'rb') as f:
+            seen[member_name] = f.read()
+        return member_name
+    return handle_video
+
+
+def test_ingests_video_members_with_their_names(server, tmp_path):
+    seen = {}
+    assert ingest_archive(server.url, collect(seen), spool_root=str(tmp_path)) == ['train/abseiling/a.mp4', 'train/bowling/b.mp4']
+    assert seen == {name: data for name, data in MEMBERS.items() if name.endswith('.mp4')}
+    assert os.listdir(tmp_path) == []  # spool removed
+
+
+def test_local_archive(tmp_path):
+    path = tmp_path / 'part_1.tar.gz'
+    path.write_bytes(ARCHIVE)
+    seen = {}
+    ingest_archive(str(path), collect(seen), spool_root=str(tmp_path / 'spool'))
+    assert sorted(seen) == ['train/abseiling/a.mp4', 'train/bowling/b.mp4']
+
+
+def test_stalled_download_fails_instead_of_hanging(server, tmp_path):
+    server.stall_after = len(ARCHIVE) - 100_000  # part way through the second video
+    seen = {}
+    started = time.time()
+    with pytest.raises(OSError):
+        ingest_archive(server.url, collect(seen), spool_root=str(tmp_path), timeout=0.5)
+    assert time.time() - started < 5
+    assert list(seen) == ['train/abseiling/a.mp4']  # videos read before the stall were still handled
+
+
+def test_handler_error_stops_the_reader(server, tmp_path):
+    def fail(path, member_name):
+        raise RuntimeError("encode failed")
+
+    with pytest.raises(RuntimeError, match='encode failed'):
+        ingest_archive(server.url, fail, spool_root=str(tmp_path))
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,131 @@
+import os
+
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+import upload_to_s3
+from boto3.s3.transfer import TransferConfig
+from upload_to_s3 import UploadQueue, download_file_from_s3, get_s3_client, get_upload_queue, upload_file_to_s3
+
+BUCKET = 'kinetics-400'
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(upload_to_s3, '_client', None)
+    monkeypatch.setattr(upload_to_s3, '_upload_queue', None)
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def make_file(directory, name, size=1024):
+    path = directory / name
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+
+def test_upload_and_download_round_trip(s3, tmp_path):
+    path = make_file(tmp_path, 'clip.mp4')
+    assert upload_file_to_s3(path, BUCKET, 'videos/clip.mp4')
+    assert download_file_from_s3(BUCKET, 'videos/clip.mp4', str(tmp_path / 'copy.mp4'))
+    assert (tmp_path / 'copy.mp4').read_bytes() == (tmp_path / 'clip.mp4').read_bytes()
+
+
+def test_upload_failure_returns_false(s3, tmp_path):
+    assert not upload_file_to_s3(make_file(tmp_path, 'clip.mp4'), 'no-such-bucket', 'clip.mp4')
+    assert not download_file_from_s3(BUCKET, 'missing.mp4', str(tmp_path / 'missing.mp4'))
+
+
+def test_queue_flush_waits_for_every_upload(s3, tmp_path):
+    uploads = UploadQueue(num_workers=3)
+    done = []
+    paths = [make_file(tmp_path, f'segment_{i}.pt') for i in range(10)]
+    for i, path in enumerate(paths):
+        uploads.submit(path, BUCKET, f'features/segment_{i}.pt', delete_after=i % 2 == 0, on_success=lambda i=i: done.append(i))
+
+    assert uploads.flush() == []
+    assert sorted(done) == list(range(10))
+    listed = s3.list_objects_v2(Bucket=BUCKET, Prefix='features/')['Contents']
+    assert len(listed) == 10
+    assert [os.path.exists(path) for path in paths] == [i % 2 == 1 for i in range(10)]
+    uploads.close()
+
+
+def test_queue_reports_failures_once_and_keeps_the_files(s3, tmp_path):
+    uploads = UploadQueue(num_workers=2)
+    good, bad = make_file(tmp_path, 'good.pt'), make_file(tmp_path, 'bad.pt')
+    called = []
+    uploads.submit(good, BUCKET, 'good.pt', delete_after=True)
+    uploads.submit(bad, 'no-such-bucket', 'bad.pt', delete_after=True, on_success=lambda: called.append(bad))
+
+    assert uploads.flush() == [(bad, 'no-such-bucket', 'bad.pt')]
+    assert os.path.exists(bad) and not os.path.exists(good)
+    assert called == []
+    assert uploads.flush() == []  # failures are cleared once reported
+
+    uploads.submit(bad, 'no-such-bucket', 'bad.pt')
+    assert uploads.close() == [(bad, 'no-such-bucket', 'bad.pt')]
+    assert not any(thread.is_alive() for thread in uploads._threads)
+
+
+def test_failing_callback_is_reported_and_the_workers_keep_going(s3, tmp_path):
+    uploads = UploadQueue(num_workers=1)
+    first, second = make_file(tmp_path, 'first.pt'), make_file(tmp_path, 'second.pt')
+    done = []
+
+    def manifest_put_fails():
+        raise RuntimeError("manifest write failed")
+
+    uploads.submit(first, BUCKET, 'first.pt', on_success=manifest_put_fails)
+    uploads.submit(second, BUCKET, 'second.pt', delete_after=True, on_success=lambda: done.append(second))
+    assert uploads.flush() == [(first, BUCKET, 'first.pt')]
+    assert done == [second] and not os.path.exists(second)
+
+    uploads.submit(first, BUCKET, 'first.pt', on_success=lambda: done.append(first))
+    assert uploads.flush() == []
+    assert done == [second, first]
+    uploads.close()
+
+
+def test_client_and_queue_are_shared_per_process(s3, monkeypatch):
+    client = get_s3_client()
+    uploads = get_upload_queue()
+    assert get_s3_client() is client and get_upload_queue() is uploads
+
+    # a forked worker child sees another pid and builds its own
+    monkeypatch.setattr(upload_to_s3.os, 'getpid', lambda: -1)
+    assert get_s3_client() is not client
+    assert get_upload_queue() is not uploads
+
+
+def test_client_pool_fits_every_upload_thread(s3):
+    pool = get_s3_client().meta.config.max_pool_connections
+    assert pool == upload_to_s3.S3_MAX_CONCURRENCY * upload_to_s3.S3_UPLOAD_WORKERS
+
+
+def test_multipart_threshold(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(upload_to_s3, 'TRANSFER_CONFIG', TransferConfig(
+        multipart_threshold=5 * MB, multipart_chunksize=5 * MB, max_concurrency=4, use_threads=True))
+    small = make_file(tmp_path, 'small.bin', 4 * MB)
+    large = make_file(tmp_path, 'large.bin', 11 * MB)
+    assert upload_file_to_s3(small, BUCKET, 'small.bin')
+    assert upload_file_to_s3(large, BUCKET, 'large.bin')
+
+    # multipart ETags end in -<number of parts>
+    assert '-' not in s3.head_object(Bucket=BUCKET, Key='small.bin')['ETag']
+    assert s3.head_object(Bucket=BUCKET, Key='large.bin')['ETag'].strip('"').endswith('-3')
+
+
+def test_default_transfer_config():
+    config = upload_to_s3.TRANSFER_CONFIG
+    assert config.multipart_threshold == upload_to_s3.S3_MULTIPART_THRESHOLD
+    assert config.multipart_chunksize == upload_to_s3.S3_MULTIPART_THRESHOLD
+    assert config.max_concurrency == upload_to_s3.S3_MAX_CONCURRENCY
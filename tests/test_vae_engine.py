@@ -0,0 +1,60 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+diffusers = pytest.importorskip('diffusers')
+
+from vae_engine import VAEEncoderEngine, parity_check
+
+
+def tiny_vae():
+    """Randomly initialised AutoencoderKL, as benchmarks/pipeline_benchmark.py::save_tiny_vae builds it."""
+    torch.manual_seed(0)
+    vae = diffusers.AutoencoderKL(
+        in_channels=3, out_channels=3, latent_channels=4,
+        down_block_types=('DownEncoderBlock2D',) * 4, up_block_types=('UpDecoderBlock2D',) * 4,
+        block_out_channels=(8, 16, 16, 16), layers_per_block=1, norm_num_groups=8, sample_size=256,
+    )
+    return vae.eval().requires_grad_(False)
+
+
+@pytest.fixture(scope='module')
+def reference():
+    return tiny_vae()
+
+
+@pytest.fixture(scope='module')
+def frames():
+    torch.manual_seed(1)
+    return torch.rand((2, 3, 64, 64)) * 2 - 1
+
+
+def engine_for(backend, tmp_path, **kwargs):
+    return VAEEncoderEngine(tiny_vae(), backend, device='cpu', model_name='tiny-vae', cache_dir=str(tmp_path), **kwargs)
+
+
+@pytest.mark.parametrize('backend, channels_last', [('eager', False), ('eager', True), ('torchscript', False)])
+def test_engine_matches_the_full_vae(reference, frames, tmp_path, backend, channels_last):
+    engine = engine_for(backend, tmp_path, channels_last=channels_last)
+    result = parity_check(reference, engine, frames, repeats=1)
+    assert result['mean_max_rel_error'] < 1e-4
+    assert result['logvar_max_rel_error'] < 1e-4
+
+
+def test_torchscript_artifact_is_reused(reference, frames, tmp_path):
+    first = engine_for('torchscript', tmp_path)
+    second = engine_for('torchscript', tmp_path)
+    assert first.artifact == second.artifact
+    with torch.inference_mode():
+        assert torch.allclose(first.moments(frames), second.moments(frames))
+
+
+def test_onnx_export_leaves_the_loaded_weights_alone(reference, frames, tmp_path):
+    pytest.importorskip('onnxruntime')
+    pytest.importorskip('onnx')
+    vae = tiny_vae().to(torch.float64)
+    engine = VAEEncoderEngine(vae, 'onnx', device='cpu', model_name='tiny-vae', cache_dir=str(tmp_path))
+    assert vae.encoder.conv_in.weight.dtype == torch.float64
+    assert next(engine.parameters()).dtype == torch.float64
+
+    result = parity_check(reference, engine_for('onnx', tmp_path / 'fp32'), frames, repeats=1)
+    assert result['mean_max_rel_error'] < 1e-4
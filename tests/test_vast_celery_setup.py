@@ -0,0 +1,141 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('celery')
+pytest.importorskip('dotenv')
+
+import vast_celery_setup
+
+
+class FakeVastai:
+    """Stands in for run_vastai: canned offers, scripted create results and instance states."""
+
+    def __init__(self, offers=(), create=None, states=None):
+        self.offers = list(offers)
+        self.create = create or {}
+        self.states = states or {}
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        if args[:2] == ('search', 'offers'):
+            return self.offers
+        if args[:2] == ('create', 'instance'):
+            return self.create.get(int(args[2]))
+        if args[:2] == ('show', 'instance'):
+            states = self.states.get(int(args[2]), [])
+            return states.pop(0) if len(states) > 1 else (states[0] if states else None)
+        raise AssertionError(f"unexpected vastai call {args}")
+
+
+class FakeTime:
+    """Clock that only moves when the code under test sleeps."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def offer(offer_id, dph, flops, inet_down=1000):
+    return {'id': offer_id, 'dph_total': dph, 'total_flops': flops, 'inet_down': inet_down, 'gpu_name': 'RTX'}
+
+
+@pytest.fixture
+def vastai(monkeypatch):
+    fake = FakeVastai()
+    monkeypatch.setattr(vast_celery_setup, 'run_vastai', fake)
+    return fake
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(vast_celery_setup, 'time', fake)
+    return fake
+
+
+def test_offers_are_ranked_by_tflops_per_dollar(vastai):
+    vastai.offers = [
+        offer(1, 0.40, 40),                  # 100 TFLOPS per $/hr
+        offer(2, 0.20, 30),                  # 150
+        offer(3, 0.10, 29, inet_down=250),   # 290, halved for half the target bandwidth: 145
+        offer(4, 0.25, 50),                  # 200
+        offer(5, 0.0, 99),                   # no price, scored 0
+    ]
+    ranked = vast_celery_setup.search_vast_ai_offers(max_dph=0.5)
+    assert [o['id'] for o in ranked] == [4, 2, 3, 1, 5]
+    assert vastai.calls == [('search', 'offers', 'dph_total<=0.5')]
+
+
+def test_no_offers(vastai):
+    vastai.offers = None
+    assert vast_celery_setup.search_vast_ai_offers() == []
+    assert vast_celery_setup.launch_vast_ai_instances(2) == []
+
+
+def test_launch_skips_taken_offers(vastai):
+    vastai.offers = [offer(1, 0.1, 50), offer(2, 0.1, 40), offer(3, 0.1, 30), offer(4, 0.1, 20)]
+    vastai.create = {1: {'success': False}, 2: {'new_contract': 202}, 4: {'new_contract': 404}}
+
+    assert vast_celery_setup.launch_vast_ai_instances(2, max_dph=0.3, image='vidforge/worker') == [202, 404]
+    created = [call[2] for call in vastai.calls if call[0] == 'create']
+    assert created == ['1', '2', '3', '4']
+    assert ('create', 'instance', '2', '--image', 'vidforge/worker', '--disk', '32') in vastai.calls
+
+
+def test_launch_stops_at_the_requested_count(vastai):
+    vastai.offers = [offer(i, 0.1, 50 - i) for i in range(1, 5)]
+    vastai.create = {i: {'new_contract': 100 + i} for i in range(1, 5)}
+    assert vast_celery_setup.launch_vast_ai_instances(2) == [101, 102]
+    assert len([call for call in vastai.calls if call[0] == 'create']) == 2
+
+
+def test_wait_for_instance_times_out(vastai, clock, monkeypatch):
+    vastai.states = {7: [{'actual_status': 'loading'}]}
+    monkeypatch.setattr(vast_celery_setup, 'subprocess', SimpleNamespace(run=lambda *a, **k: pytest.fail("not reachable yet")))
+
+    assert vast_celery_setup.wait_for_instance(7, timeout=60, poll_interval=10) is None
+    assert clock.sleeps == [10] * 6
+    assert len(vastai.calls) == 6
+
+
+def test_wait_for_instance_retries_until_ssh_answers(vastai, clock, monkeypatch):
+    running = {'actual_status': 'running', 'ssh_host': 'ssh5.vast.ai', 'ssh_port': 2222}
+    vastai.states = {7: [{'actual_status': 'loading'}, running]}
+    probes = iter([1, 0])
+    monkeypatch.setattr(vast_celery_setup, 'subprocess',
+                        SimpleNamespace(run=lambda *a, **k: SimpleNamespace(returncode=next(probes))))
+
+    assert vast_celery_setup.wait_for_instance(7, timeout=60, poll_interval=10) == ('root@ssh5.vast.ai', '2222')
+    assert clock.sleeps == [10, 10]
+
+
+def test_bootstrap_reports_per_instance_results(monkeypatch, capsys):
+    def setup(instance_id, timings=None, **kwargs):
+        timings['ready'] = 1.0
+        if instance_id == 2:
+            raise RuntimeError("scp failed")
+        if instance_id == 3:
+            return False
+        timings['start'] = 2.0
+        return True
+
+    monkeypatch.setattr(vast_celery_setup, 'setup_celery_worker_on_vast', setup)
+    results = vast_celery_setup.setup_celery_workers_on_vast([1, 2, 3], parallelism=2)
+
+    assert results == {1: True, 2: False, 3: False}
+    output = capsys.readouterr().out
+    assert "Setting up instance 2 failed: scp failed" in output
+    assert "1: 3s total" in output and "2: 1s total" in output and "FAILED" in output
+
+
+def test_bootstrap_with_no_instances():
+    assert vast_celery_setup.setup_celery_workers_on_vast([]) == {}
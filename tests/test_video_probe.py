@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+import video_probe
+from video_probe import index_path, load_index, probe_directory
+
+
+@pytest.fixture
+def videos(tmp_path, monkeypatch):
+    directory = tmp_path / 'videos'
+    directory.mkdir()
+    for name in ('a.mp4', 'b.webm'):
+        (directory / name).write_bytes(os.urandom(100))
+    (directory / 'notes.txt').write_text('not a video')
+
+    probed = []
+
+    def fake_probe(path):
+        probed.append(os.path.basename(path))
+        stat = os.stat(path)
+        return {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'duration': 1.0}
+
+    monkeypatch.setattr(video_probe, 'probe_video', fake_probe)
+    return directory, probed
+
+
+def test_index_next_to_the_videos(videos):
+    videos, probed = videos
+    index = probe_directory(str(videos))
+    assert sorted(index) == ['a.mp4', 'b.webm']
+    assert os.path.exists(videos / video_probe.PROBE_INDEX_NAME)
+
+    probed.clear()
+    assert probe_directory(str(videos)) == index
+    assert probed == []  # served from the index
+
+
+def test_index_dir_leaves_the_video_directory_untouched(videos, tmp_path):
+    videos, _ = videos
+    index_dir = tmp_path / 'output'
+    probe_directory(str(videos), index_dir=str(index_dir))
+    assert sorted(os.listdir(videos)) == ['a.mp4', 'b.webm', 'notes.txt']
+    assert os.path.exists(index_path(str(videos), str(index_dir)))
+    assert sorted(load_index(str(videos), str(index_dir))) == ['a.mp4', 'b.webm']
+
+
+def test_index_names_do_not_collide_across_directories(tmp_path):
+    first, second = tmp_path / 'x' / 'clips', tmp_path / 'y' / 'clips'
+    assert index_path(str(first), str(tmp_path)) != index_path(str(second), str(tmp_path))
+
+
+def test_unwritable_index_is_skipped(videos, tmp_path, capsys):
+    videos, _ = videos
+    blocker = tmp_path / 'not_a_directory'
+    blocker.write_text('')
+    index = probe_directory(str(videos), index_dir=str(blocker / 'index'))
+    assert sorted(index) == ['a.mp4', 'b.webm']
+    assert 'Could not write probe index' in capsys.readouterr().out
+
+
+def test_corrupt_index_is_ignored(videos):
+    videos, probed = videos
+    (videos / video_probe.PROBE_INDEX_NAME).write_text('{not json')
+    assert sorted(probe_directory(str(videos))) == ['a.mp4', 'b.webm']
+    assert sorted(probed) == ['a.mp4', 'b.webm']